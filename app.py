@@ -9,17 +9,42 @@ import plotly.express as px
 import plotly.graph_objects as go
 import numpy as np
 import re
-from openai import OpenAI
+import uuid
+import functools
 import faiss
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 import warnings
 warnings.filterwarnings('ignore')
 from dotenv import load_dotenv
+from src.application.profiler import format_schema_summary, get_source_profile, REMOTE_DIALECTS
+from src.application.federation import FederationEngine
+from src.application.type_inference import infer_column_types
+from src.application.dtype_optimizer import optimize_dtypes, register_dataframe, format_bytes
+from src.application.exporters import EXPORT_FORMATS, export_bytes, build_html_report
+from src.application.query_jobs import (
+    QueryJob, get_query_job_manager, make_async_runner, make_sync_runner, make_federated_runner
+)
+from src.application.llm_gateway import get_llm_gateway
+from src.application.ingestion_cache import get_ingestion_cache
+from src.application.result_grid import fetch_result_page, DEFAULT_PAGE_SIZE, PAGE_SIZE_OPTIONS
+from src.application.previous_results import (
+    collect_previous_results, format_previous_results, referenced_previous_results, register_previous_results
+)
+from src.application.engine import generate_validated_sql, SQL_CANDIDATES, make_preflight, summarize_result, build_result_chart
+from src.infrastructure.tracing import Trace, activate, span, record_llm_usage, record_fetch, metrics, start_metrics_server
+from src.application.sql_generation import (
+    is_safe_query, build_table_ref, build_sql_prompt, build_federated_sql_prompt,
+    mcp_tools_to_openai, build_mcp_messages, MCP_MODEL
+)
 
 # .envファイルから環境変数を読み込み
 load_dotenv()
 
+# Prometheusメトリクスのエクスポート（FLASHVIZ_METRICS_PORTを設定した場合のみ）
+if os.getenv("FLASHVIZ_METRICS_PORT"):
+    start_metrics_server(int(os.getenv("FLASHVIZ_METRICS_PORT")))
+
 # 新しいコネクタシステムのインポート
 try:
     from src.infrastructure.connectors.factory import ConnectorFactory
@@ -31,43 +56,132 @@ except ImportError as e:
 
 st.set_page_config(page_title="FlashViz", layout="wide", initial_sidebar_state="expanded")
 
-# SQLバリデーション関数
-def is_safe_query(sql: str) -> tuple[bool, str]:
-    """
-    SELECT文のみを許可するバリデーション
+# 文字列カラムをstring[pyarrow]で保持するか
+USE_ARROW_STRINGS = os.getenv("FLASHVIZ_ARROW_STRINGS", "false").lower() == "true"
+
+def add_data_source(source_name: str, source_info: dict) -> None:
+    """データソースを登録（取り込み時の型推論・dtype最適化はここで一度だけ実行、取り込みキャッシュ経由なら実行済み）"""
+    if source_info.get('df') is not None and 'dtype_report' not in source_info:
+        source_info['df'], source_info['schema_metadata'] = infer_column_types(source_info['df'])
+        source_info['df'], source_info['dtype_report'] = optimize_dtypes(
+            source_info['df'], use_arrow_strings=USE_ARROW_STRINGS
+        )
+    st.session_state.data_sources[source_name] = source_info
+    st.session_state.active_source = source_name
+    st.session_state.messages[source_name] = []
+
+def sync_federation() -> FederationEngine:
+    """接続中の全データソースを共有DuckDBセッションに登録（登録済みのソースは再取得しない）"""
+    engine = st.session_state.federation
+    sources = {name: info for name, info in st.session_state.data_sources.items()
+               if info.get('type') != 'mcp' and info.get('df') is not None}
+    engine.remove_missing(list(sources))
+    for name, info in sources.items():
+        if engine.relation_for(name) is not None:
+            continue
+        connector = info.get('connector')
+        dialect = connector.get_dialect() if connector is not None and hasattr(connector, 'get_dialect') else 'duckdb'
+        table_ref = build_table_ref(info, dialect, connector)
+        is_remote = dialect in REMOTE_DIALECTS and table_ref != "data" and hasattr(connector, 'execute_query')
+        # ウェアハウスのテーブルはクエリごとに必要なカラム・行だけをリモートで取得
+        engine.add_source(
+            name, info.get('type', dialect), info['df'],
+            dtype_columns=info.get('dtype_report', {}).get('columns'),
+            fetch=connector.execute_query_shared if is_remote else None,
+            table_ref=table_ref if is_remote else None,
+            dialect=dialect if is_remote else None,
+            profile=get_source_profile(info, dialect, connector, table_ref)
+        )
+    return engine
+
+def submit_query_job(sql_query: str, prompt: str, dialect: str, connector, duck_conn,
+                     federation: FederationEngine = None) -> QueryJob:
+    """クエリをバックグラウンドジョブとして投入（ドライバーのキャンセルAPIを登録）"""
+    if federation is not None:
+        # 全データソースを横断するクエリは共有DuckDBセッションで実行
+        run, cancel = make_federated_runner(federation, sql_query)
+    elif dialect in ['snowflake', 'databricks'] and connector and connector.supports_async_query():
+        # サーバー側で非同期実行し、クエリIDでポーリング・取得
+        run, cancel = make_async_runner(connector, sql_query)
+    elif dialect in ['snowflake', 'bigquery', 'databricks'] and connector and hasattr(connector, 'execute_query'):
+        run, cancel = make_sync_runner(connector, sql_query)
+    elif duck_conn is not None:
+        run = lambda job: duck_conn.execute(sql_query).fetchdf()
+        cancel = duck_conn.interrupt
+    else:
+        raise RuntimeError("DuckDB接続が初期化されていません。")
+
+    def traced_run(job: QueryJob) -> pd.DataFrame:
+        with span("query.execute", dialect="duckdb" if federation is not None else dialect):
+            result = run(job)
+            if federation is not None or dialect not in REMOTE_DIALECTS:
+                # DuckDBはfetchdfで直接DataFrameになるため、ここで取得量を記録
+                record_fetch(result, "duckdb")
+        return result
+
+    return get_query_job_manager().submit(st.session_state.session_id, sql_query, traced_run, cancel, label=prompt)
+
+@st.fragment(run_every=1.0)
+def render_query_job_status(job_id: str) -> None:
+    """実行中ジョブの進捗表示（このフラグメントだけを1秒ごとに再描画）"""
+    job_manager = get_query_job_manager()
+    job = job_manager.get(job_id)
+    if job is None or job.is_finished:
+        # 結果の処理はアプリ全体の再実行で行う
+        st.rerun()
+    with st.chat_message("assistant"):
+        status = {QueryJob.QUEUED: "キュー待ち", QueryJob.CANCELLING: "キャンセル中"}.get(job.status, "クエリ実行中")
+        st.markdown(f"⏳ {status}... 経過 {job.elapsed:.1f}秒 / 取得行数 {job.rows_fetched:,}")
+        if job.query_id:
+            st.caption(f"クエリID: {job.query_id}")
+        with st.expander("生成されたSQL"):
+            st.code(job.sql, language="sql")
+        if st.button("⏹ キャンセル", key=f"cancel_{job.id}", disabled=job.status == QueryJob.CANCELLING):
+            job_manager.cancel(job.id)
+            st.rerun()
+
+def reset_result_page(key: str) -> None:
+    """絞り込み・並べ替え・表示行数を変えたら最初のページに戻す"""
+    st.session_state[f"{key}_page"] = 1
 
-    Returns:
-        (bool, str): (安全かどうか, エラーメッセージ)
+@st.fragment
+def render_result_grid(result_df: pd.DataFrame, key: str) -> None:
+    """結果をページ単位で表示（並べ替え・絞り込みはDuckDBで実行し、表示するページの行だけをブラウザに送る）
+
+    ページ送りなどの操作ではこのフラグメントだけを再描画する。
     """
-    sql_stripped = sql.strip()
-    if not sql_stripped:
-        return False, "SQLクエリが空です"
-
-    # 大文字に変換してチェック（コメントや文字列リテラルを考慮）
-    sql_upper = sql_stripped.upper()
-
-    # WITH句（CTE）をサポート
-    if sql_upper.startswith('WITH'):
-        # WITH句の場合、最終的なSELECTがあるかチェック
-        if 'SELECT' not in sql_upper:
-            return False, "WITH句の後にSELECT文が必要です"
-    elif not sql_upper.startswith('SELECT'):
-        return False, "SELECT文のみ実行可能です"
-
-    # 危険なキーワードをチェック
-    dangerous_keywords = [
-        'UPDATE', 'DELETE', 'DROP', 'INSERT', 'CREATE',
-        'ALTER', 'TRUNCATE', 'GRANT', 'REVOKE', 'EXEC',
-        'EXECUTE', 'MERGE', 'REPLACE'
-    ]
-
-    for keyword in dangerous_keywords:
-        # 単語境界を考慮（例: SELECT内の"UPDATE"は許可）
-        pattern = r'\b' + keyword + r'\b'
-        if re.search(pattern, sql_upper):
-            return False, f"危険なSQL操作が検出されました: {keyword}"
-
-    return True, ""
+    if len(result_df) <= DEFAULT_PAGE_SIZE:
+        st.dataframe(result_df)
+        return
+
+    columns = list(result_df.columns)
+    filter_col, target_col = st.columns([3, 2])
+    with filter_col:
+        filter_text = st.text_input("絞り込み", key=f"{key}_filter", placeholder="含む文字列",
+                                    on_change=reset_result_page, args=(key,))
+    with target_col:
+        filter_column = st.selectbox("絞り込むカラム", [None] + columns, key=f"{key}_filter_column",
+                                     on_change=reset_result_page, args=(key,), format_func=lambda col: "（全カラム）" if col is None else str(col))
+    sort_col, order_col, size_col, page_col = st.columns([2, 1, 1, 1])
+    with sort_col:
+        sort_column = st.selectbox("並べ替え", [None] + columns, key=f"{key}_sort",
+                                   on_change=reset_result_page, args=(key,), format_func=lambda col: "（元の順序）" if col is None else str(col))
+    with order_col:
+        descending = st.toggle("降順", key=f"{key}_desc", disabled=sort_column is None,
+                               on_change=reset_result_page, args=(key,))
+    with size_col:
+        page_size = st.selectbox("表示行数", PAGE_SIZE_OPTIONS, index=PAGE_SIZE_OPTIONS.index(DEFAULT_PAGE_SIZE),
+                                 key=f"{key}_page_size", on_change=reset_result_page, args=(key,))
+    with page_col:
+        page = st.number_input("ページ", min_value=1, step=1, key=f"{key}_page")
+
+    result_page = fetch_result_page(result_df, page, page_size, sort_column, descending, filter_text, filter_column)
+    st.dataframe(result_page["rows"], hide_index=True)
+    if result_page["total"]:
+        st.caption(f"全{result_page['total']:,}行中 {result_page['start'] + 1:,}〜"
+                   f"{result_page['start'] + len(result_page['rows']):,}行目（{result_page['page']:,}/{result_page['pages']:,}ページ）")
+    else:
+        st.caption("条件に一致する行がありません")
 
 # セッション状態の初期化
 if 'data_sources' not in st.session_state:
@@ -78,6 +192,12 @@ if 'messages' not in st.session_state:
     st.session_state.messages = {}  # {データソース名: [messages]}
 if 'source_counter' not in st.session_state:
     st.session_state.source_counter = 0
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex  # クエリジョブの所有者ID
+if 'query_jobs' not in st.session_state:
+    st.session_state.query_jobs = {}  # {データソース名: 実行中のジョブ情報}
+if 'federation' not in st.session_state:
+    st.session_state.federation = FederationEngine()  # 全データソースを横断する共有DuckDBセッション
 
 # サイドバー
 with st.sidebar:
@@ -102,11 +222,21 @@ with st.sidebar:
             st.session_state.active_source = selected_source
             st.rerun()
 
+        # メモリ使用量（取り込み時のdtype最適化の前後）
+        dtype_report = st.session_state.data_sources[selected_source].get('dtype_report')
+        if dtype_report:
+            st.caption(
+                f"メモリ: {format_bytes(dtype_report['memory_before'])} → {format_bytes(dtype_report['memory_after'])}"
+            )
+
         # 削除ボタン
         col1, col2 = st.columns([3, 1])
         with col2:
             if st.button("🗑️", key="delete_source", help="選択中のデータソースを削除"):
                 del st.session_state.data_sources[selected_source]
+                pending_job = st.session_state.query_jobs.pop(selected_source, None)
+                if pending_job:
+                    get_query_job_manager().cancel(pending_job["job_id"])
                 if selected_source in st.session_state.messages:
                     del st.session_state.messages[selected_source]
                 st.session_state.active_source = list(st.session_state.data_sources.keys())[0] if st.session_state.data_sources else None
@@ -154,23 +284,33 @@ with st.sidebar:
         if uploaded_file and source_name:
             if st.button("追加", key="add_local"):
                 try:
-                    if uploaded_file.name.endswith(".csv"):
-                        df = pd.read_csv(uploaded_file)
-                    elif uploaded_file.name.endswith(".parquet"):
-                        df = pd.read_parquet(uploaded_file)
-                    elif uploaded_file.name.endswith((".xlsx", ".xls")):
-                        df = pd.read_excel(uploaded_file)
-
-                    # データソースを追加
-                    st.session_state.data_sources[source_name] = {
-                        "type": "local",
-                        "df": df,
-                        "connector": None,
-                        "file_name": uploaded_file.name
-                    }
-                    st.session_state.active_source = source_name
-                    st.session_state.messages[source_name] = []
-                    st.success(f"✅ {source_name}を追加しました！")
+                    progress_bar = st.progress(0.0, text="読み込み中...")
+
+                    def report_progress(done: int, total: int, item: str) -> None:
+                        progress_bar.progress(done / max(total, 1), text=f"読み込み中: {item}（{done}/{total}）")
+
+                    # 同じ内容のファイルは取り込み済みのデータを全セッションで共有
+                    ingested = get_ingestion_cache().load(
+                        uploaded_file, uploaded_file.name, use_arrow_strings=USE_ARROW_STRINGS,
+                        progress=report_progress
+                    )
+                    progress_bar.empty()
+
+                    # Excelの複数シートはシートごとに1つのデータソースとして追加
+                    tables = ingested["tables"]
+                    for table_name, table in tables.items():
+                        add_data_source(source_name if len(tables) == 1 else f"{source_name} - {table_name}", {
+                            "type": "local",
+                            "df": table["df"],
+                            "schema_metadata": table["schema_metadata"],
+                            "dtype_report": table["dtype_report"],
+                            "connector": None,
+                            "file_name": uploaded_file.name,
+                            "sheet_name": table_name if len(tables) > 1 else None,
+                            "content_hash": ingested["content_hash"]
+                        })
+                    added = source_name if len(tables) == 1 else f"{source_name}（{len(tables)}シート）"
+                    st.success(f"✅ {added}を追加しました！" + ("（取り込み済みのデータを再利用）" if ingested["cached"] else ""))
                     st.rerun()
                 except Exception as e:
                     st.error(f"読み込みエラー: {e}")
@@ -230,15 +370,13 @@ with st.sidebar:
                                 st.session_state.source_counter += 1
 
                                 # データソースを追加
-                                st.session_state.data_sources[source_name] = {
+                                add_data_source(source_name, {
                                     "type": "bigquery",
                                     "df": df,
                                     "connector": client,
                                     "dataset": selected_dataset,
                                     "table": selected_table
-                                }
-                                st.session_state.active_source = source_name
-                                st.session_state.messages[source_name] = []
+                                })
                                 st.session_state.temp_bq_client = None
                                 st.success(f"✅ {source_name}を追加しました！")
                                 st.rerun()
@@ -310,16 +448,14 @@ with st.sidebar:
                                         st.session_state.source_counter += 1
 
                                         # データソースを追加
-                                        st.session_state.data_sources[source_name] = {
+                                        add_data_source(source_name, {
                                             "type": "snowflake",
                                             "df": df,
                                             "connector": connector,
                                             "database": selected_db,
                                             "schema": selected_schema,
                                             "table": selected_table
-                                        }
-                                        st.session_state.active_source = source_name
-                                        st.session_state.messages[source_name] = []
+                                        })
                                         st.session_state.temp_sf_connector = None
                                         st.success(f"✅ {source_name}を追加しました！")
                                         st.rerun()
@@ -383,16 +519,14 @@ with st.sidebar:
                                         st.session_state.source_counter += 1
 
                                         # データソースを追加
-                                        st.session_state.data_sources[source_name] = {
+                                        add_data_source(source_name, {
                                             "type": "databricks",
                                             "df": df,
                                             "connector": connector,
                                             "catalog": selected_catalog,
                                             "schema": selected_schema,
                                             "table": selected_table
-                                        }
-                                        st.session_state.active_source = source_name
-                                        st.session_state.messages[source_name] = []
+                                        })
                                         st.session_state.temp_db_connector = None
                                         st.success(f"✅ {source_name}を追加しました！")
                                         st.rerun()
@@ -451,14 +585,12 @@ with st.sidebar:
                             st.session_state.source_counter += 1
 
                             # データソースを追加
-                            st.session_state.data_sources[source_name] = {
+                            add_data_source(source_name, {
                                 "type": "google_sheets",
                                 "df": df,
                                 "connector": connector,
                                 "sheet_name": selected_sheet
-                            }
-                            st.session_state.active_source = source_name
-                            st.session_state.messages[source_name] = []
+                            })
                             st.session_state.temp_gs_connector = None
                             st.success(f"✅ {source_name}を追加しました！")
                             st.rerun()
@@ -507,16 +639,14 @@ with st.sidebar:
                             tools = connector.list_tools()
 
                             # データソースを追加（DataFrameは不要、MCPツールを保持）
-                            st.session_state.data_sources[source_name] = {
+                            add_data_source(source_name, {
                                 "type": "mcp",
                                 "connector": connector,
                                 "server_url": server_url,
                                 "tools": tools,
                                 "connection_info": connection_info,
                                 "df": None  # MCPはDataFrameを持たない
-                            }
-                            st.session_state.active_source = source_name
-                            st.session_state.messages[source_name] = []
+                            })
 
                             st.success(f"✅ {source_name}に接続しました！")
                             st.info(f"利用可能なツール: {len(tools)}個")
@@ -545,16 +675,6 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
     # MCP Serversの場合の処理
     is_mcp = active_data.get('type') == 'mcp'
 
-    # MCPでない場合のみDataFrame処理を実行
-    if not is_mcp and df is not None:
-        # 日付カラムの自動変換
-        for col in df.columns:
-            if "date" in col.lower() or "time" in col.lower():
-                try:
-                    df[col] = pd.to_datetime(df[col])
-                except:
-                    pass
-
     # データソースの種類を判定
     connector = None
     duck_conn = None
@@ -573,7 +693,7 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
     # DuckDBが必要な場合は常に初期化
     if dialect == 'duckdb' and df is not None:
         duck_conn = duckdb.connect()
-        duck_conn.register("data", df)
+        register_dataframe(duck_conn, "data", df, active_data.get('dtype_report', {}).get('columns'))
 
     # カラム分割: 左にデータプレビュー、右にチャット
     col_left, col_right = st.columns([1, 2])
@@ -609,6 +729,17 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
     with col_right:
         st.subheader("💬 データ分析チャット")
 
+        # 複数のデータソースがある場合は横断クエリを選択可能
+        federated_mode = False
+        queryable_sources = [info for info in st.session_state.data_sources.values()
+                             if info.get('type') != 'mcp' and info.get('df') is not None]
+        if not is_mcp and len(queryable_sources) >= 2:
+            federated_mode = st.toggle(
+                "🔗 全データソースを横断して質問",
+                key="federated_mode",
+                help="接続中のデータソースをテーブルとして結合・比較するSQLを生成します（ウェアハウスのテーブルは必要なカラム・行だけを取得）"
+            )
+
         # 現在のデータソースのメッセージを初期化（必要に応じて）
         if st.session_state.active_source not in st.session_state.messages:
             st.session_state.messages[st.session_state.active_source] = []
@@ -622,73 +753,134 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
                     if "sql" in message:
                         with st.expander("生成されたSQL"):
                             st.code(message["sql"], language="sql")
+                    if message.get("pushdown"):
+                        truncated = [scan["relation"] for scan in message["pushdown"] if scan["truncated"]]
+                        if truncated:
+                            # 一部の行だけで計算した結果のため、集計値や結合結果が正しくない可能性がある
+                            limit = st.session_state.federation.max_remote_rows
+                            st.warning(f"{', '.join(truncated)} は取得上限（{limit:,}行）を超えたため、"
+                                       "先頭の行だけで計算しています。集計値や結合結果は実際と異なる可能性があります。"
+                                       "条件を追加して対象を絞り込んでください。")
+                        saved = sum(scan["bytes_saved"] for scan in message["pushdown"])
+                        with st.expander(f"リモート取得（プッシュダウンで約{format_bytes(saved)}削減）"):
+                            for scan in message["pushdown"]:
+                                status = "キャッシュ" if scan["cached"] else f"{format_bytes(scan['bytes_fetched'])}取得"
+                                mode = "クエリ全体をリモートで実行" if scan.get("mode") == "query" else "必要な列と行を取得"
+                                st.caption(f"{scan['relation']}: {mode} / {scan['rows']:,}行 / {status}"
+                                           + ("（取得上限に到達）" if scan["truncated"] else ""))
+                                st.code(scan["sql"], language="sql")
                     if "dataframe" in message:
-                        st.dataframe(message["dataframe"])
+                        render_result_grid(message["dataframe"], f"grid_{idx}")
                     if "figure" in message:
                         st.plotly_chart(message["figure"], width="stretch")
+                        if "chart_reason" in message:
+                            st.caption(f"グラフ: {message['chart_reason']}")
                     if "summary" in message:
                         with st.expander("分析要約", expanded=True):
                             st.markdown(message["summary"])
 
-                    # ダウンロードボタン
+                    # ダウンロードボタン（ファイルはクリック時にのみ生成）
                     if "dataframe" in message and "timestamp" in message:
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            # HTMLレポート生成
-                            html_report = f"""
-                            <html>
-                            <head>
-                                <title>FlashViz分析レポート - {message['timestamp'].strftime('%Y/%m/%d %H:%M')}</title>
-                                <style>
-                                    body {{ font-family: Arial, sans-serif; margin: 40px; }}
-                                    h1, h2 {{ color: #333; }}
-                                    .query {{ background-color: #f0f0f0; padding: 10px; border-radius: 5px; }}
-                                    .sql {{ background-color: #e8e8e8; padding: 10px; border-radius: 5px; font-family: monospace; white-space: pre-wrap; }}
-                                    .summary {{ background-color: #f9f9f9; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-                                    table {{ border-collapse: collapse; width: 100%; }}
-                                    th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-                                    th {{ background-color: #4CAF50; color: white; }}
-                                </style>
-                            </head>
-                            <body>
-                                <h1>FlashViz 分析レポート</h1>
-                                <p><strong>作成日時:</strong> {message['timestamp'].strftime('%Y年%m月%d日 %H:%M:%S')}</p>
-
-                                <h2>質問</h2>
-                                <div class="query">{message.get('question', '')}</div>
-
-                                <h2>実行したSQL</h2>
-                                <div class="sql">{message.get('sql', '')}</div>
-
-                                <h2>分析要約</h2>
-                                <div class="summary">{message.get('summary', '要約なし')}</div>
-
-                                <h2>グラフ</h2>
-                                {message.get('figure', '').to_html() if 'figure' in message else '<p>グラフなし</p>'}
-
-                                <h2>データ（上位20行）</h2>
-                                {message['dataframe'].head(20).to_html()}
-                            </body>
-                            </html>
-                            """
-
+                        stamp = message['timestamp'].strftime('%Y%m%d_%H%M%S')
+                        html_col, *export_cols = st.columns(1 + len(EXPORT_FORMATS))
+                        with html_col:
                             st.download_button(
                                 label="📄 HTMLレポート",
-                                data=html_report,
-                                file_name=f"vizzy_report_{message['timestamp'].strftime('%Y%m%d_%H%M%S')}.html",
+                                data=functools.partial(
+                                    build_html_report, message.get('question', ''), message.get('sql', ''),
+                                    message.get('summary', '要約なし'), message.get('figure'),
+                                    message['dataframe'], message['timestamp']
+                                ),
+                                file_name=f"vizzy_report_{stamp}.html",
                                 mime="text/html",
+                                on_click="ignore",
                                 key=f"html_{idx}"
                             )
+                        export_labels = {"csv": "📊 CSV (gzip)", "parquet": "🗜 Parquet", "arrow": "🏹 Arrow IPC"}
+                        for export_col, (export_format, spec) in zip(export_cols, EXPORT_FORMATS.items()):
+                            with export_col:
+                                st.download_button(
+                                    label=export_labels[export_format],
+                                    data=functools.partial(export_bytes, message['dataframe'], export_format),
+                                    file_name=f"vizzy_data_{stamp}.{spec['extension']}",
+                                    mime=spec["mime"],
+                                    on_click="ignore",
+                                    key=f"{export_format}_{idx}"
+                                )
 
-                        with col2:
-                            csv = message['dataframe'].to_csv(index=False)
-                            st.download_button(
-                                label="📊 CSVデータ",
-                                data=csv,
-                                file_name=f"vizzy_data_{message['timestamp'].strftime('%Y%m%d_%H%M%S')}.csv",
-                                mime="text/csv",
-                                key=f"csv_{idx}"
-                            )
+                # 処理段階ごとの所要時間
+                if message.get("trace") is not None and message["trace"].spans:
+                    message_trace = message["trace"]
+                    tokens = message_trace.total("prompt_tokens") + message_trace.total("completion_tokens")
+                    with st.expander(f"⏱ 処理時間（{message_trace.elapsed():.2f}秒 / トークン {tokens:,}）"):
+                        st.dataframe(message_trace.to_dataframe(), hide_index=True, width="stretch")
+
+        # 実行中のクエリジョブ
+        pending_job = st.session_state.query_jobs.get(st.session_state.active_source)
+        if pending_job:
+            job_manager = get_query_job_manager()
+            job = job_manager.get(pending_job["job_id"])
+            if job is None:
+                del st.session_state.query_jobs[st.session_state.active_source]
+            elif not job.is_finished:
+                render_query_job_status(job.id)
+            else:
+                job_manager.pop(job.id)
+                del st.session_state.query_jobs[st.session_state.active_source]
+                prompt = pending_job["prompt"]
+                sql_query = pending_job["sql"]
+
+                metrics.increment("flashviz_questions_total", status=job.status)
+                trace = pending_job.get("trace")
+                with activate(trace):
+                    if job.status == QueryJob.SUCCEEDED:
+                        result_df = job.result
+                        with st.chat_message("assistant"):
+                            # 分析要約の生成
+                            with st.spinner("分析結果を要約中..."):
+                                try:
+                                    client = get_llm_gateway().client_for(st.session_state.session_id)
+                                    analysis_summary = summarize_result(client, prompt, sql_query, result_df)
+                                except Exception as e:
+                                    st.warning(f"要約生成エラー: {e}")
+                                    analysis_summary = "要約を生成できませんでした。"
+
+                            # グラフ生成
+                            fig, chart_recommendation = build_result_chart(result_df, prompt)
+
+                        # アシスタントメッセージを履歴に追加（表示は再実行後の履歴描画で行う）
+                        assistant_message = {
+                            "role": "assistant",
+                            "content": f"分析結果を表示しました。（{job.rows_fetched:,}行 / {job.elapsed:.1f}秒）",
+                            "data": True,
+                            "sql": sql_query,
+                            "dataframe": result_df,
+                            "summary": analysis_summary,
+                            "question": prompt,
+                            "timestamp": pd.Timestamp.now()
+                        }
+                        if result_df.attrs.get("pushdown"):
+                            assistant_message["pushdown"] = result_df.attrs["pushdown"]
+                        if fig:
+                            assistant_message["figure"] = fig
+                            assistant_message["chart_reason"] = chart_recommendation["reason"]
+                    elif job.status == QueryJob.CANCELLED:
+                        assistant_message = {
+                            "role": "assistant",
+                            "content": f"クエリをキャンセルしました。（{job.elapsed:.1f}秒）",
+                            "sql": sql_query
+                        }
+                    else:
+                        assistant_message = {
+                            "role": "assistant",
+                            "content": f"SQLエラー: {job.error}",
+                            "sql": sql_query,
+                            "error": job.error
+                        }
+                if trace is not None:
+                    assistant_message["trace"] = trace
+                st.session_state.messages[st.session_state.active_source].append(assistant_message)
+                st.rerun()
 
         # チャット入力
         if prompt := st.chat_input("質問を入力してください（例: 月別の売上推移を見せて）"):
@@ -705,7 +897,11 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
                 st.error("OpenAI APIキーが設定されていません。.envファイルにOPENAI_API_KEYを設定してください。")
                 st.stop()
 
-            client = OpenAI(api_key=openai_api_key)
+            # プロセス全体で共有するクライアント（接続の再利用・レート制限・リトライ）
+            client = get_llm_gateway().client_for(st.session_state.session_id)
+
+            # 質問ごとのトレース（ジョブのワーカースレッドにも引き継がれる）
+            trace = Trace(prompt)
 
             # MCPの場合は別処理
             if is_mcp:
@@ -713,415 +909,190 @@ if st.session_state.active_source and st.session_state.active_source in st.sessi
                 tools = active_data.get('tools', [])
 
                 # OpenAI Tool形式に変換
-                openai_tools = []
-                for tool in tools:
-                    openai_tool = {
-                        "type": "function",
-                        "function": {
-                            "name": tool.get('name', 'unknown'),
-                            "description": tool.get('description', ''),
-                            "parameters": tool.get('inputSchema', {"type": "object", "properties": {}})
-                        }
-                    }
-                    openai_tools.append(openai_tool)
-
-                # LLMにツールを使って質問に答えさせる
-                with st.chat_message("assistant"):
-                    with st.spinner("処理中..."):
-                        # 会話履歴を使う（システムプロンプト + 履歴 + 新しい質問）
-                        messages = [
-                            {"role": "system", "content": f"あなたは{st.session_state.active_source}のMCPサーバーに接続されたアシスタントです。利用可能なツールを使ってユーザーの質問に答えてください。データベースのテーブル情報を取得したり、SQLクエリを実行したりできます。"}
-                        ]
-
-                        # 過去の会話履歴を追加（最新10件まで）
-                        for msg in st.session_state.messages[st.session_state.active_source][-10:]:
-                            messages.append({"role": msg["role"], "content": msg["content"]})
-
-                        # 新しい質問を追加
-                        messages.append({"role": "user", "content": prompt})
-
-                        response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=messages,
-                            tools=openai_tools if openai_tools else None,
-                            tool_choice="auto" if openai_tools else None
-                        )
-
-                        # ツール呼び出しがあるか確認
-                        if response.choices[0].message.tool_calls:
-                            tool_calls = response.choices[0].message.tool_calls
-                            st.info(f"🔧 {len(tool_calls)}個のツールを実行中...")
-
-                            # アシスタントのメッセージを追加（ツール呼び出し情報含む）
-                            assistant_msg = response.choices[0].message
-                            messages.append({
-                                "role": "assistant",
-                                "content": assistant_msg.content or "",
-                                "tool_calls": [
-                                    {
-                                        "id": tc.id,
-                                        "type": "function",
-                                        "function": {
-                                            "name": tc.function.name,
-                                            "arguments": tc.function.arguments
-                                        }
-                                    } for tc in assistant_msg.tool_calls
-                                ]
-                            })
-
-                            # ツール実行結果を格納
-                            for tool_call in tool_calls:
-                                tool_name = tool_call.function.name
-                                import json
-                                tool_args = json.loads(tool_call.function.arguments)
-
-                                with st.expander(f"実行中: {tool_name}"):
-                                    st.json(tool_args)
-
-                                # MCPツール実行
-                                try:
-                                    result = connector.call_tool(tool_name, tool_args)
-                                    messages.append({
-                                        "role": "tool",
-                                        "tool_call_id": tool_call.id,
-                                        "content": str(result)
-                                    })
-                                    st.success(f"✅ {tool_name} 実行完了")
-                                except Exception as e:
-                                    st.error(f"❌ {tool_name} 実行エラー: {e}")
-                                    messages.append({
-                                        "role": "tool",
-                                        "tool_call_id": tool_call.id,
-                                        "content": f"Error: {str(e)}"
-                                    })
-
-                            # ツール結果を含めて再度LLMに投げる
-                            final_response = client.chat.completions.create(
-                                model="gpt-4o",
-                                messages=messages
+                openai_tools = mcp_tools_to_openai(tools)
+
+                with activate(trace):
+                    # LLMにツールを使って質問に答えさせる
+                    with st.chat_message("assistant"):
+                        with st.spinner("処理中..."):
+                            # 会話履歴を使う（システムプロンプト + 履歴 + 新しい質問）
+                            messages = build_mcp_messages(
+                                st.session_state.active_source,
+                                st.session_state.messages[st.session_state.active_source],
+                                prompt
                             )
 
-                            assistant_message = final_response.choices[0].message.content
-                        else:
-                            assistant_message = response.choices[0].message.content
+                            with span("llm.mcp_tool_selection"):
+                                response = client.chat.completions.create(
+                                    model=MCP_MODEL,
+                                    messages=messages,
+                                    tools=openai_tools if openai_tools else None,
+                                    tool_choice="auto" if openai_tools else None
+                                )
+                                record_llm_usage(MCP_MODEL, response.usage)
+
+                            # ツール呼び出しがあるか確認
+                            if response.choices[0].message.tool_calls:
+                                tool_calls = response.choices[0].message.tool_calls
+                                st.info(f"🔧 {len(tool_calls)}個のツールを実行中...")
+
+                                # アシスタントのメッセージを追加（ツール呼び出し情報含む）
+                                assistant_msg = response.choices[0].message
+                                messages.append({
+                                    "role": "assistant",
+                                    "content": assistant_msg.content or "",
+                                    "tool_calls": [
+                                        {
+                                            "id": tc.id,
+                                            "type": "function",
+                                            "function": {
+                                                "name": tc.function.name,
+                                                "arguments": tc.function.arguments
+                                            }
+                                        } for tc in assistant_msg.tool_calls
+                                    ]
+                                })
+
+                                # ツール実行結果を格納
+                                for tool_call in tool_calls:
+                                    tool_name = tool_call.function.name
+                                    import json
+                                    tool_args = json.loads(tool_call.function.arguments)
+
+                                    with st.expander(f"実行中: {tool_name}"):
+                                        st.json(tool_args)
+
+                                    # MCPツール実行
+                                    try:
+                                        with span("mcp.tool_call", tool=tool_name):
+                                            result = connector.call_tool(tool_name, tool_args)
+                                        messages.append({
+                                            "role": "tool",
+                                            "tool_call_id": tool_call.id,
+                                            "content": str(result)
+                                        })
+                                        st.success(f"✅ {tool_name} 実行完了")
+                                    except Exception as e:
+                                        st.error(f"❌ {tool_name} 実行エラー: {e}")
+                                        messages.append({
+                                            "role": "tool",
+                                            "tool_call_id": tool_call.id,
+                                            "content": f"Error: {str(e)}"
+                                        })
+
+                                # ツール結果を含めて再度LLMに投げる
+                                with span("llm.mcp_answer"):
+                                    final_response = client.chat.completions.create(
+                                        model=MCP_MODEL,
+                                        messages=messages
+                                    )
+                                    record_llm_usage(MCP_MODEL, final_response.usage)
+
+                                assistant_message = final_response.choices[0].message.content
+                            else:
+                                assistant_message = response.choices[0].message.content
 
-                        st.markdown(assistant_message)
+                            st.markdown(assistant_message)
 
-                        # メッセージを履歴に追加
-                        st.session_state.messages[st.session_state.active_source].append({
-                            "role": "assistant",
-                            "content": assistant_message,
-                            "data": True
-                        })
+                            # メッセージを履歴に追加
+                            st.session_state.messages[st.session_state.active_source].append({
+                                "role": "assistant",
+                                "content": assistant_message,
+                                "data": True,
+                                "trace": trace
+                            })
+                            metrics.increment("flashviz_questions_total", status="mcp")
 
-                        st.rerun()
+                            st.rerun()
 
-            # スキーマ情報取得（非MCP用）
-            schema = {}
-            if df is not None:
-                for col in df.columns:
-                    dtype = str(df[col].dtype)
-                    schema[col] = dtype
-
-            # サンプルデータ
-            sample_data = df.head(3).to_string() if df is not None else ""
-
-            # SQL生成プロンプト（データベース別に最適化）
-            if dialect == 'snowflake':
-                # アクティブデータソースからテーブル情報を取得
-                if 'database' in active_data and 'schema' in active_data and 'table' in active_data:
-                    table_ref = f"{active_data['database']}.{active_data['schema']}.{active_data['table']}"
-                else:
-                    table_ref = "data"
-
-                sql_generation_prompt = f"""
-以下のテーブル情報を基に、ユーザーの質問に答えるSnowflake SQLクエリを生成してください。
-
-テーブル名: {table_ref}
-カラム情報: {schema}
-
-サンプルデータ:
-{sample_data}
-
-ユーザーの質問: {prompt}
-
-重要な指示:
-- Snowflakeの構文を使用すること
-- **カラム名が小文字の場合は必ずダブルクォートで囲むこと** (例: "name", "user_id")
-- 大文字のカラム名はダブルクォート不要 (例: NAME, USER_ID)
-- エイリアス（AS句）も小文字の場合はダブルクォートで囲むこと
-- 日付関数: DATE_TRUNC(), DATEADD(), DATEDIFF()など
-- 文字列関数: CONCAT(), SPLIT_PART(), REGEXP_SUBSTR()など
-- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
-- SQLクエリのみを返す（説明は不要）
-"""
-            elif dialect == 'bigquery':
-                # BigQueryの場合もテーブル情報を取得
-                if 'dataset' in active_data and 'table' in active_data:
-                    # BigQueryのconnectorからproject_idを取得
-                    if connector and hasattr(connector, 'connection'):
-                        project_id = connector.connection.project
-                        table_ref = f"`{project_id}.{active_data['dataset']}.{active_data['table']}`"
+            with activate(trace):
+                table_ref = build_table_ref(active_data, dialect, connector)
+
+                with span("prompt_build"):
+                    # カラム統計の要約（生データ行の代わりにプロンプトへ渡す）
+                    schema_summary = ""
+                    federation = None
+                    if federated_mode:
+                        federation = sync_federation()
+                        schema_summary = federation.build_catalog_prompt()
+                    elif df is not None:
+                        profile = get_source_profile(active_data, dialect, connector, table_ref)
+                        schema_summary = format_schema_summary(profile)
+
+                    # 過去の回答の結果（prev_1, prev_2, ...）は絞り込みの質問でDuckDBから参照できるようにする
+                    previous = {} if federated_mode else collect_previous_results(
+                        st.session_state.messages[st.session_state.active_source]
+                    )
+
+                    # SQL生成プロンプト（データベース別に最適化）
+                    if federated_mode:
+                        sql_generation_prompt = build_federated_sql_prompt(schema_summary, prompt)
                     else:
-                        table_ref = f"{active_data['dataset']}.{active_data['table']}"
-                else:
-                    table_ref = "data"
-
-                sql_generation_prompt = f"""
-以下のテーブル情報を基に、ユーザーの質問に答えるBigQuery SQLクエリを生成してください。
-
-テーブル名: {table_ref}
-カラム情報: {schema}
-
-サンプルデータ:
-{sample_data}
-
-ユーザーの質問: {prompt}
-
-重要な指示:
-- BigQueryの標準SQL構文を使用すること
-- 日付関数: DATE_TRUNC(), DATE_ADD(), DATE_DIFF()など
-- ARRAY、STRUCTなどの複雑な型も考慮
-- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
-- SQLクエリのみを返す（説明は不要）
-"""
-            elif dialect == 'databricks':
-                # アクティブデータソースからテーブル情報を取得
-                if 'catalog' in active_data and 'schema' in active_data and 'table' in active_data:
-                    table_ref = f"{active_data['catalog']}.{active_data['schema']}.{active_data['table']}"
-                else:
-                    table_ref = "data"
-
-                sql_generation_prompt = f"""
-以下のテーブル情報を基に、ユーザーの質問に答えるDatabricks SQLクエリを生成してください。
-
-テーブル名: {table_ref}
-カラム情報: {schema}
-
-サンプルデータ:
-{sample_data}
-
-ユーザーの質問: {prompt}
-
-重要な指示:
-- Databricksの構文を使用すること（Spark SQLベース）
-- 日付関数: date_trunc(), date_add(), datediff()など
-- カタログ.スキーマ.テーブル形式の完全修飾名を使用
-- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
-- SQLクエリのみを返す（説明は不要）
-"""
-            else:  # DuckDB (デフォルト)
-                sql_generation_prompt = f"""
-以下のテーブル情報を基に、ユーザーの質問に答えるDuckDB SQLクエリを生成してください。
-
-テーフル名: data
-カラム情報: {schema}
-
-サンプルデータ:
-{sample_data}
-
-ユーザーの質問: {prompt}
-
-重要な指示:
-- DuckDBの構文を使用すること
-- 日付型のカラムはCAST(column_name AS DATE)を使用
-- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
-- SQLクエリのみを返す（説明は不要）
-"""
-
-            try:
-                with st.chat_message("assistant"):
-                    with st.spinner("SQL生成中..."):
-                        response = client.chat.completions.create(
-                            model="gpt-5-nano",
-                            messages=[
-                                {"role": "system", "content": "あなたはSQL生成の専門家です。"},
-                                {"role": "user", "content": sql_generation_prompt}
-                            ]
+                        sql_generation_prompt = build_sql_prompt(
+                            dialect, table_ref, schema_summary, prompt, format_previous_results(previous)
                         )
 
-                    sql_query = response.choices[0].message.content.strip()
-                    sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
-
-                    with st.expander("生成されたSQL", expanded=False):
-                        st.code(sql_query, language="sql")
-
-                    # SQLバリデーション
-                    is_safe, error_message = is_safe_query(sql_query)
-                    if not is_safe:
-                        st.error(f"🚫 セキュリティエラー: {error_message}")
-                        st.warning("このアプリケーションはSELECT文のみ実行可能です。データの変更・削除を行うSQL操作は許可されていません。")
-                        st.session_state.messages[st.session_state.active_source].append({
-                            "role": "assistant",
-                            "content": f"申し訳ございません。生成されたSQLが安全性チェックに失敗しました。\n\nエラー: {error_message}\n\nこのアプリケーションはSELECT文のみ実行可能です。",
-                            "sql": sql_query,
-                            "error": error_message
-                        })
-                        st.stop()
-
-                    # クエリ実行
-                    try:
-                        with st.spinner("クエリ実行中..."):
-                            if dialect in ['snowflake', 'bigquery', 'databricks'] and connector and hasattr(connector, 'execute_query'):
-                                result_df = connector.execute_query(sql_query)
-                            elif duck_conn is not None:
-                                result_df = duck_conn.execute(sql_query).fetchdf()
-                            else:
-                                raise RuntimeError(f"データソース'{active_data['type']}'でのクエリ実行に失敗しました。DuckDB接続が初期化されていません。")
-
-                        st.dataframe(result_df)
-
-                        # 分析要約の生成
-                        with st.spinner("分析結果を要約中..."):
-                            summary_prompt = f"""
-以下の分析結果を要約してください：
-
-ユーザーの質問: {prompt}
-実行したSQL: {sql_query}
-
-結果データ（上位10行）:
-{result_df.head(10).to_string()}
-
-以下の形式で要約してください：
-1. 主な発見（2-3個の重要なポイント）
-2. データの傾向や特徴
-3. ビジネス上の示唆（あれば）
-
-簡潔で分かりやすい日本語で記述してください。
-"""
-                            try:
-                                summary_response = client.chat.completions.create(
-                                    model="gpt-5-nano",
-                                    messages=[
-                                        {"role": "system", "content": "あなたはデータ分析の専門家です。"},
-                                        {"role": "user", "content": summary_prompt}
-                                    ]
-                                )
-                                analysis_summary = summary_response.choices[0].message.content.strip()
-
-                                with st.expander("分析要約", expanded=True):
-                                    st.markdown(analysis_summary)
-                            except Exception as e:
-                                st.warning(f"要約生成エラー: {e}")
-                                analysis_summary = "要約を生成できませんでした。"
-
-                        # グラフ生成
-                        fig = None
-                        if len(result_df.columns) >= 2:
-                            query_lower = prompt.lower()
-                            colors = ['#4361ee', '#3f37c9', '#7209b7', '#b5179e', '#f72585',
-                                     '#4cc9f0', '#4895ef', '#480ca8', '#560bad', '#6a4c93']
-
-                            if any(word in prompt for word in ["円", "割合", "比率", "構成", "内訳"]) or "pie" in query_lower:
-                                fig = px.pie(result_df, names=result_df.columns[0], values=result_df.columns[1],
-                                           title=prompt, color_discrete_sequence=colors)
-                                fig.update_layout(plot_bgcolor='white', paper_bgcolor='white', font=dict(color='#333333'))
-                                st.plotly_chart(fig, width="stretch")
-
-                            elif any(word in prompt for word in ["時系列", "推移", "変化", "折れ線", "線グラフ", "線"]) or any(word in query_lower for word in ["trend", "line"]):
-                                fig = px.line(result_df, x=result_df.columns[0], y=result_df.columns[1],
-                                            title=prompt, color_discrete_sequence=['#4361ee'])
-                                fig.update_layout(plot_bgcolor='white', paper_bgcolor='white', font=dict(color='#333333'),
-                                                xaxis=dict(gridcolor='#e0e0e0'), yaxis=dict(gridcolor='#e0e0e0'))
-                                st.plotly_chart(fig, width="stretch")
-
-                            elif any(word in prompt for word in ["関係", "相関", "散布"]) or any(word in query_lower for word in ["scatter", "correlation"]):
-                                fig = px.scatter(result_df, x=result_df.columns[0], y=result_df.columns[1],
-                                               title=prompt, color_discrete_sequence=['#4361ee'])
-                                fig.update_layout(plot_bgcolor='white', paper_bgcolor='white', font=dict(color='#333333'),
-                                                xaxis=dict(gridcolor='#e0e0e0'), yaxis=dict(gridcolor='#e0e0e0'))
-                                st.plotly_chart(fig, width="stretch")
+                try:
+                    with st.chat_message("assistant"):
+                        with st.spinner("SQL生成中..."):
+                            # 横断クエリはDuckDB上で実行されるため事前検証はしない
+                            validate = None if federated_mode else make_preflight(
+                                active_data, dialect, table_ref, {name: info["df"] for name, info in previous.items()}
+                            )
+                            sql_query, preflight = generate_validated_sql(
+                                client, sql_generation_prompt, validate, candidates=1 if federated_mode else SQL_CANDIDATES
+                            )
 
+                        with st.expander("生成されたSQL", expanded=False):
+                            st.code(sql_query, language="sql")
+                        if preflight is not None and not preflight["ok"]:
+                            st.warning(f"SQLの事前検証でエラーが解消されませんでした（そのまま実行します）: {preflight['error']}")
+
+                        # SQLバリデーション
+                        with span("safety_check"):
+                            is_safe, error_message = is_safe_query(sql_query)
+                        if not is_safe:
+                            st.error(f"🚫 セキュリティエラー: {error_message}")
+                            st.warning("このアプリケーションはSELECT文のみ実行可能です。データの変更・削除を行うSQL操作は許可されていません。")
+                            st.session_state.messages[st.session_state.active_source].append({
+                                "role": "assistant",
+                                "content": f"申し訳ございません。生成されたSQLが安全性チェックに失敗しました。\n\nエラー: {error_message}\n\nこのアプリケーションはSELECT文のみ実行可能です。",
+                                "sql": sql_query,
+                                "error": error_message,
+                                "trace": trace
+                            })
+                            metrics.increment("flashviz_questions_total", status="rejected")
+                            st.stop()
+
+                        # クエリをバックグラウンドジョブとして投入（再実行をまたいで継続し、キャンセル可能）
+                        previous_job = st.session_state.query_jobs.get(st.session_state.active_source)
+                        if previous_job:
+                            get_query_job_manager().cancel(previous_job["job_id"])
+                        try:
+                            previous_refs = referenced_previous_results(sql_query, previous)
+                            if previous_refs:
+                                # 過去の結果だけで答えられる質問はウェアハウスに問い合わせずにDuckDBで実行
+                                with span("previous_results", relations=",".join(previous_refs)):
+                                    if duck_conn is None:
+                                        duck_conn = duckdb.connect()
+                                    register_previous_results(duck_conn, previous, previous_refs)
+                                job = submit_query_job(sql_query, prompt, "duckdb", None, duck_conn)
                             else:
-                                if len(result_df) > 0:
-                                    result_df_sorted = result_df.sort_values(by=result_df.columns[1], ascending=False)
-                                else:
-                                    result_df_sorted = result_df
-                                fig = px.bar(result_df_sorted, x=result_df_sorted.columns[0], y=result_df_sorted.columns[1],
-                                           title=prompt, color_discrete_sequence=['#4361ee'])
-                                fig.update_layout(plot_bgcolor='white', paper_bgcolor='white', font=dict(color='#333333'),
-                                                xaxis=dict(gridcolor='#e0e0e0'), yaxis=dict(gridcolor='#e0e0e0'))
-                                st.plotly_chart(fig, width="stretch")
-
-                        # アシスタントメッセージを履歴に追加
-                        assistant_message = {
-                            "role": "assistant",
-                            "content": f"分析結果を表示しました。",
-                            "data": True,
+                                job = submit_query_job(sql_query, prompt, dialect, connector, duck_conn, federation)
+                        except Exception as e:
+                            st.error(f"SQLエラー: {e}")
+                            st.stop()
+
+                        st.session_state.query_jobs[st.session_state.active_source] = {
+                            "job_id": job.id,
+                            "prompt": prompt,
                             "sql": sql_query,
-                            "dataframe": result_df,
-                            "summary": analysis_summary,
-                            "question": prompt,
-                            "timestamp": pd.Timestamp.now()
+                            "trace": trace
                         }
-                        if fig:
-                            assistant_message["figure"] = fig
-                        st.session_state.messages[st.session_state.active_source].append(assistant_message)
-
-                        # 新しく生成された結果のダウンロードボタン
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            # HTMLレポート生成
-                            html_report = f"""
-                            <html>
-                            <head>
-                                <title>Vizzy分析レポート - {assistant_message['timestamp'].strftime('%Y/%m/%d %H:%M')}</title>
-                                <style>
-                                    body {{ font-family: Arial, sans-serif; margin: 40px; }}
-                                    h1, h2 {{ color: #333; }}
-                                    .query {{ background-color: #f0f0f0; padding: 10px; border-radius: 5px; }}
-                                    .sql {{ background-color: #e8e8e8; padding: 10px; border-radius: 5px; font-family: monospace; white-space: pre-wrap; }}
-                                    .summary {{ background-color: #f9f9f9; padding: 15px; border-radius: 5px; margin: 20px 0; }}
-                                    table {{ border-collapse: collapse; width: 100%; }}
-                                    th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
-                                    th {{ background-color: #4CAF50; color: white; }}
-                                </style>
-                            </head>
-                            <body>
-                                <h1>FlashViz 分析レポート</h1>
-                                <p><strong>作成日時:</strong> {assistant_message['timestamp'].strftime('%Y年%m月%d日 %H:%M:%S')}</p>
-
-                                <h2>質問</h2>
-                                <div class="query">{prompt}</div>
-
-                                <h2>実行したSQL</h2>
-                                <div class="sql">{sql_query}</div>
-
-                                <h2>分析要約</h2>
-                                <div class="summary">{analysis_summary}</div>
-
-                                <h2>グラフ</h2>
-                                {fig.to_html() if fig else '<p>グラフなし</p>'}
-
-                                <h2>データ（上位20行）</h2>
-                                {result_df.head(20).to_html()}
-                            </body>
-                            </html>
-                            """
-
-                            st.download_button(
-                                label="📄 HTMLレポート",
-                                data=html_report,
-                                file_name=f"vizzy_report_{assistant_message['timestamp'].strftime('%Y%m%d_%H%M%S')}.html",
-                                mime="text/html",
-                                key="html_new"
-                            )
-
-                        with col2:
-                            csv = result_df.to_csv(index=False)
-                            st.download_button(
-                                label="📊 CSVデータ",
-                                data=csv,
-                                file_name=f"vizzy_data_{assistant_message['timestamp'].strftime('%Y%m%d_%H%M%S')}.csv",
-                                mime="text/csv",
-                                key="csv_new"
-                            )
-
-                    except Exception as e:
-                        st.error(f"SQLエラー: {e}")
+                        st.rerun()
 
-            except Exception as e:
-                st.error(f"AI生成エラー: {e}")
+                except Exception as e:
+                    st.error(f"AI生成エラー: {e}")
 
 else:
     # データ未ロード時の案内
@@ -1143,7 +1114,7 @@ else:
 2. **データプレビュー**: 左側でデータを確認
 3. **チャットで質問**: 右側のチャット欄に自然言語で入力
 4. **結果確認**: SQL、グラフ、分析要約が自動生成
-5. **レポート保存**: HTMLレポートやCSVをダウンロード
+5. **レポート保存**: HTMLレポートやCSV（gzip）・Parquet・Arrow IPCをダウンロード
 
 ### 対応データソース
 
@@ -0,0 +1,94 @@
+"""
+DuckDBで動くウェアハウスの代替コネクタ
+Snowflake/BigQuery/DatabricksのSQLをsqlglotでDuckDBに変換して実行し、本物のコネクタと同じくカーソルからバッチ取得する
+"""
+from typing import Dict, List, Any, Optional, Callable
+import time
+import numpy as np
+import pandas as pd
+import duckdb
+import sqlglot
+from src.infrastructure.connectors.base import BaseConnector, QueryHandle, bind_cancel
+
+
+# 代替ウェアハウスのカタログ・スキーマ・テーブル名
+CATALOG = "bench"
+SCHEMA = "public"
+TABLE = "sales"
+
+
+def generate_sales_data(rows: int, seed: int = 0) -> pd.DataFrame:
+    """ベンチマーク用の売上データを生成"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "order_date": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 365 * 24, rows), unit="h"),
+        "category": rng.choice([f"カテゴリ{c}" for c in "ABCDEFGH"], rows),
+        "region": rng.choice(["東京", "大阪", "名古屋", "福岡", "札幌"], rows),
+        "amount": rng.gamma(2.0, 5000.0, rows).round(0),
+        "quantity": rng.integers(1, 20, rows),
+    })
+
+
+class FakeWarehouseConnector(BaseConnector):
+    """指定したダイアレクトとして振る舞うDuckDBコネクタ"""
+
+    def __init__(self, dialect: str):
+        super().__init__()
+        self.dialect = dialect
+        self.latency = 0.0
+
+    def connect(self, credentials: Dict[str, Any]) -> None:
+        """代替ウェアハウスを作成
+
+        Args:
+            credentials: {
+                "rows": salesテーブルの行数,
+                "latency": クエリごとに加える遅延（秒、ネットワーク往復の代わり）
+            }
+        """
+        self.latency = credentials.get("latency", 0.0)
+        self.connection = duckdb.connect()
+        self.connection.execute(f"ATTACH ':memory:' AS {CATALOG}")
+        self.connection.execute(f"CREATE SCHEMA {CATALOG}.{SCHEMA}")
+        sales_df = generate_sales_data(credentials.get("rows", 100000))
+        self.connection.execute(f"CREATE TABLE {CATALOG}.{SCHEMA}.{TABLE} AS SELECT * FROM sales_df")
+        self.is_connected = True
+
+    def list_datasets(self) -> List[str]:
+        self._ensure_connected()
+        return [SCHEMA]
+
+    def list_tables(self, dataset: str) -> List[str]:
+        self._ensure_connected()
+        return [TABLE]
+
+    def get_sample_data(self, dataset: str, table: str, schema: str = None, limit: int = 1000) -> pd.DataFrame:
+        self._ensure_connected()
+        return self.connection.cursor().execute(
+            f"SELECT * FROM {CATALOG}.{SCHEMA}.{TABLE} LIMIT {int(limit)}"
+        ).fetchdf()
+
+    def get_table_schema(self, dataset: str, table: str, schema: str = None) -> Dict[str, str]:
+        self._ensure_connected()
+        rows = self.connection.cursor().execute(f"DESCRIBE {CATALOG}.{SCHEMA}.{TABLE}").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """ダイアレクトのSQLをDuckDBに変換して実行"""
+        self._ensure_connected()
+        duckdb_sql = sqlglot.transpile(query, read=self.dialect, write="duckdb")[0]
+        if self.latency:
+            time.sleep(self.latency)
+        cursor = self.connection.cursor()
+        try:
+            # カタログを省略した schema.table（BigQueryのdataset.table形式）でも参照できるようにする
+            cursor.execute(f"USE {CATALOG}")
+            with bind_cancel(handle, cursor.interrupt):
+                cursor.execute(duckdb_sql)
+                return self._fetch_dataframe(cursor, progress)
+        finally:
+            cursor.close()
+
+    def get_dialect(self) -> str:
+        return self.dialect
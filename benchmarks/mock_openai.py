@@ -0,0 +1,103 @@
+"""
+ベンチマーク用のOpenAI互換モックサーバー
+/v1/chat/completions だけを実装し、SQL生成・要約・MCPツール呼び出しに決まった応答を一定の遅延で返す
+"""
+from typing import Dict, List, Any
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import re
+import time
+import uuid
+
+
+# SQL生成プロンプトに対して返すクエリ（{table}はプロンプト中のテーブル名）
+SQL_TEMPLATE = "SELECT category, SUM(amount) AS total_amount, COUNT(*) AS orders FROM {table} GROUP BY category ORDER BY total_amount DESC"
+SUMMARY_TEXT = "1. 主な発見: カテゴリAの売上が最も大きい\n2. データの傾向: 上位3カテゴリで全体の半分以上\n3. ビジネス上の示唆: 上位カテゴリの在庫を優先"
+
+
+def _estimate_tokens(text: str) -> int:
+    """トークン数の概算（4文字で1トークン）"""
+    return max(1, len(text) // 4)
+
+
+def build_response(request: Dict[str, Any]) -> Dict[str, Any]:
+    """リクエストの内容に応じたChat Completions形式の応答を作る"""
+    messages: List[Dict[str, Any]] = request.get("messages", [])
+    last = (messages[-1].get("content") or "") if messages else ""
+    message: Dict[str, Any] = {"role": "assistant", "content": None}
+
+    if request.get("tools") and not any(m.get("role") == "tool" for m in messages):
+        # MCP: 最初の呼び出しではSQL実行ツールを呼ぶ
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:8]}",
+            "type": "function",
+            "function": {"name": "execute_sql", "arguments": json.dumps({"sql": SQL_TEMPLATE.format(table="sales")})}
+        }]
+        finish_reason = "tool_calls"
+    elif "SQLクエリを生成" in last:
+        tables = re.findall(r"テーブル名: (\S+)", last)
+        table = tables[0] if tables else "data"
+        message["content"] = "```sql\n" + SQL_TEMPLATE.format(table=table) + "\n```"
+        finish_reason = "stop"
+    else:
+        message["content"] = SUMMARY_TEXT
+        finish_reason = "stop"
+
+    prompt_tokens = sum(_estimate_tokens(str(m.get("content") or "")) for m in messages)
+    # nを指定した場合は同じ内容の候補をn個返す
+    n = request.get("n") or 1
+    completion_tokens = _estimate_tokens(message["content"] or json.dumps(message.get("tool_calls"))) * n
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [{"index": i, "message": message, "finish_reason": finish_reason} for i in range(n)],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def make_handler(latency: float):
+    """指定した遅延で応答するリクエストハンドラー"""
+
+    class MockOpenAIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_error(404)
+                return
+            time.sleep(latency)
+            body = json.dumps(build_response(request), ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockOpenAIHandler
+
+
+def serve(port: int, latency: float = 0.05) -> None:
+    """モックサーバーを起動（ブロックする）"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(latency))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI互換モックサーバー")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--latency", type=float, default=0.05, help="応答までの遅延（秒）")
+    args = parser.parse_args()
+    serve(args.port, args.latency)
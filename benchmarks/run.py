@@ -0,0 +1,303 @@
+"""
+text2sqlパイプラインのベンチマーク
+チャット処理（app.py）と同じ部品（共有LLMゲートウェイ・事前検証付きSQL生成）で
+プロンプト組み立て → SQL生成 → 安全性チェック → 実行 → 要約 → グラフ
+を段階ごとに計測し、p50/p95・スループット・ピークRSSを表示する。
+
+外部サービスは使わず、OpenAI互換モックサーバー・スタブMCPサーバー・DuckDBの代替ウェアハウスで動かす。
+
+使い方:
+    python -m benchmarks.run --sources local snowflake bigquery databricks mcp \\
+        --rows 10000 100000 --history 0 20 --questions 20 --concurrency 4
+"""
+from typing import Dict, List, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+import duckdb
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.application.profiler import format_schema_summary, get_source_profile
+from src.application.type_inference import infer_column_types
+from src.application.dtype_optimizer import optimize_dtypes, register_dataframe
+from src.application.charting import build_chart
+from src.application.chart_recommender import recommend_chart, prepare_chart_data
+from src.application.engine import generate_validated_sql, make_preflight, summarize_result, SQL_CANDIDATES
+from src.application.llm_gateway import get_llm_gateway
+from src.application.sql_generation import (
+    is_safe_query, build_table_ref, build_sql_prompt, mcp_tools_to_openai, build_mcp_messages, MCP_MODEL
+)
+from src.infrastructure.tracing import Trace, activate
+from src.infrastructure.connectors.mcp import MCPConnectorSync
+from benchmarks import mock_openai, stub_mcp
+from benchmarks.fake_warehouse import FakeWarehouseConnector, generate_sales_data, CATALOG, SCHEMA, TABLE
+
+
+SQL_STAGES = ["prompt_build", "sql_generation", "safety_check", "execution", "summary", "chart"]
+MCP_STAGES = ["prompt_build", "tool_selection", "tool_execution", "final_answer"]
+WAREHOUSE_SOURCES = ["snowflake", "bigquery", "databricks"]
+QUESTION = "カテゴリ別の売上合計を見せて"
+# LLMゲートウェイの公平キューでの所有者（アプリのセッションIDに相当）
+LLM_OWNER = "benchmark"
+
+
+def _free_port() -> int:
+    """空いているローカルポートを取得"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(target, port: int, *args) -> multiprocessing.Process:
+    """サーバーを別プロセスで起動し、ポートが開くまで待つ（RSSを計測対象から分離）"""
+    process = multiprocessing.Process(target=target, args=(port, *args), daemon=True)
+    process.start()
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"サーバーが起動しませんでした（port={port}）")
+
+
+def prepare_source(kind: str, rows: int, warehouse_latency: float, mcp_url: Optional[str]) -> Dict[str, Any]:
+    """app.pyのデータソース追加と同じ手順でデータソース情報を作る"""
+    if kind == "mcp":
+        connector = MCPConnectorSync()
+        connector.connect(mcp_url, server_name="bench")
+        return {"type": "mcp", "df": None, "connector": connector, "tools": connector.list_tools()}
+
+    if kind == "local":
+        source = {"type": "local", "df": generate_sales_data(rows), "connector": None}
+    else:
+        connector = FakeWarehouseConnector(kind)
+        connector.connect({"rows": rows, "latency": warehouse_latency})
+        source = {"type": kind, "connector": connector, "df": connector.get_sample_data(SCHEMA, TABLE)}
+        if kind == "snowflake":
+            source.update(database=CATALOG, schema=SCHEMA, table=TABLE)
+        elif kind == "bigquery":
+            source.update(dataset=SCHEMA, table=TABLE)
+        else:
+            source.update(catalog=CATALOG, schema=SCHEMA, table=TABLE)
+
+    # 取り込み時の型推論・dtype最適化（add_data_sourceと同じ）
+    source["df"], source["schema_metadata"] = infer_column_types(source["df"])
+    source["df"], source["dtype_report"] = optimize_dtypes(source["df"])
+    return source
+
+
+def make_history(length: int) -> List[Dict[str, Any]]:
+    """チャット履歴（ユーザーとアシスタントの交互）"""
+    history = []
+    for i in range(length):
+        if i % 2 == 0:
+            history.append({"role": "user", "content": f"{i // 2 + 1}番目の質問: 地域別の売上を教えて"})
+        else:
+            history.append({"role": "assistant", "content": "分析結果を表示しました。" + "地域別の売上は東京が最大です。" * 5})
+    return history
+
+
+def run_sql_question(source: Dict[str, Any], question: str) -> Dict[str, Any]:
+    """SQLを生成して実行する質問を1件処理し、段階ごとの所要時間を返す"""
+    timings = {}
+    connector = source["connector"]
+    dialect = connector.get_dialect() if connector else "duckdb"
+
+    # LLMのトークン数はトレースに記録された使用量から集計する
+    trace = Trace(question)
+    with activate(trace):
+        start = time.perf_counter()
+        table_ref = build_table_ref(source, dialect, connector)
+        profile = get_source_profile(source, dialect, connector, table_ref)
+        prompt = build_sql_prompt(dialect, table_ref, format_schema_summary(profile), question)
+        timings["prompt_build"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # アプリと同じく共有ゲートウェイ経由で生成し、サンプルで事前検証する（接続先はOPENAI_BASE_URLのモック）
+        client = get_llm_gateway().client_for(LLM_OWNER)
+        validate = make_preflight(source, dialect, table_ref)
+        sql_query, _ = generate_validated_sql(client, prompt, validate, candidates=SQL_CANDIDATES)
+        timings["sql_generation"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        is_safe, error_message = is_safe_query(sql_query)
+        timings["safety_check"] = time.perf_counter() - start
+        if not is_safe:
+            raise RuntimeError(error_message)
+
+        start = time.perf_counter()
+        if connector is not None:
+            result_df = connector.execute_query(sql_query)
+        else:
+            # ローカルファイルはアプリと同じく接続を作ってから登録・実行
+            duck_conn = duckdb.connect()
+            register_dataframe(duck_conn, "data", source["df"], source["dtype_report"]["columns"])
+            result_df = duck_conn.execute(sql_query).fetchdf()
+            duck_conn.close()
+        timings["execution"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        summarize_result(client, question, sql_query, result_df)
+        timings["summary"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        recommendation = recommend_chart(result_df)
+        if recommendation:
+            chart_df = prepare_chart_data(result_df, recommendation)
+            build_chart(recommendation["type"], chart_df, recommendation["x"], recommendation["y"], question)
+        timings["chart"] = time.perf_counter() - start
+
+    tokens = trace.total("prompt_tokens") + trace.total("completion_tokens")
+    return {"timings": timings, "tokens": tokens, "rows": len(result_df)}
+
+
+def run_mcp_question(source: Dict[str, Any], history: List[Dict[str, Any]], question: str) -> Dict[str, Any]:
+    """MCPツール経由の質問を1件処理し、段階ごとの所要時間を返す"""
+    timings = {}
+    tokens = 0
+    connector = source["connector"]
+
+    start = time.perf_counter()
+    openai_tools = mcp_tools_to_openai(source["tools"])
+    messages = build_mcp_messages("bench", history + [{"role": "user", "content": question}], question)
+    timings["prompt_build"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client = get_llm_gateway().client_for(LLM_OWNER)
+    response = client.chat.completions.create(
+        model=MCP_MODEL, messages=messages, tools=openai_tools, tool_choice="auto"
+    )
+    # 他の質問と共有した応答（usageなし）は送信していないため数えない
+    tokens += response.usage.total_tokens if response.usage else 0
+    timings["tool_selection"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assistant_msg = response.choices[0].message
+    messages.append({
+        "role": "assistant",
+        "content": assistant_msg.content or "",
+        "tool_calls": [
+            {"id": tc.id, "type": "function", "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+            for tc in assistant_msg.tool_calls or []
+        ]
+    })
+    for tool_call in assistant_msg.tool_calls or []:
+        result = connector.call_tool(tool_call.function.name, json.loads(tool_call.function.arguments))
+        messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": str(result)})
+    timings["tool_execution"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    final_response = client.chat.completions.create(model=MCP_MODEL, messages=messages)
+    tokens += final_response.usage.total_tokens if final_response.usage else 0
+    timings["final_answer"] = time.perf_counter() - start
+
+    return {"timings": timings, "tokens": tokens, "rows": 0}
+
+
+def run_scenario(source: Dict[str, Any], history_length: int, questions: int, concurrency: int) -> Dict[str, Any]:
+    """同じ質問をquestions件、concurrency並列で処理して統計を取る"""
+    history = make_history(history_length)
+    is_mcp = source["type"] == "mcp"
+    stages = MCP_STAGES if is_mcp else SQL_STAGES
+
+    def run_one(_):
+        start = time.perf_counter()
+        if is_mcp:
+            result = run_mcp_question(source, history, QUESTION)
+        else:
+            result = run_sql_question(source, QUESTION)
+        result["total"] = time.perf_counter() - start
+        return result
+
+    # 1件目はプロファイル計算・接続確立を含むため計測から除外（ウォームアップ）
+    run_one(None)
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(run_one, range(questions)))
+    wall = time.perf_counter() - wall_start
+
+    stats = {}
+    for stage in stages + ["total"]:
+        values = np.array([r["total"] if stage == "total" else r["timings"][stage] for r in results]) * 1000
+        stats[stage] = {"p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95))}
+    return {
+        "stages": stats,
+        "throughput_qps": questions / wall,
+        "tokens_per_question": float(np.mean([r["tokens"] for r in results])),
+        "result_rows": results[0]["rows"],
+        # ru_maxrssはLinuxではKB（プロセス開始からの最大値）
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_scenario(name: str, result: Dict[str, Any]) -> None:
+    """シナリオの結果を表形式で表示"""
+    print(f"\n== {name}")
+    print(f"{'stage':<16}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    for stage, values in result["stages"].items():
+        print(f"{stage:<16}{values['p50_ms']:>12.2f}{values['p95_ms']:>12.2f}")
+    print(f"throughput: {result['throughput_qps']:.2f} questions/s / tokens/question: {result['tokens_per_question']:.0f}"
+          f" / peak RSS: {result['peak_rss_mb']:.1f}MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="text2sqlパイプラインのベンチマーク")
+    parser.add_argument("--sources", nargs="+", default=["local", "snowflake", "mcp"],
+                        choices=["local", "mcp"] + WAREHOUSE_SOURCES)
+    parser.add_argument("--rows", nargs="+", type=int, default=[10000, 100000], help="データ行数（複数指定可）")
+    parser.add_argument("--history", nargs="+", type=int, default=[0, 20],
+                        help="チャット履歴の件数（複数指定可、MCPの会話に送られる）")
+    parser.add_argument("--questions", type=int, default=20, help="シナリオごとの質問数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に処理する質問数")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="モックLLMの応答遅延（秒）")
+    parser.add_argument("--warehouse-latency", type=float, default=0.02, help="代替ウェアハウスのクエリごとの遅延（秒）")
+    parser.add_argument("--output", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    openai_port = _free_port()
+    servers = [start_server(mock_openai.serve, openai_port, args.llm_latency)]
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_port}/v1"
+
+    results = []
+    try:
+        # RSSは単調増加のため行数の小さい順に実行
+        for rows in sorted(args.rows):
+            mcp_url = None
+            if "mcp" in args.sources:
+                mcp_port = _free_port()
+                servers.append(start_server(stub_mcp.serve, mcp_port, rows))
+                mcp_url = f"http://127.0.0.1:{mcp_port}/mcp"
+            for kind in args.sources:
+                source = prepare_source(kind, rows, args.warehouse_latency, mcp_url)
+                # 履歴の長さが影響するのはMCPの会話のみ
+                for history_length in (args.history if kind == "mcp" else args.history[:1]):
+                    name = f"{kind} rows={rows:,}" + (f" history={history_length}" if kind == "mcp" else "")
+                    result = run_scenario(source, history_length, args.questions, args.concurrency)
+                    print_scenario(name, result)
+                    results.append({"source": kind, "rows": rows, "history": history_length, **result})
+                if source["connector"] is not None:
+                    source["connector"].close()
+    finally:
+        for server in servers:
+            server.terminate()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
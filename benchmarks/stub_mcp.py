@@ -0,0 +1,99 @@
+"""
+ベンチマーク用のスタブMCPサーバー
+MCPConnectorが使うJSON-RPC（initialize, tools/list, tools/call）をHTTPで実装し、SQLはDuckDB上のsalesテーブルで実行する
+"""
+from typing import Dict, Any
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import json
+import threading
+import duckdb
+from benchmarks.fake_warehouse import generate_sales_data
+
+
+TOOLS = [
+    {
+        "name": "execute_sql",
+        "description": "salesテーブルに対してSELECT文を実行し、結果をCSVで返す",
+        "inputSchema": {
+            "type": "object",
+            "properties": {"sql": {"type": "string", "description": "実行するSQL"}},
+            "required": ["sql"],
+        },
+    },
+    {
+        "name": "list_tables",
+        "description": "テーブル一覧を返す",
+        "inputSchema": {"type": "object", "properties": {}},
+    },
+]
+
+
+def make_handler(conn: duckdb.DuckDBPyConnection):
+    """DuckDB接続を使ってツールを実行するリクエストハンドラー"""
+    lock = threading.Lock()
+
+    def call_tool(name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        if name == "list_tables":
+            text = "sales"
+        elif name == "execute_sql":
+            with lock:
+                text = conn.execute(arguments["sql"]).fetchdf().to_csv(index=False)
+        else:
+            raise ValueError(f"Unknown tool: {name}")
+        return {"content": [{"type": "text", "text": text}], "isError": False}
+
+    class StubMCPHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            method = request.get("method")
+            params = request.get("params", {})
+            try:
+                if method == "initialize":
+                    result = {
+                        "protocolVersion": "2024-11-05",
+                        "capabilities": {"tools": {}},
+                        "serverInfo": {"name": "flashviz-bench-stub", "version": "1.0.0"},
+                    }
+                elif method == "tools/list":
+                    result = {"tools": TOOLS}
+                elif method == "tools/call":
+                    result = call_tool(params.get("name"), params.get("arguments", {}))
+                else:
+                    raise ValueError(f"Unknown method: {method}")
+                response = {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+            except Exception as e:
+                response = {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32000, "message": str(e)}}
+
+            body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubMCPHandler
+
+
+def serve(port: int, rows: int = 100000) -> None:
+    """スタブMCPサーバーを起動（ブロックする）"""
+    conn = duckdb.connect()
+    sales_df = generate_sales_data(rows)
+    conn.execute("CREATE TABLE sales AS SELECT * FROM sales_df")
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(conn))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="スタブMCPサーバー")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--rows", type=int, default=100000, help="salesテーブルの行数")
+    args = parser.parse_args()
+    serve(args.port, args.rows)
@@ -0,0 +1,405 @@
+"""
+FlashVizのHTTP APIサーバー（ASGI）
+Streamlitを使わずに、質問（ask）・SQL実行（execute）・スキーマ取得（schema）をHTTPで提供する。
+データソースとコネクタはプロセス全体で共有し、ブロッキング処理は共有スレッドプールで実行するため、
+多数のクライアントを1つのasyncioイベントループで処理できる。
+
+結果の形式（リクエストの"format"で指定）:
+    json    : 結果全体を1つのJSONで返す（既定）
+    ndjson  : 1行目にメタ情報（sql, summaryなど）、2行目以降に1行1レコードをストリーミング
+    arrow   : Arrow IPCストリーム（メタ情報はスキーマのメタデータ"flashviz"にJSONで格納）
+    csv     : gzip圧縮したCSV（ファイルとしてダウンロード）
+    parquet : zstd圧縮したParquet（ファイルとしてダウンロード）
+
+使い方:
+    python server.py --port 8000 --sources sources.json
+    uvicorn server:app --port 8000
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from typing import Dict, List, Any, Optional, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import argparse
+import asyncio
+import functools
+import json
+import pandas as pd
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from src.application.engine import Text2SQLEngine
+from src.application.exporters import EXPORTERS, EXPORT_FORMATS, ARROW_STREAM_MEDIA_TYPE, iter_arrow
+from src.infrastructure.tracing import metrics
+from src.infrastructure.connectors.factory import ConnectorFactory
+
+# .envファイルから環境変数を読み込み
+load_dotenv()
+
+# ストリーミング時に1回で送る行数
+STREAM_BATCH_SIZE = 10000
+
+engine: Optional[Text2SQLEngine] = None
+executor: Optional[ThreadPoolExecutor] = None
+# {データソース名: データソース情報（app.pyのdata_sourcesと同じ形式）}
+sources: Dict[str, Dict[str, Any]] = {}
+_sources_lock = asyncio.Lock()
+
+
+def load_source(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """データソース定義からコネクタを作成して接続し、データソース情報を作る
+
+    Args:
+        spec: {
+            "type": "snowflake" / "bigquery" / "databricks" / "local_file" / "google_sheets",
+            "credentials": コネクタのconnectに渡す認証情報,
+            "database" / "catalog" / "dataset", "schema", "table", "sheet_name": 対象テーブル
+                （local_fileでディレクトリ・globを指定した場合はtableでファイル・パーティションセット、Excelはシートを選ぶ）,
+            "auto_reload": local_fileでファイルの変更を検知して読み直すか（既定True）
+        }
+    """
+    source_type = spec["type"].lower()
+    connector = ConnectorFactory.create_connector(source_type)
+    connector.connect(spec.get("credentials", {}))
+
+    if source_type == "local_file":
+        return local_source_info(connector, spec.get("table"))
+    if source_type == "snowflake":
+        df = connector.get_sample_data(spec["database"], spec["table"], spec["schema"])
+        return {"type": "snowflake", "df": df, "connector": connector,
+                "database": spec["database"], "schema": spec["schema"], "table": spec["table"]}
+    if source_type == "databricks":
+        df = connector.get_sample_data(spec["catalog"], spec["table"], schema=spec["schema"])
+        return {"type": "databricks", "df": df, "connector": connector,
+                "catalog": spec["catalog"], "schema": spec["schema"], "table": spec["table"]}
+    if source_type == "bigquery":
+        df = connector.get_sample_data(spec["dataset"], spec["table"])
+        return {"type": "bigquery", "df": df, "connector": connector, "dataset": spec["dataset"], "table": spec["table"]}
+    if source_type == "google_sheets":
+        df = connector.get_sample_data("", spec["sheet_name"])
+        return {"type": "google_sheets", "df": df, "connector": connector, "sheet_name": spec["sheet_name"]}
+    raise ValueError(f"Unknown connector type: {source_type}")
+
+
+def local_source_info(connector: Any, table: Optional[str] = None) -> Dict[str, Any]:
+    """ローカルファイルのコネクタからデータソース情報を作る（file_connectorとtableは変更の監視用）"""
+    if connector.df is not None:
+        # 1ファイルはアプリと同じく全行をDuckDBで扱う（Excelはtableでシートを選ぶ、省略時は最初のシート）
+        table = table or next(iter(connector.frames))
+        return {"type": "local", "df": connector.frames[table], "connector": None, "file_connector": connector,
+                "table": table, "file_name": os.path.basename(connector.file_path)}
+    # ディレクトリ・globはファイルを直接読む（パーティションの条件で読むファイルを絞る）
+    table = table or connector.list_tables("")[0]
+    df = connector.get_sample_data("", table)
+    return {"type": "local_file", "df": df, "connector": connector, "file_connector": connector, "table": table}
+
+
+def watch_source(name: str, info: Dict[str, Any], spec: Dict[str, Any]) -> None:
+    """ローカルファイルのデータソースのファイルを監視し、変更されたら読み直す
+
+    データソースのテーブルが変更された場合だけ、データ・カラム統計・事前検証用のサンプルを作り直す
+    （型推論・dtype最適化とカラム統計はエンジンへの再登録で再計算される）。
+    """
+    connector = info.get("file_connector")
+    if connector is None or not spec.get("auto_reload", True):
+        return
+    current = {"info": info}
+
+    def on_change(tables: List[str]) -> None:
+        # 登録を解除・置き換えたデータソースと、別のテーブルの変更は無視する
+        if sources.get(name) is not current["info"] or info["table"] not in tables:
+            return
+        try:
+            reloaded = local_source_info(connector, info["table"])
+            engine.add_source(name, reloaded)
+        except Exception as e:
+            print(f"データソース '{name}' の再読み込みに失敗しました: {e}", file=sys.stderr)
+            return
+        sources[name] = current["info"] = reloaded
+        metrics.increment("flashviz_source_reloads_total", type=info["type"])
+
+    connector.watch(on_change)
+
+
+def close_source(info: Dict[str, Any], keep: Optional[Dict[str, Any]] = None) -> None:
+    """データソースのコネクタを閉じる（ファイルの監視も終了、keepのデータソースと共有するコネクタは除く）"""
+    kept = [keep.get(key) for key in ("connector", "file_connector")] if keep else []
+    closed = []
+    for connector in (info.get("connector"), info.get("file_connector")):
+        if connector is not None and not any(connector is c for c in kept + closed):
+            connector.close()
+            closed.append(connector)
+
+
+async def run_blocking(func, *args, **kwargs) -> Any:
+    """ブロッキング処理を共有スレッドプールで実行"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def json_response(data: Any, status_code: int = 200) -> Response:
+    """日本語・日時・numpyの値をそのまま返せるJSONレスポンス"""
+    body = json.dumps(data, ensure_ascii=False, default=_json_default)
+    return Response(body, status_code=status_code, media_type="application/json")
+
+
+def _json_default(value: Any) -> Any:
+    """json.dumpsで扱えない値の変換"""
+    if hasattr(value, "item"):
+        # numpyのスカラー
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return str(value)
+
+
+def _records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """DataFrameをJSON用のレコードに変換（NaN/NaTはnull）"""
+    return json.loads(df.to_json(orient="records", date_format="iso", force_ascii=False))
+
+
+def _iter_ndjson(meta: Dict[str, Any], df: pd.DataFrame) -> Iterator[bytes]:
+    """1行目にメタ情報、以降にレコードを1行ずつ出力"""
+    yield (json.dumps(meta, ensure_ascii=False, default=_json_default) + "\n").encode("utf-8")
+    for start in range(0, len(df), STREAM_BATCH_SIZE):
+        chunk = df.iloc[start:start + STREAM_BATCH_SIZE]
+        lines = chunk.to_json(orient="records", lines=True, date_format="iso", force_ascii=False)
+        # pandasのバージョンによって末尾の改行の有無が異なる
+        yield (lines if lines.endswith("\n") else lines + "\n").encode("utf-8")
+
+
+def result_response(meta: Dict[str, Any], df: pd.DataFrame, result_format: str) -> Response:
+    """結果を指定の形式で返す"""
+    if result_format == "ndjson":
+        return StreamingResponse(_iter_ndjson(meta, df), media_type="application/x-ndjson")
+    if result_format == "arrow":
+        return StreamingResponse(iter_arrow(df, stream=True, metadata=meta), media_type=ARROW_STREAM_MEDIA_TYPE)
+    if result_format in ("csv", "parquet"):
+        spec = EXPORT_FORMATS[result_format]
+        return StreamingResponse(
+            EXPORTERS[result_format](df), media_type=spec["mime"],
+            headers={"Content-Disposition": f'attachment; filename="flashviz_result.{spec["extension"]}"'}
+        )
+    return json_response({**meta, "data": _records(df)})
+
+
+def _result_format(request: Request, body: Dict[str, Any]) -> str:
+    """結果の形式（ボディの"format"、なければAcceptヘッダーから判定）"""
+    result_format = body.get("format")
+    if not result_format:
+        accept = request.headers.get("accept", "")
+        if ARROW_STREAM_MEDIA_TYPE in accept:
+            result_format = "arrow"
+        elif "application/x-ndjson" in accept:
+            result_format = "ndjson"
+        else:
+            result_format = "json"
+    if result_format not in ("json", "ndjson", "arrow", "csv", "parquet"):
+        raise ValueError(f"Unsupported format: {result_format}")
+    return result_format
+
+
+async def _read_body(request: Request) -> Dict[str, Any]:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise ValueError("リクエストボディがJSONではありません")
+    if not isinstance(body, dict):
+        raise ValueError("リクエストボディはJSONオブジェクトで指定してください")
+    return body
+
+
+async def health(request: Request) -> Response:
+    return json_response({"status": "ok", "sources": len(sources)})
+
+
+async def list_sources(request: Request) -> Response:
+    """登録済みデータソースの一覧"""
+    return json_response([
+        {"name": name, "type": info.get("type"), "dialect": engine.sources[name]["dialect"],
+         "table": engine.sources[name]["table_ref"]}
+        for name, info in sources.items()
+    ])
+
+
+async def add_source(request: Request) -> Response:
+    """データソースを接続して登録（名前が重複する場合は置き換え）"""
+    try:
+        body = await _read_body(request)
+        name = body["name"]
+        info = await run_blocking(load_source, body)
+        await run_blocking(engine.add_source, name, info)
+    except (KeyError, ValueError) as e:
+        return json_response({"error": f"データソースの指定が不正です: {e}"}, 400)
+    except Exception as e:
+        return json_response({"error": f"接続エラー: {e}"}, 502)
+
+    async with _sources_lock:
+        previous = sources.pop(name, None)
+        sources[name] = info
+    watch_source(name, info, body)
+    if previous is not None:
+        await run_blocking(close_source, previous, info)
+    return json_response({"name": name, "type": info["type"], "rows": len(info["df"])}, 201)
+
+
+async def remove_source(request: Request) -> Response:
+    """データソースの登録を解除して接続を閉じる"""
+    name = request.path_params["name"]
+    async with _sources_lock:
+        info = sources.pop(name, None)
+        engine.remove_source(name)
+    if info is None:
+        return json_response({"error": f"データソース '{name}' が登録されていません"}, 404)
+    await run_blocking(close_source, info)
+    return Response(status_code=204)
+
+
+async def get_schema(request: Request) -> Response:
+    """データソースのカラム・型・統計（プロンプトに渡すスキーマ要約を含む）"""
+    name = request.path_params["name"]
+    if name not in sources:
+        return json_response({"error": f"データソース '{name}' が登録されていません"}, 404)
+    info = sources[name]
+    entry = engine.sources[name]
+    profile = info["profile"]
+    columns = [
+        {"name": col, **{key: value for key, value in stats.items() if key != "top_values"}}
+        for col, stats in profile["columns"].items()
+    ]
+    return json_response({
+        "name": name,
+        "type": info.get("type"),
+        "dialect": entry["dialect"],
+        "table": entry["table_ref"],
+        "row_count": profile["row_count"],
+        "columns": columns,
+        "summary": entry["schema_summary"],
+    })
+
+
+async def ask(request: Request) -> Response:
+    """質問からSQLを生成して実行し、結果を返す
+
+    ボディ: {"question": 質問文, "source": データソース名, "format": 形式, "summarize": 要約するか}
+    """
+    try:
+        body = await _read_body(request)
+        result_format = _result_format(request, body)
+        question = body["question"]
+    except (KeyError, ValueError) as e:
+        return json_response({"error": f"リクエストが不正です: {e}"}, 400)
+
+    result = await run_blocking(
+        engine.ask, question, body.get("source"), summarize=body.get("summarize", True), chart=False
+    )
+    meta = {
+        "question": result["question"],
+        "source": result["source"],
+        "status": result["status"],
+        "sql": result["sql"],
+        "error": result["error"],
+        "rows": result["rows"],
+        "summary": result["summary"],
+        "chart": result["chart"],
+        "elapsed": round(result["elapsed"], 3),
+        "tokens": result["tokens"],
+    }
+    if result["status"] == Text2SQLEngine.REJECTED:
+        return json_response(meta, 422)
+    if result["status"] != Text2SQLEngine.SUCCEEDED:
+        return json_response(meta, 404 if result["source"] not in sources else 500)
+    return result_response(meta, result["dataframe"], result_format)
+
+
+async def execute(request: Request) -> Response:
+    """SELECT文をデータソースで直接実行
+
+    ボディ: {"sql": SQL, "source": データソース名, "format": 形式}
+    """
+    try:
+        body = await _read_body(request)
+        result_format = _result_format(request, body)
+        sql = body["sql"]
+        source = body.get("source")
+        result_df = await run_blocking(engine.execute, sql, source)
+    except (KeyError, ValueError) as e:
+        return json_response({"error": str(e)}, 400)
+    except Exception as e:
+        return json_response({"error": f"SQLエラー: {e}"}, 500)
+    meta = {"source": source or next(iter(sources), None), "sql": sql, "rows": len(result_df)}
+    return result_response(meta, result_df, result_format)
+
+
+async def prometheus_metrics(request: Request) -> Response:
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def create_app(sources_file: Optional[str] = None, max_workers: int = 32, max_llm_concurrency: int = 8,
+               max_query_concurrency: int = 8) -> Starlette:
+    """ASGIアプリケーションを作成
+
+    Args:
+        sources_file: 起動時に登録するデータソース定義（POST /sourcesのボディのJSON配列）
+        max_workers: ブロッキング処理を実行する共有スレッドプールのサイズ
+        max_llm_concurrency: LLM呼び出しの同時実行数の上限
+        max_query_concurrency: クエリ実行の同時実行数の上限
+    """
+    global engine, executor
+    engine = Text2SQLEngine(max_workers=max_workers, max_llm_concurrency=max_llm_concurrency,
+                            max_query_concurrency=max_query_concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="flashviz-api")
+
+    if sources_file:
+        with open(sources_file, encoding="utf-8") as f:
+            for spec in json.load(f):
+                info = load_source(spec)
+                engine.add_source(spec["name"], info)
+                sources[spec["name"]] = info
+                watch_source(spec["name"], info, spec)
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        yield
+        for info in sources.values():
+            close_source(info)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return Starlette(
+        routes=[
+            Route("/health", health),
+            Route("/sources", list_sources, methods=["GET"]),
+            Route("/sources", add_source, methods=["POST"]),
+            Route("/sources/{name}", remove_source, methods=["DELETE"]),
+            Route("/sources/{name}/schema", get_schema),
+            Route("/ask", ask, methods=["POST"]),
+            Route("/execute", execute, methods=["POST"]),
+            Route("/metrics", prometheus_metrics),
+        ],
+        lifespan=lifespan,
+    )
+
+
+# uvicorn server:app で起動する場合（データソース定義は環境変数FLASHVIZ_SOURCESで指定）
+app = None if __name__ == "__main__" else create_app(os.getenv("FLASHVIZ_SOURCES"))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="FlashViz HTTP APIサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--sources", help="起動時に登録するデータソース定義（JSON）")
+    parser.add_argument("--workers", type=int, default=32, help="共有スレッドプールのサイズ")
+    parser.add_argument("--llm-concurrency", type=int, default=8)
+    parser.add_argument("--query-concurrency", type=int, default=8)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_app(args.sources, args.workers, args.llm_concurrency, args.query_concurrency),
+        host=args.host, port=args.port
+    )
@@ -0,0 +1,132 @@
+"""
+ルールベースのグラフ推薦
+結果カラムの型・カーディナリティ・行数からグラフ種類と軸・集計方法を決める（LLM呼び出しなし）
+"""
+from typing import Dict, List, Any, Optional
+import pandas as pd
+import pyarrow as pa
+from src.application.type_inference import column_kind
+
+
+# 円グラフにする最大カテゴリ数
+MAX_PIE_CATEGORIES = 6
+# 棒グラフにそのまま並べる最大カテゴリ数（超えたら上位のみ）
+MAX_BAR_CATEGORIES = 30
+# カーディナリティ推定に使う最大行数
+CARDINALITY_SAMPLE_ROWS = 10000
+# これを超える結果は集計・描画コストが高すぎるためグラフを作らない
+MAX_CHART_ROWS = 5_000_000
+
+
+def _column_role(series: pd.Series) -> str:
+    """カラムの役割を判定（"temporal", "numeric", "categorical"）
+
+    dtypeのメタデータだけで判定し、object型のみ先頭のサンプルからArrow型を推定する。
+    """
+    kind = column_kind(series)
+    if kind == "TIMESTAMP":
+        return "temporal"
+    if kind in ("INTEGER", "FLOAT"):
+        return "numeric"
+    if kind == "BOOLEAN" or isinstance(series.dtype, pd.CategoricalDtype):
+        return "categorical"
+    if series.dtype == object:
+        sample = series.dropna().head(100)
+        try:
+            arrow_type = pa.infer_type(sample.tolist())
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return "categorical"
+        if pa.types.is_temporal(arrow_type):
+            return "temporal"
+        if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+            return "numeric"
+    return "categorical"
+
+
+def _estimate_cardinality(series: pd.Series) -> int:
+    """ユニーク数の推定（カテゴリ型はカテゴリ数、それ以外は先頭サンプルで計算）"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return len(series.cat.categories)
+    sample = series.head(CARDINALITY_SAMPLE_ROWS)
+    try:
+        distinct = sample.nunique(dropna=True)
+    except TypeError:
+        return len(series)
+    # サンプルが全てユニークなら全体もほぼユニークとみなす
+    if distinct == len(sample):
+        return len(series)
+    return distinct
+
+
+def recommend_chart(df: pd.DataFrame) -> Optional[Dict[str, Any]]:
+    """結果データに適したグラフを推薦
+
+    Args:
+        df: クエリ結果
+
+    Returns:
+        {"type": "line"|"bar"|"pie"|"scatter", "x": カラム名, "y": カラム名,
+         "aggregation": None|"sum", "top_n": Optional[int], "reason": 説明}
+        グラフに向かない、または描画コストが高すぎる場合はNone
+    """
+    if len(df) == 0 or len(df.columns) < 2 or len(df) > MAX_CHART_ROWS:
+        return None
+
+    roles = {col: _column_role(df[col]) for col in df.columns}
+    temporal = [col for col, role in roles.items() if role == "temporal"]
+    numeric = [col for col, role in roles.items() if role == "numeric"]
+    categorical = [col for col, role in roles.items() if role == "categorical"]
+    row_count = len(df)
+
+    # 時間軸 + 数値 → 折れ線（同じ時刻が複数行あれば合計）
+    if temporal and numeric:
+        x, y = temporal[0], numeric[0]
+        aggregation = "sum" if _estimate_cardinality(df[x]) < row_count else None
+        return {"type": "line", "x": x, "y": y, "aggregation": aggregation, "top_n": None,
+                "reason": f"{x}が日時型のため時系列で表示"}
+
+    # カテゴリ + 数値 → 少数なら円グラフ、それ以外は棒グラフ（多すぎる場合は上位のみ）
+    if categorical and numeric:
+        x, y = categorical[0], numeric[0]
+        cardinality = _estimate_cardinality(df[x])
+        aggregation = "sum" if cardinality < row_count else None
+        values = pd.to_numeric(df[y], errors="coerce")
+        if cardinality <= MAX_PIE_CATEGORIES and (values.dropna() >= 0).all() and values.sum() > 0:
+            return {"type": "pie", "x": x, "y": y, "aggregation": aggregation, "top_n": None,
+                    "reason": f"{x}のカテゴリが{cardinality}個のため構成比で表示"}
+        top_n = MAX_BAR_CATEGORIES if cardinality > MAX_BAR_CATEGORIES else None
+        return {"type": "bar", "x": x, "y": y, "aggregation": aggregation, "top_n": top_n,
+                "reason": f"{x}のカテゴリ別に比較" + (f"（上位{top_n}件）" if top_n else "")}
+
+    # 数値 + 数値 → 散布図（x が単調増加でユニークなら折れ線）
+    if len(numeric) >= 2:
+        x, y = numeric[0], numeric[1]
+        if df[x].is_monotonic_increasing and _estimate_cardinality(df[x]) == row_count:
+            return {"type": "line", "x": x, "y": y, "aggregation": None, "top_n": None,
+                    "reason": f"{x}が単調増加のため折れ線で表示"}
+        return {"type": "scatter", "x": x, "y": y, "aggregation": None, "top_n": None,
+                "reason": f"{x}と{y}の関係を散布図で表示"}
+
+    return None
+
+
+def prepare_chart_data(df: pd.DataFrame, recommendation: Dict[str, Any]) -> pd.DataFrame:
+    """推薦内容に従って集計・並べ替え・上位抽出したデータを返す"""
+    x, y = recommendation["x"], recommendation["y"]
+    chart_df = df[[x, y]]
+    if chart_df[y].dtype == object:
+        # Decimalなどobject型の数値
+        chart_df = chart_df.assign(**{y: pd.to_numeric(chart_df[y], errors="coerce")})
+
+    if recommendation.get("aggregation") == "sum":
+        chart_df = chart_df.groupby(x, as_index=False, observed=True, sort=False)[y].sum()
+
+    if recommendation["type"] == "line":
+        chart_df = chart_df.sort_values(by=x)
+    elif recommendation["type"] in ("bar", "pie"):
+        top_n = recommendation.get("top_n")
+        if top_n:
+            chart_df = chart_df.nlargest(top_n, y)
+        else:
+            chart_df = chart_df.sort_values(by=y, ascending=False)
+    return chart_df
@@ -0,0 +1,186 @@
+"""
+グラフ描画レイヤー
+大きな結果をサーバー側で間引き・集約してからPlotlyに渡す
+"""
+from typing import Dict, List, Any, Optional
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+
+# 折れ線の最大描画点数（LTTBで間引く）
+MAX_LINE_POINTS = 2000
+# 散布図をビン集約に切り替える点数
+MAX_SCATTER_POINTS = 10000
+# 散布図のビン数（各軸）
+SCATTER_BINS = 100
+# この点数を超えたらWebGLトレース（scattergl）を使う
+WEBGL_THRESHOLD = 1000
+# HTMLレポートに埋め込むトレースあたりの最大点数
+MAX_REPORT_POINTS = 2000
+
+CHART_COLORS = ['#4361ee', '#3f37c9', '#7209b7', '#b5179e', '#f72585',
+                '#4cc9f0', '#4895ef', '#480ca8', '#560bad', '#6a4c93']
+
+
+def _to_numeric_axis(values: pd.Series) -> Optional[np.ndarray]:
+    """数値・日時の軸をfloat配列に変換（変換できない軸はNone）"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        if getattr(values.dt, "tz", None) is not None:
+            values = values.dt.tz_convert(None)
+        # NaTはNaNとして扱う
+        nanoseconds = values.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(np.float64)
+        nanoseconds[values.isna().to_numpy()] = np.nan
+        return nanoseconds
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    return None
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets法で残す点のインデックスを返す
+
+    Args:
+        x: x座標（昇順）
+        y: y座標
+        threshold: 残す点数
+
+    Returns:
+        残す点のインデックス配列
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    # 先頭と末尾を除いた点をthreshold-2個のバケットに分割
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # 次のバケットの平均点（最後のバケットは末尾の点）
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], y[-1]
+        ax, ay = x[selected], y[selected]
+        areas = np.abs((ax - avg_x) * (y[start:end] - ay) - (ax - x[start:end]) * (avg_y - ay))
+        selected = start + int(np.argmax(areas))
+        indices[i + 1] = selected
+    return indices
+
+
+def downsample_line(df: pd.DataFrame, x: str, y: str, max_points: int = MAX_LINE_POINTS) -> pd.DataFrame:
+    """折れ線用にLTTBで間引いたDataFrameを返す（数値でないx軸は等間隔で間引く）"""
+    if len(df) <= max_points:
+        return df
+    x_values = _to_numeric_axis(df[x])
+    y_values = _to_numeric_axis(df[y])
+    if x_values is None or y_values is None or np.isnan(x_values).any() or np.isnan(y_values).any():
+        step = int(np.ceil(len(df) / max_points))
+        return df.iloc[::step]
+    order = np.argsort(x_values, kind="stable")
+    keep = lttb_indices(x_values[order], y_values[order], max_points)
+    return df.iloc[order[keep]]
+
+
+def bin_scatter(df: pd.DataFrame, x: str, y: str, bins: int = SCATTER_BINS) -> Optional[pd.DataFrame]:
+    """散布図用に2次元ビンで集約（各ビンの中心と件数）。数値軸でない場合はNone"""
+    x_values = _to_numeric_axis(df[x])
+    y_values = _to_numeric_axis(df[y])
+    if x_values is None or y_values is None:
+        return None
+    mask = ~(np.isnan(x_values) | np.isnan(y_values))
+    counts, x_edges, y_edges = np.histogram2d(x_values[mask], y_values[mask], bins=bins)
+    xi, yi = np.nonzero(counts)
+    binned = pd.DataFrame({
+        x: (x_edges[xi] + x_edges[xi + 1]) / 2,
+        y: (y_edges[yi] + y_edges[yi + 1]) / 2,
+        "件数": counts[xi, yi].astype(np.int64),
+    })
+    if pd.api.types.is_datetime64_any_dtype(df[x]):
+        binned[x] = pd.to_datetime(binned[x].astype(np.int64), unit="ns")
+    if pd.api.types.is_datetime64_any_dtype(df[y]):
+        binned[y] = pd.to_datetime(binned[y].astype(np.int64), unit="ns")
+    return binned
+
+
+def _apply_layout(fig: go.Figure, with_grid: bool = True) -> go.Figure:
+    """共通のレイアウトを適用"""
+    layout = dict(plot_bgcolor='white', paper_bgcolor='white', font=dict(color='#333333'))
+    if with_grid:
+        layout.update(xaxis=dict(gridcolor='#e0e0e0'), yaxis=dict(gridcolor='#e0e0e0'))
+    fig.update_layout(**layout)
+    return fig
+
+
+def build_chart(chart_type: str, df: pd.DataFrame, x: str, y: str, title: str) -> go.Figure:
+    """グラフを作成（大きな結果は間引き・集約し、閾値を超えたらWebGLで描画）
+
+    Args:
+        chart_type: "pie", "line", "scatter", "bar"
+        df: 結果データ
+        x: x軸（円グラフはラベル）のカラム名
+        y: y軸（円グラフは値）のカラム名
+        title: グラフタイトル
+
+    Returns:
+        PlotlyのFigure
+    """
+    if chart_type == "pie":
+        fig = px.pie(df, names=x, values=y, title=title, color_discrete_sequence=CHART_COLORS)
+        return _apply_layout(fig, with_grid=False)
+
+    if chart_type == "line":
+        plot_df = downsample_line(df, x, y)
+        render_mode = "webgl" if len(plot_df) > WEBGL_THRESHOLD else "auto"
+        fig = px.line(plot_df, x=x, y=y, title=title, color_discrete_sequence=['#4361ee'], render_mode=render_mode)
+        return _apply_layout(fig)
+
+    if chart_type == "scatter":
+        plot_df = df
+        binned = bin_scatter(df, x, y) if len(df) > MAX_SCATTER_POINTS else None
+        if binned is not None:
+            fig = px.scatter(binned, x=x, y=y, color="件数", size="件数", title=title,
+                             color_continuous_scale="Blues", render_mode="webgl")
+            return _apply_layout(fig)
+        if len(df) > MAX_SCATTER_POINTS:
+            # 数値でない軸は等間隔で間引く
+            plot_df = df.iloc[::int(np.ceil(len(df) / MAX_SCATTER_POINTS))]
+        render_mode = "webgl" if len(plot_df) > WEBGL_THRESHOLD else "auto"
+        fig = px.scatter(plot_df, x=x, y=y, title=title, color_discrete_sequence=['#4361ee'], render_mode=render_mode)
+        return _apply_layout(fig)
+
+    fig = px.bar(df, x=x, y=y, title=title, color_discrete_sequence=['#4361ee'])
+    return _apply_layout(fig)
+
+
+def figure_to_report_html(fig: Optional[go.Figure], max_points: int = MAX_REPORT_POINTS) -> str:
+    """HTMLレポート用にグラフを埋め込む（トレースの点数を上限で間引き、plotly.jsはCDN参照）"""
+    if fig is None:
+        return '<p>グラフなし</p>'
+    report_fig = go.Figure(fig)
+    for trace in report_fig.data:
+        x_values = getattr(trace, "x", None)
+        if x_values is None or len(x_values) <= max_points:
+            continue
+        n = len(x_values)
+        step = int(np.ceil(n / max_points))
+        # 点ごとの配列（y、ホバー情報、マーカーの色・サイズ）も同じ間隔で間引く
+        updates = {}
+        for prop in ("x", "y", "customdata", "text", "hovertext"):
+            values = getattr(trace, prop, None)
+            if values is not None and not isinstance(values, str) and len(values) == n:
+                updates[prop] = values[::step]
+        marker = getattr(trace, "marker", None)
+        for prop in ("color", "size"):
+            values = getattr(marker, prop, None) if marker is not None else None
+            if values is not None and not isinstance(values, (str, int, float)) and len(values) == n:
+                updates[f"marker.{prop}"] = values[::step]
+        trace.update(updates)
+    return report_fig.to_html(full_html=False, include_plotlyjs="cdn")
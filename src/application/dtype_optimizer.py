@@ -0,0 +1,132 @@
+"""
+取り込み時のdtype最適化
+数値のダウンキャスト・低カーディナリティ文字列のカテゴリ化でセッション内のメモリを削減する
+"""
+from typing import Dict, List, Any, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+
+# DuckDBビューで元の型に戻すためのキャスト先
+_DUCKDB_CAST_TYPES = {
+    "INTEGER": "BIGINT",
+    "FLOAT": "DOUBLE",
+    "STRING": "VARCHAR",
+}
+
+
+def _memory_bytes(df: pd.DataFrame) -> int:
+    """DataFrameの実メモリ使用量（文字列の中身を含む）"""
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def _is_string_column(series: pd.Series) -> bool:
+    """文字列カラムかどうか（object型は中身をサンプルで確認）"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return False
+    if pd.api.types.is_string_dtype(series.dtype) and series.dtype != object:
+        return True
+    if series.dtype == object:
+        sample = series.dropna().head(100)
+        return not sample.empty and all(isinstance(v, str) for v in sample)
+    return False
+
+
+def optimize_dtypes(df: pd.DataFrame, max_category_ratio: float = 0.5, min_rows_for_category: int = 50,
+                    use_arrow_strings: bool = False) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """値を変えずにdtypeを縮小したDataFrameとレポートを返す
+
+    - 整数は値域に収まる最小の整数型へダウンキャスト
+    - float64はfloat32で往復しても値が変わらない場合のみfloat32へ
+    - ユニーク率がmax_category_ratio以下の文字列はcategoryへ
+    - use_arrow_stringsがTrueなら残りの文字列をArrow文字列型へ
+
+    Args:
+        df: 取り込んだDataFrame
+        max_category_ratio: カテゴリ化するユニーク数/行数の上限
+        min_rows_for_category: カテゴリ化を検討する最小行数
+        use_arrow_strings: 文字列をstring[pyarrow]で保持するか
+
+    Returns:
+        (最適化後のDataFrame, {"memory_before", "memory_after", "columns": {カラム名: 元の型分類}})
+    """
+    memory_before = _memory_bytes(df)
+    converted = {}
+    original_kinds = {}
+
+    for col in df.columns:
+        series = df[col]
+        dtype = series.dtype
+        if pd.api.types.is_bool_dtype(dtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype):
+            downcast = pd.to_numeric(series, downcast="integer")
+            if downcast.dtype.itemsize < dtype.itemsize:
+                converted[col] = downcast
+                original_kinds[col] = "INTEGER"
+        elif pd.api.types.is_float_dtype(dtype) and dtype.itemsize > 4:
+            as_float32 = series.astype(np.float32)
+            if np.array_equal(as_float32.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64), equal_nan=True):
+                converted[col] = as_float32
+                original_kinds[col] = "FLOAT"
+        elif _is_string_column(series):
+            if len(series) >= min_rows_for_category and series.nunique(dropna=True) <= max_category_ratio * len(series):
+                converted[col] = series.astype("category")
+                original_kinds[col] = "STRING"
+            elif use_arrow_strings and dtype == object:
+                converted[col] = series.astype("string[pyarrow]")
+                original_kinds[col] = "STRING"
+
+    if converted:
+        df = df.copy(deep=False)
+        for col, values in converted.items():
+            df[col] = values
+
+    report = {
+        "memory_before": memory_before,
+        "memory_after": _memory_bytes(df) if converted else memory_before,
+        "columns": original_kinds,
+    }
+    return df, report
+
+
+def register_dataframe(conn: Any, name: str, df: pd.DataFrame, original_kinds: Optional[Dict[str, str]] = None) -> None:
+    """最適化済みDataFrameをDuckDBに登録
+
+    縮小したカラムは元の型（BIGINT/DOUBLE/VARCHAR）にキャストしたビューとして公開し、
+    int16同士の乗算オーバーフローなどでクエリ結果が変わらないようにする。
+
+    Args:
+        conn: DuckDB接続
+        name: 公開するリレーション名
+        df: 登録するDataFrame
+        original_kinds: optimize_dtypesのレポートの"columns"
+    """
+    if not original_kinds:
+        conn.register(name, df)
+        return
+
+    raw_name = f"__{name}_raw"
+    conn.register(raw_name, df)
+    select_items = []
+    for col in df.columns:
+        quoted = '"' + str(col).replace('"', '""') + '"'
+        kind = original_kinds.get(col)
+        if kind in _DUCKDB_CAST_TYPES:
+            select_items.append(f"CAST({quoted} AS {_DUCKDB_CAST_TYPES[kind]}) AS {quoted}")
+        else:
+            select_items.append(quoted)
+    quoted_name = '"' + name.replace('"', '""') + '"'
+    conn.execute(f"CREATE OR REPLACE TEMP VIEW {quoted_name} AS SELECT {', '.join(select_items)} FROM \"{raw_name}\"")
+
+
+def format_bytes(num_bytes: int) -> str:
+    """バイト数を読みやすい単位に整形"""
+    if num_bytes < 1024:
+        return f"{num_bytes}B"
+    size = num_bytes / 1024
+    for unit in ("KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
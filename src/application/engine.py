@@ -0,0 +1,355 @@
+"""
+ヘッドレスのtext2sqlエンジン
+Streamlitに依存せずに 質問 → SQL生成 → 安全性チェック → 実行 → 要約 → グラフ を実行し、
+質問のバッチをLLM・クエリ実行それぞれの同時実行数の上限内で並列に処理する
+"""
+from typing import Dict, List, Any, Optional, Tuple, Union, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import functools
+import os
+import threading
+import duckdb
+import pandas as pd
+import plotly.graph_objects as go
+from src.application.profiler import format_schema_summary, get_source_profile, REMOTE_DIALECTS
+from src.application.type_inference import infer_column_types
+from src.application.dtype_optimizer import optimize_dtypes, register_dataframe
+from src.application.charting import build_chart
+from src.application.chart_recommender import recommend_chart, prepare_chart_data
+from src.application.llm_gateway import get_llm_gateway
+from src.application.preflight import preflight_sql
+from src.infrastructure.tracing import Trace, activate, span, set_attributes, record_llm_usage, record_fetch, metrics
+from src.application.sql_generation import (
+    is_safe_query, build_table_ref, build_sql_prompt, build_sql_repair_prompt, extract_sql, build_summary_prompt,
+    SQL_SYSTEM_PROMPT, SUMMARY_SYSTEM_PROMPT, SQL_MODEL
+)
+
+# 事前検証に失敗したときにSQLを再生成する回数の上限
+PREFLIGHT_MAX_RETRIES = 2
+# 1回のSQL生成で作る候補の数（2以上で候補を並列に検証して選ぶ）
+SQL_CANDIDATES = int(os.getenv("FLASHVIZ_SQL_CANDIDATES", "1"))
+
+
+def generate_sql(client: Any, prompt: str) -> str:
+    """SQL生成プロンプトをLLMに投げ、応答からSQLを取り出す"""
+    return generate_validated_sql(client, prompt, None)[0]
+
+
+def make_preflight(source_info: Dict[str, Any], dialect: str, table_ref: str,
+                   relations: Optional[Dict[str, pd.DataFrame]] = None) -> Optional[Callable[[str], Dict[str, Any]]]:
+    """データソースのサンプルで生成SQLを事前検証する関数（サンプルがなければNone）
+
+    relationsには対象テーブルのほかに参照できるDuckDBのリレーション（過去の結果など）を渡す
+    """
+    if source_info.get('df') is None or source_info.get('type') == 'mcp':
+        return None
+    return functools.partial(
+        preflight_sql, dialect=dialect, table_ref=table_ref, sample_df=source_info['df'],
+        dtype_columns=source_info.get('dtype_report', {}).get('columns'), relations=relations
+    )
+
+
+def _run_preflight(validate: Callable[[str], Dict[str, Any]], sql: str, **attributes: Any) -> Dict[str, Any]:
+    """事前検証を1回実行してスパンとメトリクスに記録"""
+    with span("preflight", **attributes):
+        check = validate(sql)
+        set_attributes(ok=check["ok"], stage=check["stage"])
+    metrics.increment("flashviz_preflight_total", result="ok" if check["ok"] else check["stage"])
+    return check
+
+
+def _select_candidate(sqls: List[str], validate: Callable[[str], Dict[str, Any]]) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """SQLの候補を並列に事前検証し、サンプルで結果が返った最初の候補を選ぶ
+
+    結果が返る候補がなければ検証を通った最初の候補、それもなければ最初の候補（修正の対象）を返す。
+    """
+    unique = [sql for i, sql in enumerate(sqls) if sql not in sqls[:i] and is_safe_query(sql)[0]]
+    if not unique:
+        return sqls[0], None
+
+    with span("sql_candidates", candidates=len(unique)):
+        checks: Dict[int, Dict[str, Any]] = {}
+        pool = ThreadPoolExecutor(max_workers=len(unique), thread_name_prefix="sql-candidate")
+        try:
+            # スパンを同じトレースに記録するため、候補ごとにコンテキストを引き継ぐ
+            futures = {
+                pool.submit(contextvars.copy_context().run, _run_preflight, validate, sql, candidate=i): i
+                for i, sql in enumerate(unique)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                check = checks[index] = future.result()
+                if check["ok"] and check["sample_result"] is not None and not check["sample_result"].empty:
+                    set_attributes(chosen=index)
+                    return unique[index], check
+        finally:
+            # 選んだ時点で残りの候補は待たない
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        index = next((i for i in range(len(unique)) if checks[i]["ok"]), 0)
+        set_attributes(chosen=index)
+        return unique[index], checks[index]
+
+
+def generate_validated_sql(client: Any, prompt: str, validate: Optional[Callable[[str], Dict[str, Any]]],
+                           max_retries: int = PREFLIGHT_MAX_RETRIES,
+                           candidates: int = 1) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """SQLを生成し、事前検証で失敗したらエラーを伝えて再生成する（最大max_retries回）
+
+    candidatesが2以上なら1回のリクエストで複数の候補を生成し（n）、並列に事前検証して最初に使えるものを選ぶ。
+    SELECT文以外は修正を求めずにそのまま返し、呼び出し側の安全性チェックで拒否させる。
+    再生成しても検証を通らない場合は最後のSQLを返す（ウェアハウスでの実行可否はウェアハウスが判断する）。
+
+    Returns:
+        (SQL, 最後の事前検証の結果（検証しなかった場合はNone）)
+    """
+    messages = [
+        {"role": "system", "content": SQL_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+    request = {"model": SQL_MODEL, "messages": messages}
+    if candidates > 1:
+        request["n"] = candidates
+    with span("llm.sql_generation", candidates=candidates):
+        response = client.chat.completions.create(**request)
+        record_llm_usage(SQL_MODEL, response.usage)
+    sqls = [extract_sql(choice.message.content or "") for choice in response.choices]
+
+    check = None
+    if validate is not None and len(sqls) > 1:
+        sql, check = _select_candidate(sqls, validate)
+    else:
+        sql = sqls[0]
+
+    for attempt in range(max_retries + 1):
+        if validate is None or not is_safe_query(sql)[0]:
+            break
+        if check is None:
+            check = _run_preflight(validate, sql, attempt=attempt)
+        if check["ok"] or attempt >= max_retries:
+            break
+
+        messages = messages + [
+            {"role": "assistant", "content": sql},
+            {"role": "user", "content": build_sql_repair_prompt(check["error"])}
+        ]
+        with span("llm.sql_repair", attempt=attempt + 1):
+            response = client.chat.completions.create(model=SQL_MODEL, messages=messages)
+            record_llm_usage(SQL_MODEL, response.usage)
+        sql = extract_sql(response.choices[0].message.content or "")
+        check = None
+    return sql, check
+
+
+def summarize_result(client: Any, question: str, sql: str, result_df: pd.DataFrame) -> str:
+    """クエリ結果の要約をLLMで生成"""
+    with span("llm.summary"):
+        response = client.chat.completions.create(
+            model=SQL_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": build_summary_prompt(question, sql, result_df)}
+            ]
+        )
+        record_llm_usage(SQL_MODEL, response.usage)
+    return response.choices[0].message.content.strip()
+
+
+def build_result_chart(result_df: pd.DataFrame, title: str) -> Tuple[Optional[go.Figure], Optional[Dict[str, Any]]]:
+    """推奨グラフを作成（適したグラフがなければ (None, None)）"""
+    with span("chart.build"):
+        recommendation = recommend_chart(result_df)
+        if not recommendation:
+            return None, None
+        chart_df = prepare_chart_data(result_df, recommendation)
+        return build_chart(recommendation["type"], chart_df, recommendation["x"], recommendation["y"], title), recommendation
+
+
+class Text2SQLEngine:
+    """ヘッドレスのtext2sqlパイプライン
+
+    データソースはapp.pyと同じ形式の辞書（"type", "df", "connector", テーブル指定）で登録する。
+    質問はスレッドプールで並列に処理し、LLM呼び出しとクエリ実行はそれぞれセマフォで同時実行数を制限する。
+    """
+
+    SUCCEEDED = "succeeded"
+    REJECTED = "rejected"
+    FAILED = "failed"
+
+    def __init__(self, client: Any = None, max_workers: int = 8, max_llm_concurrency: int = 4,
+                 max_query_concurrency: int = 4, summarize: bool = True, chart: bool = True,
+                 sql_candidates: int = SQL_CANDIDATES):
+        """
+        Args:
+            client: OpenAIクライアント（省略時は共有のLLMゲートウェイ）
+            max_workers: バッチで同時に処理する質問数
+            max_llm_concurrency: LLM呼び出しの同時実行数の上限
+            max_query_concurrency: クエリ実行の同時実行数の上限
+            summarize: 結果の要約を生成するか
+            chart: 推奨グラフの図を作成するか
+            sql_candidates: 1回のSQL生成で作る候補の数
+        """
+        self.client = client or get_llm_gateway().client_for("engine")
+        self.max_workers = max_workers
+        self.summarize = summarize
+        self.chart = chart
+        self.sql_candidates = sql_candidates
+        # {データソース名: {"info", "dialect", "table_ref", "schema_summary", "preflight"}}
+        self.sources: Dict[str, Dict[str, Any]] = {}
+        self._llm_slots = threading.BoundedSemaphore(max_llm_concurrency)
+        self._query_slots = threading.BoundedSemaphore(max_query_concurrency)
+
+    def add_source(self, name: str, source_info: Dict[str, Any]) -> None:
+        """データソースを登録（取り込み時の型推論・dtype最適化とカラム統計の取得はここで一度だけ実行）"""
+        if source_info.get('type') == 'mcp':
+            raise ValueError("MCPのデータソースはエンジンでは扱えません")
+        if source_info.get('df') is None:
+            raise ValueError(f"データソース '{name}' にDataFrameがありません")
+        if 'dtype_report' not in source_info:
+            source_info['df'], source_info['schema_metadata'] = infer_column_types(source_info['df'])
+            source_info['df'], source_info['dtype_report'] = optimize_dtypes(source_info['df'])
+
+        connector = source_info.get('connector')
+        dialect = connector.get_dialect() if connector is not None and hasattr(connector, 'get_dialect') else 'duckdb'
+        table_ref = build_table_ref(source_info, dialect, connector)
+        profile = get_source_profile(source_info, dialect, connector, table_ref)
+        self.sources[name] = {
+            "info": source_info,
+            "dialect": dialect,
+            "table_ref": table_ref,
+            "schema_summary": format_schema_summary(profile),
+            "preflight": make_preflight(source_info, dialect, table_ref),
+        }
+
+    def remove_source(self, name: str) -> None:
+        """データソースの登録を解除（コネクタは呼び出し側で閉じる）"""
+        self.sources.pop(name, None)
+
+    def ask(self, question: str, source: Optional[str] = None,
+            summarize: Optional[bool] = None, chart: Optional[bool] = None) -> Dict[str, Any]:
+        """質問を1件処理して結果を返す（失敗しても例外は投げず、statusとerrorに記録する）
+
+        Args:
+            question: 質問文
+            source: データソース名（省略時は最初に登録したデータソース）
+            summarize: 要約を生成するか（省略時はエンジンの設定）
+            chart: 推奨グラフの図を作成するか（Falseでも推奨内容は返す。省略時はエンジンの設定）
+
+        Returns:
+            {"question", "source", "status", "sql", "error", "dataframe", "rows", "summary",
+             "figure", "chart", "preflight", "elapsed", "tokens", "trace"}
+        """
+        source = source or next(iter(self.sources), None)
+        summarize = self.summarize if summarize is None else summarize
+        chart = self.chart if chart is None else chart
+        result = {
+            "question": question,
+            "source": source,
+            "status": self.SUCCEEDED,
+            "sql": None,
+            "error": None,
+            "dataframe": None,
+            "rows": 0,
+            "summary": None,
+            "figure": None,
+            "chart": None,
+            "preflight": None,
+        }
+        trace = Trace(question)
+        with activate(trace):
+            try:
+                if source not in self.sources:
+                    raise ValueError(f"データソース '{source}' が登録されていません")
+                entry = self.sources[source]
+
+                with span("prompt_build"):
+                    prompt = build_sql_prompt(entry["dialect"], entry["table_ref"], entry["schema_summary"], question)
+                with self._llm_slots:
+                    result["sql"], result["preflight"] = generate_validated_sql(
+                        self.client, prompt, entry["preflight"], candidates=self.sql_candidates
+                    )
+
+                with span("safety_check"):
+                    is_safe, error_message = is_safe_query(result["sql"])
+                if not is_safe:
+                    result["status"] = self.REJECTED
+                    result["error"] = error_message
+                else:
+                    with self._query_slots:
+                        result_df = self._execute(entry, result["sql"])
+                    result["dataframe"] = result_df
+                    result["rows"] = len(result_df)
+
+                    if summarize:
+                        try:
+                            with self._llm_slots:
+                                result["summary"] = summarize_result(self.client, question, result["sql"], result_df)
+                        except Exception:
+                            # 要約の失敗は結果全体の失敗にしない（アプリと同じ）
+                            result["summary"] = None
+                    if chart:
+                        result["figure"], result["chart"] = build_result_chart(result_df, question)
+                    else:
+                        # 図の作成（plotly）はCPUを使うため、推奨内容だけを返す
+                        result["chart"] = recommend_chart(result_df)
+            except Exception as e:
+                result["status"] = self.FAILED
+                result["error"] = str(e)
+
+        metrics.increment("flashviz_questions_total", status=result["status"])
+        result["elapsed"] = trace.elapsed()
+        result["tokens"] = trace.total("prompt_tokens") + trace.total("completion_tokens")
+        result["trace"] = trace
+        return result
+
+    def execute(self, sql: str, source: Optional[str] = None) -> pd.DataFrame:
+        """SQLを安全性チェックのうえデータソースで直接実行（LLMを使わない）
+
+        Raises:
+            ValueError: データソースが未登録、またはSELECT文以外の場合
+        """
+        source = source or next(iter(self.sources), None)
+        if source not in self.sources:
+            raise ValueError(f"データソース '{source}' が登録されていません")
+        is_safe, error_message = is_safe_query(sql)
+        if not is_safe:
+            raise ValueError(error_message)
+        with self._query_slots:
+            return self._execute(self.sources[source], sql)
+
+    def ask_batch(self, questions: List[Union[str, Dict[str, str]]], source: Optional[str] = None) -> List[Dict[str, Any]]:
+        """質問のリストを並列に処理し、入力と同じ順序で結果を返す
+
+        Args:
+            questions: 質問文、または {"question": 質問文, "source": データソース名} のリスト
+            source: データソース名を指定しない質問に使うデータソース
+        """
+        def run(item: Union[str, Dict[str, str]]) -> Dict[str, Any]:
+            if isinstance(item, dict):
+                return self.ask(item["question"], item.get("source", source))
+            return self.ask(item, source)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="text2sql") as pool:
+            return list(pool.map(run, questions))
+
+    def _execute(self, entry: Dict[str, Any], sql: str) -> pd.DataFrame:
+        """データソースでSQLを実行（ウェアハウス・ディレクトリのローカルファイルはコネクタ、ローカルはクエリごとのDuckDB接続）"""
+        info = entry["info"]
+        dialect = entry["dialect"]
+        connector = info.get('connector')
+        with span("query.execute", dialect=dialect):
+            # ウェアハウスと、ファイルを直接読むローカルファイル（ディレクトリ・glob）はコネクタで実行
+            if (dialect in REMOTE_DIALECTS or info.get('type') == 'local_file') and connector is not None \
+                    and hasattr(connector, 'execute_query'):
+                return connector.execute_query_shared(sql)
+
+            # DataFrameはコピーせずに登録するため、接続をスレッドごとに分けても負荷は小さい
+            conn = duckdb.connect()
+            try:
+                register_dataframe(conn, "data", info['df'], info.get('dtype_report', {}).get('columns'))
+                result_df = conn.execute(sql).fetchdf()
+            finally:
+                conn.close()
+            record_fetch(result_df, "duckdb")
+            return result_df
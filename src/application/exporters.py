@@ -0,0 +1,162 @@
+"""
+クエリ結果のエクスポート
+CSV（gzip）・Parquet（zstd）・Arrow IPCを行のまとまりごとに生成し、結果全体を1つの文字列にせずにストリーミングする。
+HTMLレポートもここで組み立てる（ダウンロード時にのみ生成）
+"""
+from typing import Dict, List, Any, Optional, Iterator, Callable
+import json
+import zlib
+import pandas as pd
+import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.application.charting import figure_to_report_html
+from src.infrastructure.tracing import span
+
+# 1回に変換・書き出す行数
+EXPORT_CHUNK_ROWS = 50000
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# 形式ごとの拡張子とMIMEタイプ
+EXPORT_FORMATS = {
+    "csv": {"extension": "csv.gz", "mime": "application/gzip"},
+    "parquet": {"extension": "parquet", "mime": "application/vnd.apache.parquet"},
+    "arrow": {"extension": "arrow", "mime": "application/vnd.apache.arrow.file"},
+}
+
+
+class _ChunkSink:
+    """書き込まれたバイト列をためておき、ストリーミングで少しずつ取り出すための出力先"""
+
+    closed = False
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data: Any) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """DataFrameをArrowのテーブルに変換（型が混在するobjectカラムは文字列にする）"""
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        converted = df.copy()
+        for col in converted.columns:
+            if converted[col].dtype == object:
+                converted[col] = converted[col].map(lambda v: v if v is None or pd.isna(v) else str(v))
+        return pa.Table.from_pandas(converted, preserve_index=False)
+
+
+def iter_csv_gzip(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS, compresslevel: int = 6) -> Iterator[bytes]:
+    """gzip圧縮したCSVを行のまとまりごとに出力"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    # 0行でもヘッダーは出力する
+    for start in range(0, max(len(df), 1), chunk_rows):
+        text = df.iloc[start:start + chunk_rows].to_csv(index=False, header=start == 0)
+        data = compressor.compress(text.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_parquet(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS, compression: str = "zstd") -> Iterator[bytes]:
+    """Parquetをrow groupごとに出力"""
+    table = to_arrow_table(df)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), table.schema, compression=compression) as writer:
+        for start in range(0, max(table.num_rows, 1), chunk_rows):
+            writer.write_table(table.slice(start, chunk_rows), row_group_size=chunk_rows)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_arrow(df: pd.DataFrame, chunk_rows: int = EXPORT_CHUNK_ROWS, stream: bool = False,
+               metadata: Optional[Dict[str, Any]] = None) -> Iterator[bytes]:
+    """Arrow IPCをレコードバッチごとに出力
+
+    Args:
+        df: 出力するDataFrame
+        chunk_rows: 1バッチの行数
+        stream: Trueならストリーム形式（HTTPでの逐次読み込み向け）、Falseならファイル形式（.arrow/Feather V2）
+        metadata: スキーマのメタデータ"flashviz"にJSONで格納する値
+    """
+    table = to_arrow_table(df)
+    schema = table.schema
+    if metadata is not None:
+        schema = schema.with_metadata({
+            **(schema.metadata or {}),
+            b"flashviz": json.dumps(metadata, ensure_ascii=False, default=str).encode("utf-8"),
+        })
+    sink = _ChunkSink()
+    new_writer = pa.ipc.new_stream if stream else pa.ipc.new_file
+    with new_writer(pa.PythonFile(sink, mode="w"), schema) as writer:
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_batch(batch)
+            yield sink.drain()
+    yield sink.drain()
+
+
+EXPORTERS: Dict[str, Callable[[pd.DataFrame], Iterator[bytes]]] = {
+    "csv": iter_csv_gzip,
+    "parquet": iter_parquet,
+    "arrow": iter_arrow,
+}
+
+
+def export_bytes(df: pd.DataFrame, export_format: str) -> bytes:
+    """指定の形式でエクスポートしたバイト列（ダウンロードボタンのクリック時に呼ぶ）"""
+    with span("export", format=export_format, rows=len(df)):
+        return b"".join(EXPORTERS[export_format](df))
+
+
+def build_html_report(question: str, sql: str, summary: str, figure: Optional[go.Figure],
+                      df: pd.DataFrame, timestamp: pd.Timestamp) -> str:
+    """HTMLレポート（データは上位20行のみ）"""
+    with span("report.html"):
+        return f"""
+<html>
+<head>
+    <title>FlashViz分析レポート - {timestamp.strftime('%Y/%m/%d %H:%M')}</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 40px; }}
+        h1, h2 {{ color: #333; }}
+        .query {{ background-color: #f0f0f0; padding: 10px; border-radius: 5px; }}
+        .sql {{ background-color: #e8e8e8; padding: 10px; border-radius: 5px; font-family: monospace; white-space: pre-wrap; }}
+        .summary {{ background-color: #f9f9f9; padding: 15px; border-radius: 5px; margin: 20px 0; }}
+        table {{ border-collapse: collapse; width: 100%; }}
+        th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
+        th {{ background-color: #4CAF50; color: white; }}
+    </style>
+</head>
+<body>
+    <h1>FlashViz 分析レポート</h1>
+    <p><strong>作成日時:</strong> {timestamp.strftime('%Y年%m月%d日 %H:%M:%S')}</p>
+
+    <h2>質問</h2>
+    <div class="query">{question}</div>
+
+    <h2>実行したSQL</h2>
+    <div class="sql">{sql}</div>
+
+    <h2>分析要約</h2>
+    <div class="summary">{summary}</div>
+
+    <h2>グラフ</h2>
+    {figure_to_report_html(figure)}
+
+    <h2>データ（上位20行）</h2>
+    {df.head(20).to_html()}
+</body>
+</html>
+"""
@@ -0,0 +1,267 @@
+"""
+マルチソース統合クエリ
+接続中の全データソースを1つのDuckDBセッションに名前付きリレーションとして登録し、横断的なSQLを実行する
+"""
+from typing import Dict, List, Any, Optional, Callable, Tuple
+from collections import OrderedDict
+import re
+import threading
+import duckdb
+import pandas as pd
+from src.application.dtype_optimizer import register_dataframe
+from src.application.profiler import format_schema_summary
+from src.application.pushdown import plan_pushdown, plan_remote_query
+from src.infrastructure.connectors.base import QueryHandle, bind_cancel, is_sql_error
+
+
+def make_relation_name(source_name: str, existing: List[str]) -> str:
+    """データソース名からSQLで使えるリレーション名を作る（重複時は連番を付与）"""
+    base = re.sub(r"\W+", "_", source_name.lower()).strip("_")
+    if not base or base[0].isdigit():
+        base = f"src_{base}" if base else "src"
+    name = base
+    suffix = 2
+    while name in existing:
+        name = f"{base}_{suffix}"
+        suffix += 1
+    return name
+
+
+class FederationEngine:
+    """データソースを横断する共有DuckDBセッション
+
+    ローカル/サンプルのDataFrameはそのまま（コピーせず）登録する。ウェアハウスのテーブルは
+    クエリごとに必要なカラムと条件だけをリモートで取得し（プッシュダウン）、同じ取得クエリの結果は再利用する。
+    1つのウェアハウスのテーブルだけを参照するクエリは、集計を含めてクエリ全体をウェアハウスで実行する
+    （結果は再利用せず、毎回ウェアハウスで実行する）。
+    リモートからの取得はどちらもmax_remote_rows行までで、上限を超えた場合はレポートのtruncatedで知らせる。
+    """
+
+    def __init__(self, max_remote_rows: int = 100000, scan_cache_size: int = 8):
+        self.max_remote_rows = max_remote_rows
+        self.scan_cache_size = scan_cache_size
+        self.conn = duckdb.connect()
+        # 参照テーブルの解析専用（登録済みリレーションの影響を受けない空の接続）
+        self._parser = duckdb.connect()
+        self._lock = threading.Lock()
+        # {リレーション名: {"source", "type", "df", "columns", "dtype_columns", "fetch", "table_ref", "dialect",
+        #                   "profile", "scans"}}
+        self.relations: Dict[str, Dict[str, Any]] = {}
+
+    def relation_for(self, source_name: str) -> Optional[str]:
+        """データソース名に対応するリレーション名"""
+        for relation, info in self.relations.items():
+            if info["source"] == source_name:
+                return relation
+        return None
+
+    def add_source(self, source_name: str, source_type: str, df: pd.DataFrame,
+                   dtype_columns: Optional[Dict[str, str]] = None,
+                   fetch: Optional[Callable[[str], pd.DataFrame]] = None,
+                   table_ref: Optional[str] = None, dialect: Optional[str] = None,
+                   profile: Optional[Dict[str, Any]] = None) -> str:
+        """データソースをリレーションとして登録
+
+        Args:
+            source_name: データソース名
+            source_type: データソース種類（表示用）
+            df: 取り込み済みのDataFrame（ウェアハウスの場合はサンプル）
+            dtype_columns: dtype最適化レポートの"columns"
+            fetch: リモートでSQLを実行してDataFrameを返す関数 fetch(sql, handle=...)（ウェアハウスのみ、参照時に実行）
+            table_ref: リモートの完全修飾テーブル名
+            dialect: リモートのSQLダイアレクト
+            profile: プロンプト用のカラム統計
+
+        Returns:
+            リレーション名
+        """
+        relation = self.relation_for(source_name)
+        if relation is not None:
+            return relation
+        relation = make_relation_name(source_name, list(self.relations))
+        self.relations[relation] = {
+            "source": source_name,
+            "type": source_type,
+            "df": df,
+            "columns": [str(col) for col in df.columns],
+            "dtype_columns": dtype_columns,
+            "fetch": fetch,
+            "table_ref": table_ref,
+            "dialect": dialect,
+            "profile": profile,
+            "scans": OrderedDict(),  # {リモートSQL: 取得結果}
+        }
+        if fetch is None:
+            with self._lock:
+                register_dataframe(self.conn, relation, df, dtype_columns)
+        return relation
+
+    def remove_missing(self, source_names: List[str]) -> None:
+        """削除されたデータソースのリレーションを破棄"""
+        for relation, info in list(self.relations.items()):
+            if info["source"] not in source_names:
+                with self._lock:
+                    self.conn.execute(f'DROP VIEW IF EXISTS "{relation}"')
+                    self.conn.unregister(f"__{relation}_raw")
+                del self.relations[relation]
+
+    def referenced_relations(self, sql: str) -> List[str]:
+        """SQLが参照している登録済みリレーション"""
+        try:
+            names = self._parser.get_table_names(sql)
+        except duckdb.Error:
+            # 解析できない場合は単語一致で判定
+            return [r for r in self.relations if re.search(rf"\b{re.escape(r)}\b", sql)]
+        return [r for r in self.relations if r in names]
+
+    def plan(self, sql: str) -> Dict[str, Dict[str, Any]]:
+        """SQLが参照するリモートリレーションの取得計画（解析できなければテーブル全体を取得）"""
+        remote = {relation: {"table_ref": info["table_ref"], "dialect": info["dialect"]}
+                  for relation, info in self.relations.items() if info["fetch"] is not None}
+        if not remote:
+            return {}
+        relation_columns = {relation: info["columns"] for relation, info in self.relations.items()}
+        # 上限を超えたかどうかを判定できるよう1行多く取得する
+        plans = plan_pushdown(sql, relation_columns, remote, limit=self.max_remote_rows + 1)
+        if plans is None:
+            plans = {}
+            for relation in self.referenced_relations(sql):
+                if relation in remote:
+                    info = self.relations[relation]
+                    plans[relation] = {
+                        "sql": f"SELECT * FROM {info['table_ref']} LIMIT {self.max_remote_rows + 1}",
+                        "columns": info["columns"],
+                        "predicates": [],
+                    }
+        return plans
+
+    def plan_remote_query(self, sql: str) -> Optional[Dict[str, Any]]:
+        """1つのリモートリレーションだけを参照するクエリを、クエリ全体をリモートで実行する計画にする（できなければNone）"""
+        relations = self.referenced_relations(sql)
+        if len(relations) != 1 or self.relations[relations[0]]["fetch"] is None:
+            return None
+        relation = relations[0]
+        info = self.relations[relation]
+        # 上限を超えたかどうかを判定できるよう1行多く取得する
+        remote_sql = plan_remote_query(sql, relation, info["columns"], info["table_ref"], info["dialect"],
+                                       limit=self.max_remote_rows + 1)
+        if remote_sql is None:
+            return None
+        return {"relation": relation, "sql": remote_sql, "columns": [], "predicates": []}
+
+    def execute(self, sql: str, handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """参照されたリモートテーブルの必要部分だけを取得してからSQLを実行
+
+        1つのリモートテーブルだけを参照するクエリは、クエリ全体をリモートで実行する
+        （ウェアハウスがSQLを受け付けなかった場合は必要部分を取得してDuckDBで実行する）。
+        リモートの取得はロックの外で行い、ロックはキャッシュの更新とDuckDBでの実行の間だけ取る。
+
+        Args:
+            sql: 実行するSQL
+            handle: このクエリを中断するためのハンドル（実行中のリモート取得またはDuckDBでの実行を中断する）
+
+        Returns:
+            結果DataFrame（attrs["pushdown"]にリモート取得ごとのレポートを格納）
+        """
+        remote_plan = self.plan_remote_query(sql)
+        if remote_plan is not None:
+            relation = remote_plan["relation"]
+            try:
+                result = self.relations[relation]["fetch"](remote_plan["sql"], handle=handle)
+            except Exception as e:
+                # ウェアハウスに未対応の関数などはDuckDB側で実行する（認証・キャンセルなどのエラーはそのまま返す）
+                if not is_sql_error(e):
+                    raise
+                result = None
+            if result is not None:
+                truncated = len(result) > self.max_remote_rows
+                # 取得結果は共有されるため、上限で切り詰めるときも元のDataFrameは変更しない
+                result = result.iloc[:self.max_remote_rows].copy(deep=False)
+                report = self._report(relation, remote_plan, result, False, "query")
+                report["truncated"] = truncated
+                result.attrs["pushdown"] = [report]
+                return result
+
+        plans = self.plan(sql)
+        fetched = {relation: self._fetch(relation, plan["sql"], handle) for relation, plan in plans.items()}
+        # 取得結果の登録からクエリ完了まで、他のクエリにリレーションを差し替えられないようにする
+        with self._lock:
+            report = [self._load_remote(relation, plans[relation], *fetched[relation]) for relation in plans]
+            # 中断はこのクエリの実行中だけ有効にする（共有接続で次に実行される他のクエリを中断しない）
+            with bind_cancel(handle, self.conn.interrupt):
+                result = self.conn.execute(sql).fetchdf()
+        result.attrs["pushdown"] = report
+        return result
+
+    def interrupt(self) -> None:
+        """実行中のクエリを中断"""
+        self.conn.interrupt()
+
+    def build_catalog_prompt(self, max_tokens_per_relation: int = 600) -> str:
+        """SQL生成プロンプト用の統合カタログ（リレーションごとのカラム統計）"""
+        sections = []
+        for relation, info in self.relations.items():
+            header = f"テーブル名: {relation}（データソース: {info['source']} / 種類: {info['type']}）"
+            if info["profile"] is not None:
+                body = format_schema_summary(info["profile"], max_tokens=max_tokens_per_relation)
+            else:
+                body = ", ".join(f"{col} ({dtype})" for col, dtype in info["df"].dtypes.astype(str).items())
+            sections.append(f"{header}\n{body}")
+        return "\n\n".join(sections)
+
+    def _fetch(self, relation: str, remote_sql: str,
+               handle: Optional[QueryHandle] = None) -> Tuple[pd.DataFrame, bool]:
+        """取得クエリを実行（同じSQLの結果は再利用）し、(結果, 再利用したか)を返す
+
+        ロックはキャッシュの参照・更新の間だけ取り、リモートの実行中は他のクエリを待たせない。
+        """
+        scans = self.relations[relation]["scans"]
+        with self._lock:
+            if remote_sql in scans:
+                scans.move_to_end(remote_sql)
+                return scans[remote_sql], True
+        df = self.relations[relation]["fetch"](remote_sql, handle=handle)
+        with self._lock:
+            scans[remote_sql] = df
+            while len(scans) > self.scan_cache_size:
+                scans.popitem(last=False)
+        return df, False
+
+    def _load_remote(self, relation: str, plan: Dict[str, Any], df: pd.DataFrame, cached: bool) -> Dict[str, Any]:
+        """取得した結果を登録（ロック取得済みで呼ぶ）し、削減できた転送量を返す"""
+        # 上限の1行先まで取得して、上限を超えたかを判定する
+        truncated = len(df) > self.max_remote_rows
+        if truncated:
+            df = df.iloc[:self.max_remote_rows]
+        register_dataframe(self.conn, relation, df)
+        report = self._report(relation, plan, df, cached, "scan")
+        report["truncated"] = truncated
+        return report
+
+    def _report(self, relation: str, plan: Dict[str, Any], df: pd.DataFrame, cached: bool, mode: str) -> Dict[str, Any]:
+        """リモート取得のレポート（mode: "query"ならクエリ全体、"scan"なら必要部分をリモートで実行）"""
+        info = self.relations[relation]
+        # テーブル全体を取得した場合の転送量はサンプルの1行あたりサイズ×全体行数で見積もる
+        sample = info["df"]
+        row_bytes = _dataframe_bytes(sample) / len(sample) if len(sample) else 0
+        total_rows = (info["profile"] or {}).get("row_count", len(sample))
+        bytes_full = int(row_bytes * total_rows)
+        bytes_fetched = 0 if cached else _dataframe_bytes(df)
+        return {
+            "relation": relation,
+            "sql": plan["sql"],
+            "columns": plan["columns"],
+            "predicates": plan["predicates"],
+            "rows": len(df),
+            "mode": mode,
+            "truncated": False,
+            "cached": cached,
+            "bytes_fetched": bytes_fetched,
+            "bytes_full": bytes_full,
+            "bytes_saved": max(bytes_full - bytes_fetched, 0),
+        }
+
+
+def _dataframe_bytes(df: pd.DataFrame) -> int:
+    """DataFrameの実メモリ使用量（転送量の目安）"""
+    return int(df.memory_usage(deep=True, index=False).sum())
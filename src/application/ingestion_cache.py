@@ -0,0 +1,244 @@
+"""
+アップロードファイルの取り込みキャッシュ
+ファイルの内容のハッシュをキーに、取り込み（パース・型推論・dtype最適化）済みのDataFrameをプロセス内で共有する。
+初回の取り込み時にParquetとして保存し、メモリから追い出された後やプロセスの再起動後もパースをやり直さずに復元する。
+同じファイルを複数のセッションでアップロードしてもパースは1回、メモリ上のデータは1つになる。
+Excelのブックはシートごとのテーブルとして1件のエントリにまとめて保持する。
+キャッシュのDataFrameは全セッションで共有されるため、読み取り専用として扱うこと。
+"""
+from typing import Dict, Any, Optional, Callable, Tuple
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import shutil
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.application.type_inference import infer_column_types
+from src.application.dtype_optimizer import optimize_dtypes
+from src.infrastructure.file_reader import read_tables, ProgressCallback
+from src.infrastructure.singleflight import SingleFlight
+from src.infrastructure.tracing import span, set_attributes, metrics
+
+# メモリに保持する取り込み済みデータの合計サイズの上限
+DEFAULT_MEMORY_LIMIT_BYTES = int(os.getenv("FLASHVIZ_INGEST_CACHE_MB", "2048")) * 1024 * 1024
+# Parquetの保存先とディスク上の合計サイズの上限
+DEFAULT_CACHE_DIR = os.getenv("FLASHVIZ_INGEST_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "flashviz", "ingest"))
+DEFAULT_DISK_LIMIT_BYTES = int(os.getenv("FLASHVIZ_INGEST_CACHE_DISK_MB", "10240")) * 1024 * 1024
+
+
+def content_hash(data: Any) -> str:
+    """ファイルの内容のSHA-256（bytes/memoryview、またはgetbufferを持つアップロードファイル）"""
+    if hasattr(data, "getbuffer"):
+        data = data.getbuffer()
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_file(data: Any, file_name: str, progress: Optional[ProgressCallback] = None) -> Dict[str, pd.DataFrame]:
+    """アップロードされたファイルを拡張子に応じて読み込む（Excelは全シート）
+
+    Returns:
+        {テーブル名: DataFrame}（CSV・Parquetは"data"のみ、Excelはシート名ごと）
+    """
+    return read_tables(data, file_name, progress)
+
+
+def _restore_dataframe(table: pa.Table) -> pd.DataFrame:
+    """ParquetのテーブルをDataFrameに戻す（Parquetで表せない秒単位の日時は元の単位に戻す）"""
+    numpy_types = {column["name"]: column["numpy_type"] for column in (table.schema.pandas_metadata or {}).get("columns", [])}
+    # 変換済みのArrowバッファを解放しながら変換し、ピークメモリを抑える
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    for col in df.columns:
+        numpy_type = numpy_types.get(col)
+        if numpy_type and numpy_type.startswith("datetime64[") and str(df[col].dtype) != numpy_type:
+            df[col] = df[col].astype(numpy_type)
+    return df
+
+
+class IngestionCache:
+    """内容のハッシュをキーにした取り込み済みデータのキャッシュ（メモリとParquetの2段）"""
+
+    def __init__(self, cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 memory_limit_bytes: int = DEFAULT_MEMORY_LIMIT_BYTES,
+                 disk_limit_bytes: int = DEFAULT_DISK_LIMIT_BYTES):
+        """
+        Args:
+            cache_dir: Parquetの保存先（Noneならディスクに保存しない）
+            memory_limit_bytes: メモリに保持する合計サイズの上限（超えたら古いものから追い出す）
+            disk_limit_bytes: ディスク上の合計サイズの上限（超えたら古いものから削除）
+        """
+        self.cache_dir = cache_dir
+        self.memory_limit_bytes = memory_limit_bytes
+        self.disk_limit_bytes = disk_limit_bytes
+        # {キー: {"tables": {テーブル名: {"df", "schema_metadata", "dtype_report"}}, "bytes"}}（末尾が最近使ったもの）
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        # 同じファイルが同時にアップロードされた場合は取り込みを1回にまとめる
+        self._flights = SingleFlight("ingest")
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, data: Any, file_name: str, use_arrow_strings: bool = False,
+             reader: Callable[..., Dict[str, pd.DataFrame]] = read_file,
+             progress: Optional[ProgressCallback] = None) -> Dict[str, Any]:
+        """ファイルを取り込む（同じ内容なら取り込み済みのデータを返す）
+
+        Args:
+            data: ファイルの内容（bytes/memoryview、またはStreamlitのUploadedFile）
+            file_name: ファイル名（拡張子で形式を判定）
+            use_arrow_strings: 文字列をstring[pyarrow]で保持するか（キーに含める）
+            reader: ファイルを{テーブル名: DataFrame}に読み込む関数 (data, file_name, progress)
+            progress: 読み込みの進捗の通知先 (完了数, 全体数, 内容)（キャッシュから取得した場合は呼ばない）
+
+        Returns:
+            {"tables": {テーブル名: {"df", "schema_metadata", "dtype_report"}}, "content_hash",
+             "cached": キャッシュから取得したか}
+        """
+        with span("ingest", file=file_name):
+            with span("ingest.hash"):
+                digest = content_hash(data)
+            extension = os.path.splitext(file_name)[1].lower()
+            key = f"{digest}{'-arrow' if use_arrow_strings else ''}{extension}"
+
+            entry, cached = self._flights.do(
+                key, lambda: self._get_or_ingest(key, data, file_name, use_arrow_strings, reader, progress)
+            )
+            set_attributes(cached=cached, tables=len(entry["tables"]),
+                           rows=sum(len(table["df"]) for table in entry["tables"].values()))
+            return {"tables": entry["tables"], "content_hash": digest, "cached": cached}
+
+    def _get_or_ingest(self, key: str, data: Any, file_name: str, use_arrow_strings: bool,
+                       reader: Callable[..., Dict[str, pd.DataFrame]],
+                       progress: Optional[ProgressCallback]) -> Tuple[Dict[str, Any], bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                metrics.increment("flashviz_ingest_cache_total", result="memory")
+                return entry, True
+
+        entry = self._read_parquet(key)
+        if entry is not None:
+            metrics.increment("flashviz_ingest_cache_total", result="disk")
+            cached = True
+        else:
+            metrics.increment("flashviz_ingest_cache_total", result="miss")
+            with span("ingest.parse"):
+                frames = reader(data, file_name, progress)
+            tables = {}
+            with span("ingest.optimize"):
+                for name, df in frames.items():
+                    df, schema_metadata = infer_column_types(df)
+                    df, dtype_report = optimize_dtypes(df, use_arrow_strings=use_arrow_strings)
+                    tables[name] = {"df": df, "schema_metadata": schema_metadata, "dtype_report": dtype_report}
+            entry = {"tables": tables,
+                     "bytes": sum(table["dtype_report"]["memory_after"] for table in tables.values())}
+            # Parquetへの保存は取り込みの完了を待たせないようバックグラウンドで行う
+            threading.Thread(target=self._write_parquet, args=(key, entry), name="ingest-persist", daemon=True).start()
+            cached = False
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._memory_bytes += entry["bytes"]
+            self._evict_memory()
+        return entry, cached
+
+    def _evict_memory(self) -> None:
+        """メモリ上の合計サイズが上限を超えたら古いものから追い出す（ロック取得済みで呼ぶ、最新の1件は残す）"""
+        while self._memory_bytes > self.memory_limit_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._memory_bytes -= entry["bytes"]
+
+    def _entry_dir(self, key: str) -> str:
+        """エントリの保存先（テーブルごとのParquetとメタデータのJSON）"""
+        return os.path.join(self.cache_dir, key)
+
+    def _read_parquet(self, key: str) -> Optional[Dict[str, Any]]:
+        """保存済みのParquetから復元（dtypeはpandasのメタデータで最適化後の型に戻る）"""
+        if not self.cache_dir:
+            return None
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with span("ingest.restore"):
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+                tables = {}
+                for i, table in enumerate(meta["tables"]):
+                    df = _restore_dataframe(pq.read_table(os.path.join(entry_dir, f"{i}.parquet")))
+                    tables[table["name"]] = {"df": df, "schema_metadata": table["schema_metadata"],
+                                             "dtype_report": table["dtype_report"]}
+            # 最近使ったものとして削除の対象から外す
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError, pa.ArrowException):
+            return None
+        return {"tables": tables, "bytes": sum(table["dtype_report"]["memory_after"] for table in tables.values())}
+
+    def _write_parquet(self, key: str, entry: Dict[str, Any]) -> None:
+        """取り込み済みのデータをParquetで保存（保存できない型が含まれる場合はメモリのみ）"""
+        if not self.cache_dir:
+            return
+        entry_dir = self._entry_dir(key)
+        # 書き込み途中のファイルを読まないよう、一時ディレクトリに書いてから置き換える
+        temp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        try:
+            with span("ingest.persist"):
+                os.makedirs(temp_dir, exist_ok=True)
+                meta = []
+                for i, (name, table) in enumerate(entry["tables"].items()):
+                    pq.write_table(pa.Table.from_pandas(table["df"], preserve_index=False),
+                                   os.path.join(temp_dir, f"{i}.parquet"), compression="zstd")
+                    meta.append({"name": name, "schema_metadata": table["schema_metadata"],
+                                 "dtype_report": table["dtype_report"]})
+                with open(os.path.join(temp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                    json.dump({"tables": meta}, f, ensure_ascii=False, default=str)
+                os.replace(temp_dir, entry_dir)
+        except (OSError, ValueError, pa.ArrowException):
+            # 保存済み（別プロセスが先に保存した）場合も含め、一時ディレクトリは残さない
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+        self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """ディスク上の合計サイズが上限を超えたら、使われていない順に削除"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                mtime = os.stat(os.path.join(entry_dir, "meta.json")).st_mtime
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            except OSError:
+                continue
+            entries.append((mtime, size, entry_dir))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries)[:-1]:
+            if total <= self.disk_limit_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        """メモリ上の件数と合計サイズ"""
+        with self._lock:
+            return {"entries": len(self._entries), "memory_bytes": self._memory_bytes}
+
+
+_cache: Optional[IngestionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_ingestion_cache() -> IngestionCache:
+    """プロセス全体で共有する取り込みキャッシュを取得"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = IngestionCache()
+        return _cache
@@ -0,0 +1,274 @@
+"""
+プロセス全体で共有するLLMゲートウェイ
+1つのOpenAIクライアント（HTTP接続をキープアライブで再利用）を全セッションで共有し、
+モデルごとの1分あたりリクエスト数・トークン数のトークンバケット、429/5xxのジッター付きリトライ、
+セッション間のラウンドロビンによる公平なキューイング、同じリクエストの同時実行の共有を行う。キュー待ち時間とモデルの応答時間は別々に計測する。
+"""
+from typing import Dict, Any, Optional, Tuple
+from collections import deque
+import copy
+import json
+import os
+import random
+import threading
+import time
+import httpx
+import openai
+from openai import OpenAI, DefaultHttpxClient
+from src.application.profiler import estimate_tokens
+from src.infrastructure.singleflight import llm_flights
+from src.infrastructure.tracing import span, set_attributes, metrics
+
+# モデルごとの1分あたりの既定の上限（環境変数で変更可）
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("FLASHVIZ_LLM_RPM", "500"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("FLASHVIZ_LLM_TPM", "200000"))
+# 応答トークン数の見積もり（max_completion_tokensの指定がない場合）
+DEFAULT_COMPLETION_TOKENS = 1000
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """1分あたりの上限を持つトークンバケット
+
+    予約方式で、残量を超えて予約した分は残量が負になり、その分だけ後続の予約が待つ。
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """amountを予約し、使えるようになるまでの待ち秒数を返す"""
+        self._refill()
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def adjust(self, amount: float) -> None:
+        """見積もりと実績の差を反映（正なら追加消費、負なら返却）"""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+    def pause(self, seconds: float) -> None:
+        """レート制限を受けたとき、以降の予約がseconds秒以上待つようにする"""
+        self._refill()
+        self.level = min(self.level, -seconds * self.rate)
+
+
+def _estimate_request_tokens(request: Dict[str, Any]) -> int:
+    """リクエストの入力+出力トークン数の見積もり"""
+    prompt_tokens = sum(estimate_tokens(str(message.get("content") or "")) for message in request.get("messages", []))
+    completion_tokens = request.get("max_completion_tokens") or request.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    # nで複数の候補を生成する場合は応答の分だけ増える
+    return prompt_tokens + completion_tokens * (request.get("n") or 1)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """エラー応答のRetry-Afterヘッダー（秒）"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+class LLMGateway:
+    """共有OpenAIクライアントへの呼び出しを制御するゲートウェイ"""
+
+    def __init__(self, api_key: Optional[str] = None, max_concurrency: int = 8,
+                 requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+                 model_limits: Optional[Dict[str, Tuple[int, int]]] = None,
+                 max_retries: int = 5, base_delay: float = 0.5, max_delay: float = 30.0):
+        """
+        Args:
+            api_key: OpenAI APIキー（省略時はOPENAI_API_KEY）
+            max_concurrency: 同時に送信するリクエスト数の上限
+            requests_per_minute: モデルごとの1分あたりのリクエスト数の上限
+            tokens_per_minute: モデルごとの1分あたりのトークン数の上限
+            model_limits: モデル別の上限 {モデル名: (リクエスト数, トークン数)}
+            max_retries: 429/5xx/接続エラー時の最大リトライ回数
+            base_delay: リトライ間隔の基準（秒、回数ごとに倍）
+            max_delay: リトライ間隔の上限（秒）
+        """
+        # リトライはゲートウェイで行うためSDKのリトライは無効にする
+        self.client = OpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            max_retries=0,
+            http_client=DefaultHttpxClient(
+                limits=httpx.Limits(max_connections=max_concurrency * 2, max_keepalive_connections=max_concurrency)
+            )
+        )
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.model_limits = model_limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # {モデル名: (リクエスト数のバケット, トークン数のバケット)}
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        # {所有者: 待機中のリクエスト}（先頭の所有者から順に1件ずつ送信枠を割り当てる）
+        self._waiting: Dict[str, deque] = {}
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def client_for(self, owner: str) -> "GatewayClient":
+        """所有者（セッションID）ごとのOpenAIクライアント互換オブジェクト"""
+        return GatewayClient(self, owner)
+
+    def chat_completion(self, owner: str, **request: Any) -> Any:
+        """chat.completions.createをレート制限・公平キュー・リトライ付きで実行
+
+        同じ内容のリクエストが実行中なら（所有者が異なっても）新たに送信せず、その応答を共有する。
+        共有した応答はusageをNoneにした写しを返す（トークンは実際に送信した呼び出し元だけが計上する）。
+        """
+        key = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        response, shared = llm_flights.call(key, lambda: self._send(owner, request))
+        if shared:
+            response = copy.copy(response)
+            response.usage = None
+        return response
+
+    def _send(self, owner: str, request: Dict[str, Any]) -> Any:
+        """送信枠とレート制限を待ってリクエストを送信（失敗時はリトライ）"""
+        model = request.get("model", "")
+        estimated_tokens = _estimate_request_tokens(request)
+
+        queued_at = time.perf_counter()
+        with span("llm.queue_wait", model=model):
+            self._acquire_slot(owner)
+            try:
+                wait = self._reserve(model, estimated_tokens)
+                if wait > 0:
+                    set_attributes(rate_limited=True)
+                    time.sleep(wait)
+            except BaseException:
+                self._release_slot()
+                raise
+        metrics.observe("flashviz_llm_queue_wait_seconds", time.perf_counter() - queued_at, model=model)
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                started = time.perf_counter()
+                try:
+                    response = self.client.chat.completions.create(**request)
+                except Exception as e:
+                    metrics.observe("flashviz_llm_request_seconds", time.perf_counter() - started, model=model)
+                    if attempt >= self.max_retries or not _is_retryable(e):
+                        raise
+                    delay = self._backoff(attempt, _retry_after(e))
+                    status = getattr(e, "status_code", None)
+                    if status == 429:
+                        # 他のセッションのリクエストも同じだけ待たせる
+                        with self._lock:
+                            for bucket in self._buckets_for(model):
+                                bucket.pause(delay)
+                    metrics.increment("flashviz_llm_retries_total", model=model, reason=str(status or type(e).__name__))
+                    time.sleep(delay)
+                    continue
+                metrics.observe("flashviz_llm_request_seconds", time.perf_counter() - started, model=model)
+                usage = getattr(response, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None) is not None:
+                    with self._lock:
+                        self._buckets_for(model)[1].adjust(usage.total_tokens - estimated_tokens)
+                return response
+        finally:
+            self._release_slot()
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """フルジッター付きの指数バックオフ（Retry-Afterがあればそれ以上待つ）"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def _buckets_for(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        """モデルのバケット（ロック取得済みで呼ぶ）"""
+        if model not in self._buckets:
+            requests, tokens = self.model_limits.get(model, (self.requests_per_minute, self.tokens_per_minute))
+            self._buckets[model] = (TokenBucket(requests), TokenBucket(tokens))
+        return self._buckets[model]
+
+    def _reserve(self, model: str, tokens: int) -> float:
+        """リクエスト1件とトークンを予約し、待ち秒数を返す"""
+        with self._lock:
+            request_bucket, token_bucket = self._buckets_for(model)
+            return max(request_bucket.reserve(1), token_bucket.reserve(tokens))
+
+    def _acquire_slot(self, owner: str) -> None:
+        """送信枠を待つ（所有者ごとのFIFOをラウンドロビンで処理）"""
+        ticket = threading.Event()
+        with self._lock:
+            self._waiting.setdefault(owner, deque()).append(ticket)
+            self._dispatch()
+        ticket.wait()
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+
+    def _dispatch(self) -> None:
+        """空いている送信枠を待機中のリクエストに割り当てる（ロック取得済みで呼ぶ）"""
+        while self._active < self.max_concurrency and self._waiting:
+            owner = next(iter(self._waiting))
+            queue = self._waiting.pop(owner)
+            ticket = queue.popleft()
+            if queue:
+                # 残りがあれば末尾に回し、他の所有者を先に処理する
+                self._waiting[owner] = queue
+            self._active += 1
+            ticket.set()
+
+    def queue_length(self) -> int:
+        """送信待ちのリクエスト数"""
+        with self._lock:
+            return sum(len(queue) for queue in self._waiting.values())
+
+
+class GatewayClient:
+    """OpenAIクライアントと同じ client.chat.completions.create(...) の形でゲートウェイを呼ぶためのラッパー"""
+
+    def __init__(self, gateway: LLMGateway, owner: str):
+        self.chat = self
+        self.completions = self
+        self._gateway = gateway
+        self._owner = owner
+
+    def create(self, **request: Any) -> Any:
+        return self._gateway.chat_completion(self._owner, **request)
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway() -> LLMGateway:
+    """プロセス全体で共有するLLMゲートウェイを取得"""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway(max_concurrency=int(os.getenv("FLASHVIZ_LLM_CONCURRENCY", "8")))
+        return _gateway
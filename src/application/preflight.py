@@ -0,0 +1,174 @@
+"""
+生成SQLの事前検証（プリフライト）
+ウェアハウスに送る前に、対象ダイアレクトでの構文解析、取り込み済みスキーマとのテーブル・カラムの照合、
+サンプルから作ったDuckDB上での試行実行を行い、失敗した場合はモデルに渡すエラーメッセージを返す
+"""
+from typing import Dict, List, Any, Optional
+import re
+import duckdb
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.schema import MappingSchema
+from src.application.dtype_optimizer import register_dataframe
+
+# 試行実行に使うサンプルの最大行数
+PREFLIGHT_SAMPLE_ROWS = 1000
+# 検証で対象テーブルの代わりに使うリレーション名
+_TARGET = "__preflight_target"
+# sqlglotのエラーメッセージに含まれる端末用の装飾
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def _table_matches(table: exp.Table, target: exp.Table) -> bool:
+    """SQL中のテーブル参照が対象テーブルを指しているか（指定された部分のみ比較）"""
+    for part in ("this", "db", "catalog"):
+        name = table.args.get(part)
+        if name is None:
+            continue
+        target_name = target.args.get(part)
+        if target_name is None or name.name.lower() != target_name.name.lower():
+            return False
+    return True
+
+
+def _rewrite_target(expression: exp.Expression, table_ref: str, dialect: str,
+                    relations: Dict[str, pd.DataFrame], allow_target: bool = True) -> Optional[str]:
+    """対象テーブルへの参照を検証用のリレーションに置き換える（参照できないテーブルがあればエラーメッセージを返す）"""
+    target = exp.to_table(table_ref, dialect=dialect)
+    local_names = {cte.alias_or_name.lower() for cte in expression.find_all(exp.CTE)} | set(relations)
+    for table in list(expression.find_all(exp.Table)):
+        if not table.args.get("db") and table.name.lower() in local_names:
+            continue
+        if not _table_matches(table, target):
+            usable = ", ".join([table_ref, *relations])
+            return f"存在しないテーブルが参照されています: {table.sql(dialect=dialect)}（使用できるテーブル: {usable}）"
+        if not allow_target:
+            return f"{', '.join(relations)}（過去の結果）と{table_ref}は同じクエリで参照できません。どちらか一方のみを使用してください"
+        # 列の修飾（テーブル名.カラム名）がそのまま解決できるよう、元の名前をエイリアスとして残す
+        alias = table.args["alias"].this if table.alias else table.this
+        table.replace(exp.Table(this=exp.to_identifier(_TARGET, quoted=True), alias=exp.TableAlias(this=alias.copy())))
+    return None
+
+
+def _check_columns(expression: exp.Expression, tables: Dict[str, List[str]], dialect: str) -> Optional[str]:
+    """カラム参照をスキーマと照合（エラーメッセージまたはNone）
+
+    大文字小文字の扱いはダイアレクトやサンプルの取得方法で異なるため、誤検知を避けて区別せずに照合する。
+    """
+    expression = expression.copy()
+    for identifier in expression.find_all(exp.Identifier):
+        # 引用符付きにしてダイアレクトごとの正規化（Snowflakeの大文字化など）を止める
+        identifier.set("this", identifier.name.lower())
+        identifier.set("quoted", True)
+    schema = MappingSchema(
+        {name: {col.lower(): "UNKNOWN" for col in columns} for name, columns in tables.items()},
+        dialect=dialect, normalize=False
+    )
+    try:
+        qualify(expression, schema=schema, dialect=dialect)
+    except SqlglotError as e:
+        if len(tables) == 1:
+            return f"{e}（使用できるカラム: {', '.join(tables[_TARGET])}）"
+        usable = " / ".join(f"{name}: {', '.join(columns)}" for name, columns in tables.items() if name != _TARGET)
+        return f"{e}（使用できるカラム: {usable}）"
+    return None
+
+
+def _dry_run(expression: exp.Expression, sample_df: pd.DataFrame, dtype_columns: Optional[Dict[str, str]],
+             relations: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
+    """サンプルを登録したDuckDBで試行実行
+
+    DuckDBにない関数や変換できない構文による失敗はウェアハウスでは成功し得るため、
+    カラムの解決やGROUP BYなどのバインドエラーのみを失敗とする。
+    """
+    try:
+        duckdb_sql = expression.sql(dialect="duckdb", unsupported_level=sqlglot.ErrorLevel.RAISE)
+    except SqlglotError:
+        return {"ok": True, "skipped": True, "sample_result": None}
+
+    conn = duckdb.connect()
+    try:
+        register_dataframe(conn, _TARGET, sample_df.head(PREFLIGHT_SAMPLE_ROWS), dtype_columns)
+        for name, df in relations.items():
+            register_dataframe(conn, name, df)
+        result = conn.execute(duckdb_sql).fetchdf()
+    except duckdb.BinderException as e:
+        # 置き換えたリレーション名がモデルに見えないよう、元のテーブル名（エイリアス）だけにする
+        return {"ok": False, "error": str(e).replace(f'"{_TARGET}" AS ', "")}
+    except duckdb.Error:
+        return {"ok": True, "skipped": True, "sample_result": None}
+    finally:
+        conn.close()
+    return {"ok": True, "skipped": False, "sample_result": result}
+
+
+def _uses_relations(expression: exp.Expression, relations: Dict[str, pd.DataFrame]) -> bool:
+    return any(not table.args.get("db") and table.name.lower() in relations for table in expression.find_all(exp.Table))
+
+
+def _try_parse_duckdb(sql: str) -> Optional[exp.Expression]:
+    try:
+        return sqlglot.parse_one(sql, read="duckdb")
+    except SqlglotError:
+        return None
+
+
+def _parse_error(error: SqlglotError) -> Dict[str, Any]:
+    return {"ok": False, "stage": "parse", "error": f"構文エラー: {_ANSI_ESCAPE.sub('', str(error))}", "sample_result": None}
+
+
+def preflight_sql(sql: str, dialect: str, table_ref: str, sample_df: pd.DataFrame,
+                  dtype_columns: Optional[Dict[str, str]] = None,
+                  relations: Optional[Dict[str, pd.DataFrame]] = None) -> Dict[str, Any]:
+    """生成SQLを事前検証
+
+    Args:
+        sql: 生成されたSQL
+        dialect: 対象のSQLダイアレクト
+        table_ref: 対象テーブルの完全修飾名（プロンプトに渡したもの）
+        sample_df: 取り込み済みのサンプル（ローカルファイルの場合は全データ）
+        dtype_columns: dtype最適化レポートの"columns"
+        relations: 対象テーブルのほかに参照できるDuckDBのリレーション {名前: DataFrame}（過去の結果など）。
+            これらを参照するSQLはDuckDBで実行されるものとしてDuckDBの構文で検証する
+
+    Returns:
+        {"ok": 成功したか, "stage": 失敗した段階（"parse", "schema", "dry_run"）, "error": エラーメッセージ,
+         "sample_result": サンプルでの実行結果（試行実行できなかった場合はNone）}
+    """
+    relations = {name.lower(): df for name, df in (relations or {}).items()}
+    try:
+        expression = sqlglot.parse_one(sql, read=dialect)
+        uses_relations = _uses_relations(expression, relations)
+    except SqlglotError as e:
+        # 過去の結果を参照するDuckDBのSQLは対象ダイアレクトでは解析できないことがある
+        duckdb_expression = _try_parse_duckdb(sql) if relations and dialect != "duckdb" else None
+        if duckdb_expression is None or not _uses_relations(duckdb_expression, relations):
+            return _parse_error(e)
+        expression, uses_relations = duckdb_expression, True
+
+    # 過去の結果を参照するSQLはDuckDBで実行するため、ウェアハウスのテーブルは一緒に参照できない
+    read_dialect = dialect
+    if uses_relations and dialect != "duckdb":
+        read_dialect = "duckdb"
+        try:
+            expression = sqlglot.parse_one(sql, read=read_dialect)
+        except SqlglotError as e:
+            return _parse_error(e)
+
+    table_error = _rewrite_target(expression, table_ref, dialect, relations, allow_target=read_dialect == dialect)
+    if table_error is not None:
+        return {"ok": False, "stage": "schema", "error": table_error, "sample_result": None}
+
+    tables = {_TARGET: [str(col) for col in sample_df.columns]}
+    tables.update({name: [str(col) for col in df.columns] for name, df in relations.items()})
+    column_error = _check_columns(expression, tables, read_dialect)
+    if column_error is not None:
+        return {"ok": False, "stage": "schema", "error": column_error, "sample_result": None}
+
+    dry_run = _dry_run(expression, sample_df, dtype_columns, relations)
+    if not dry_run["ok"]:
+        return {"ok": False, "stage": "dry_run", "error": dry_run["error"], "sample_result": None}
+    return {"ok": True, "stage": None, "error": None, "sample_result": dry_run["sample_result"]}
@@ -0,0 +1,66 @@
+"""
+過去の回答の結果をDuckDBのリレーションとして参照する
+チャット履歴の結果DataFrameを新しい順に prev_1, prev_2, ... として登録し、
+「東京だけにして」「その上位5件」のような絞り込みの質問をウェアハウスに問い合わせずにDuckDBで処理する
+"""
+from typing import Dict, List, Any, Optional
+import re
+import threading
+import duckdb
+import pandas as pd
+from src.application.dtype_optimizer import register_dataframe
+
+# プロンプトに含める過去の結果の最大件数
+PREVIOUS_RESULT_LIMIT = 5
+PREVIOUS_RESULT_PREFIX = "prev_"
+
+# 参照テーブルの解析専用（何も登録しない接続）
+_parser = duckdb.connect()
+_parser_lock = threading.Lock()
+
+
+def collect_previous_results(messages: List[Dict[str, Any]], limit: int = PREVIOUS_RESULT_LIMIT) -> Dict[str, Dict[str, Any]]:
+    """チャット履歴から結果のある回答を新しい順に取り出す
+
+    Returns:
+        {リレーション名: {"question", "sql", "df"}}（prev_1が直前の結果）
+    """
+    previous = {}
+    for message in reversed(messages):
+        if len(previous) >= limit:
+            break
+        if message.get("role") == "assistant" and isinstance(message.get("dataframe"), pd.DataFrame):
+            previous[f"{PREVIOUS_RESULT_PREFIX}{len(previous) + 1}"] = {
+                "question": message.get("question", ""),
+                "sql": message.get("sql", ""),
+                "df": message["dataframe"],
+            }
+    return previous
+
+
+def format_previous_results(previous: Dict[str, Dict[str, Any]]) -> str:
+    """過去の結果のリレーション名・元の質問・カラムをプロンプト用に整形"""
+    lines = []
+    for name, info in previous.items():
+        df = info["df"]
+        columns = ", ".join(f"{col} ({dtype})" for col, dtype in df.dtypes.astype(str).items())
+        lines.append(f"- {name}: 「{info['question']}」の結果（{len(df):,}行）カラム: {columns}")
+    return "\n".join(lines)
+
+
+def referenced_previous_results(sql: str, previous: Dict[str, Dict[str, Any]]) -> List[str]:
+    """SQLが参照している過去の結果のリレーション名"""
+    try:
+        with _parser_lock:
+            names = {name.lower() for name in _parser.get_table_names(sql)}
+    except duckdb.Error:
+        # 解析できない場合は単語一致で判定
+        return [name for name in previous if re.search(rf"\b{re.escape(name)}\b", sql, re.IGNORECASE)]
+    return [name for name in previous if name in names]
+
+
+def register_previous_results(conn: Any, previous: Dict[str, Dict[str, Any]],
+                              names: Optional[List[str]] = None) -> None:
+    """過去の結果をDuckDB接続にリレーションとして登録（DataFrameはコピーしない）"""
+    for name in names if names is not None else previous:
+        register_dataframe(conn, name, previous[name]["df"])
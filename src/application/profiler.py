@@ -0,0 +1,225 @@
+"""
+カラム統計プロファイラ
+生データ行の代わりにカラムごとのコンパクトな統計をプロンプトへ渡す
+"""
+from typing import Dict, List, Any, Optional
+from datetime import date, datetime
+import pandas as pd
+import duckdb
+from src.application.type_inference import column_kind
+
+
+# プッシュダウン集計に対応するダイアレクト
+REMOTE_DIALECTS = ("snowflake", "bigquery", "databricks")
+
+
+def quote_identifier(name: str, dialect: str) -> str:
+    """ダイアレクトに応じて識別子をクォート"""
+    if dialect in ("bigquery", "databricks"):
+        return "`" + str(name).replace("`", "``") + "`"
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCIIは4文字で1トークン、それ以外は1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def _format_value(value: Any, max_length: int = 30) -> str:
+    """統計値を短い文字列に整形"""
+    if isinstance(value, datetime):
+        if (value.hour, value.minute, value.second) == (0, 0, 0):
+            return value.strftime("%Y-%m-%d")
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    text = str(value)
+    if len(text) > max_length:
+        text = text[:max_length - 1] + "…"
+    return text
+
+
+class ColumnProfiler:
+    """カラムごとの統計（欠損率・カーディナリティ・最小/最大・頻出値）を計算"""
+
+    def __init__(self, top_k: int = 5, max_top_k_cardinality: int = 1000):
+        self.top_k = top_k
+        self.max_top_k_cardinality = max_top_k_cardinality
+
+    def profile_dataframe(self, df: pd.DataFrame) -> Dict[str, Any]:
+        """DuckDBの単一集計クエリでDataFrameをプロファイル
+
+        Args:
+            df: 対象のDataFrame
+
+        Returns:
+            {"row_count": int, "source": "sample", "columns": {カラム名: 統計}}
+        """
+        columns = {col: {"type": column_kind(df[col])} for col in df.columns}
+        row_count = len(df)
+
+        conn = duckdb.connect()
+        try:
+            conn.register("profile_target", df)
+            stats = self._aggregate(conn, "profile_target", columns, "duckdb")
+        except Exception:
+            # DuckDBが扱えない型が含まれる場合は欠損率のみ計算
+            stats = None
+        finally:
+            conn.close()
+
+        if stats is not None:
+            row_count = stats["row_count"]
+            for col, col_stats in stats["columns"].items():
+                columns[col].update(col_stats)
+        else:
+            null_rates = df.isna().mean() if row_count else pd.Series(0.0, index=df.columns)
+            for col in df.columns:
+                columns[col]["null_rate"] = float(null_rates[col])
+
+        for col, info in columns.items():
+            if info["type"] in ("STRING", "BOOLEAN"):
+                distinct = info.get("distinct")
+                if distinct is not None and distinct <= self.max_top_k_cardinality:
+                    info["top_values"] = self._top_values(df[col])
+
+        return {"row_count": row_count, "source": "sample", "columns": columns}
+
+    def profile_remote(self, connector: Any, table_ref: str, sample_df: pd.DataFrame, dialect: str) -> Dict[str, Any]:
+        """ウェアハウスに1本の集計クエリをプッシュダウンしてプロファイル
+
+        頻出値はサンプルから計算し、件数・欠損率・カーディナリティ・最小/最大はテーブル全体の値で上書きする。
+
+        Args:
+            connector: execute_queryを持つコネクタ
+            table_ref: 完全修飾テーブル名
+            sample_df: 取得済みのサンプルデータ
+            dialect: "snowflake", "bigquery", "databricks"
+
+        Returns:
+            profile_dataframeと同じ形式のプロファイル（sourceは"remote"）
+        """
+        profile = self.profile_dataframe(sample_df)
+        stats = self._aggregate(connector, table_ref, profile["columns"], dialect)
+        profile["row_count"] = stats["row_count"]
+        for col, col_stats in stats["columns"].items():
+            profile["columns"][col].update({k: v for k, v in col_stats.items() if v is not None})
+        profile["source"] = "remote"
+        return profile
+
+    def _aggregate(self, executor: Any, table_ref: str, columns: Dict[str, Dict[str, Any]], dialect: str) -> Dict[str, Any]:
+        """全カラムの統計を1回の集計クエリで取得（カーディナリティはHyperLogLogによる近似）"""
+        select_items = ["COUNT(*)"]
+        for col, info in columns.items():
+            quoted = quote_identifier(col, dialect)
+            # BigQueryのFLOAT64はAPPROX_COUNT_DISTINCTの対象外
+            if dialect == "bigquery" and info["type"] == "FLOAT":
+                distinct_expr = "NULL"
+            else:
+                distinct_expr = f"APPROX_COUNT_DISTINCT({quoted})"
+            select_items.extend([
+                f"COUNT({quoted})",
+                distinct_expr,
+                f"MIN({quoted})",
+                f"MAX({quoted})",
+            ])
+        query = f"SELECT {', '.join(select_items)} FROM {table_ref}"
+
+        if dialect == "duckdb":
+            row = executor.execute(query).fetchone()
+        else:
+            row = executor.execute_query(query).iloc[0].tolist()
+
+        row_count = int(row[0] or 0)
+        stats = {"row_count": row_count, "columns": {}}
+        for i, col in enumerate(columns):
+            non_null, distinct, min_value, max_value = row[1 + i * 4: 5 + i * 4]
+            non_null = int(non_null or 0)
+            stats["columns"][col] = {
+                "null_rate": (row_count - non_null) / row_count if row_count else 0.0,
+                # HyperLogLogの誤差で非NULL件数を超えないように丸める
+                "distinct": min(int(distinct), non_null) if distinct is not None else None,
+                "min": min_value,
+                "max": max_value,
+            }
+        return stats
+
+    def _top_values(self, series: pd.Series) -> List[tuple]:
+        """頻出値と件数の上位k件"""
+        try:
+            counts = series.value_counts(dropna=True).head(self.top_k)
+        except TypeError:
+            # リストなどハッシュ不可能な値
+            return []
+        return [(value, int(count)) for value, count in counts.items()]
+
+
+def get_source_profile(active_data: Dict[str, Any], dialect: str, connector: Any, table_ref: str) -> Dict[str, Any]:
+    """データソースのカラム統計を取得（データソースごとにキャッシュ）"""
+    if 'profile' not in active_data:
+        profiler = ColumnProfiler()
+        profile = None
+        if dialect in REMOTE_DIALECTS and table_ref != "data" and hasattr(connector, 'execute_query'):
+            try:
+                profile = profiler.profile_remote(connector, table_ref, active_data['df'], dialect)
+            except Exception:
+                # プッシュダウンに失敗した場合はサンプルから計算
+                profile = None
+        if profile is None:
+            profile = profiler.profile_dataframe(active_data['df'])
+        active_data['profile'] = profile
+    return active_data['profile']
+
+
+def format_schema_summary(profile: Dict[str, Any], max_tokens: int = 1500) -> str:
+    """プロファイルをトークン予算内のスキーマ要約テキストに変換
+
+    予算を超える場合はまず頻出値を省き、それでも超える場合は末尾のカラムを省略する。
+
+    Args:
+        profile: ColumnProfilerが返すプロファイル
+        max_tokens: 要約に使うトークン数の上限（概算）
+
+    Returns:
+        プロンプトに埋め込むテキスト
+    """
+    header = f"総行数: {profile['row_count']:,}"
+    if profile.get("source") == "sample":
+        header += "（サンプル）"
+
+    def column_line(col: str, info: Dict[str, Any], with_top_values: bool) -> str:
+        parts = [f"- {col} ({info['type']})"]
+        if "null_rate" in info:
+            parts.append(f"欠損率{info['null_rate']:.0%}")
+        if info.get("distinct") is not None:
+            parts.append(f"ユニーク数≈{info['distinct']:,}")
+        if info.get("min") is not None and info.get("max") is not None:
+            label = "期間" if info["type"] == "TIMESTAMP" else "範囲"
+            parts.append(f"{label}: {_format_value(info['min'])}〜{_format_value(info['max'])}")
+        if with_top_values and info.get("top_values"):
+            values = ", ".join(f"{_format_value(v)}({c})" for v, c in info["top_values"])
+            parts.append(f"頻出値: {values}")
+        return " ".join(parts)
+
+    items = list(profile["columns"].items())
+    for with_top_values in (True, False):
+        lines = [header] + [column_line(col, info, with_top_values) for col, info in items]
+        text = "\n".join(lines)
+        if estimate_tokens(text) <= max_tokens:
+            return text
+
+    # カラム数が多すぎる場合は予算内に収まる分だけ残す
+    lines = [header]
+    used = estimate_tokens(header)
+    for i, (col, info) in enumerate(items):
+        line = column_line(col, info, False)
+        cost = estimate_tokens(line)
+        if used + cost > max_tokens:
+            lines.append(f"...他{len(items) - i}列（省略）")
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
@@ -0,0 +1,199 @@
+"""
+リモートテーブルのプッシュダウン計画
+生成されたDuckDB SQLからリモートリレーションごとに必要なカラムとフィルタ条件を抽出し、
+各ウェアハウスのダイアレクトで最小限のSELECTを組み立てる
+1つのリモートリレーションだけを参照するクエリは、集計を含めてクエリ全体をウェアハウスで実行する
+"""
+from typing import Dict, List, Any, Optional
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ErrorLevel, SqlglotError
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.optimizer.pushdown_projections import pushdown_projections
+from sqlglot.optimizer.scope import traverse_scope
+
+
+def _conjuncts(condition: exp.Expression) -> List[exp.Expression]:
+    """AND で結合された条件を分解"""
+    if isinstance(condition, exp.And):
+        return list(condition.flatten())
+    return [condition]
+
+
+def _is_pushable(condition: exp.Expression, alias: str) -> bool:
+    """条件がこのリレーションのカラムだけで評価できるか（サブクエリ・集計・乱数を含まない）"""
+    if condition.find(exp.Select, exp.AggFunc, exp.Window, exp.Rand):
+        return False
+    columns = list(condition.find_all(exp.Column))
+    return bool(columns) and all(col.table == alias for col in columns)
+
+
+def _is_null_supplying(select: exp.Select, alias: str) -> bool:
+    """外部結合でNULL補完される側かどうか（その場合WHERE条件を事前に適用すると結果が変わり得る）"""
+    for join in select.args.get("joins") or []:
+        side = (join.side or "").upper()
+        joined_alias = join.this.alias_or_name
+        if side in ("LEFT", "FULL") and joined_alias == alias:
+            return True
+        if side in ("RIGHT", "FULL") and joined_alias != alias:
+            return True
+    return False
+
+
+def plan_pushdown(sql: str, relation_columns: Dict[str, List[str]], remote: Dict[str, Dict[str, str]],
+                  limit: Optional[int] = None) -> Optional[Dict[str, Dict[str, Any]]]:
+    """DuckDB SQLからリモートリレーションごとの取得クエリを計画
+
+    Args:
+        sql: 共有DuckDBセッションで実行するSQL
+        relation_columns: 全リレーションのカラム名 {リレーション名: [カラム名]}
+        remote: リモートリレーションの情報 {リレーション名: {"table_ref", "dialect"}}
+        limit: リモートから取得する行数の上限
+
+    Returns:
+        参照されたリモートリレーションごとの計画
+        {リレーション名: {"sql": リモートで実行するSQL, "columns": [カラム名], "predicates": [条件]}}
+        SQLを解析できない場合はNone
+    """
+    schema = {relation: {col: "UNKNOWN" for col in columns} for relation, columns in relation_columns.items()}
+    try:
+        expression = qualify(sqlglot.parse_one(sql, read="duckdb"), schema=schema, dialect="duckdb")
+        # CTEやサブクエリで使われていないカラムを落とす
+        expression = pushdown_projections(expression)
+        scopes = list(traverse_scope(expression))
+    except SqlglotError:
+        return None
+
+    # リモートリレーションの出現箇所ごとのエイリアスとプッシュ可能な条件
+    aliases: Dict[str, set] = {}
+    occurrences: Dict[str, List[Optional[exp.Expression]]] = {}
+    for scope in scopes:
+        for alias, (node, source) in scope.selected_sources.items():
+            if not isinstance(source, exp.Table) or source.name not in remote:
+                continue
+            relation = source.name
+            aliases.setdefault(relation, set()).add(alias)
+            predicate = None
+            select = scope.expression
+            where = select.args.get("where") if isinstance(select, exp.Select) else None
+            if where is not None and not _is_null_supplying(select, alias):
+                pushable = [cond for cond in _conjuncts(where.this) if _is_pushable(cond, alias)]
+                if pushable:
+                    predicate = exp.and_(*[cond.copy() for cond in pushable])
+            occurrences.setdefault(relation, []).append(predicate)
+
+    # 同じエイリアスが別のテーブルを指す場合はカラムを特定できない
+    ambiguous = set()
+    for scope in scopes:
+        for alias, (node, source) in scope.selected_sources.items():
+            for relation, relation_aliases in aliases.items():
+                if alias in relation_aliases and not (isinstance(source, exp.Table) and source.name == relation):
+                    ambiguous.add(relation)
+
+    plans = {}
+    for relation, predicates in occurrences.items():
+        # DuckDBの識別子は大文字小文字を区別しないため、実際のカラム名に戻す
+        actual_names = {col.lower(): col for col in relation_columns[relation]}
+        if relation in ambiguous:
+            columns = list(relation_columns[relation])
+        else:
+            used = {col.name.lower() for col in expression.find_all(exp.Column) if col.table in aliases[relation]}
+            columns = [actual_names[name] for name in actual_names if name in used]
+            if not columns:
+                # COUNT(*)のみなど、行数だけが必要な場合
+                columns = list(relation_columns[relation])[:1]
+
+        # 全出現箇所で条件がある場合のみOR結合して適用
+        predicate = None
+        if all(p is not None for p in predicates) and relation not in ambiguous:
+            predicate = exp.or_(*predicates) if len(predicates) > 1 else predicates[0]
+            predicate = predicate.transform(
+                lambda node: exp.column(actual_names.get(node.name.lower(), node.name), quoted=True)
+                if isinstance(node, exp.Column) else node
+            )
+
+        dialect = remote[relation]["dialect"]
+        query = exp.select(*[exp.column(col, quoted=True) for col in columns]).from_(
+            exp.to_table(remote[relation]["table_ref"], dialect=dialect)
+        )
+        if limit:
+            query = query.limit(limit)
+        remote_sql = query.sql(dialect=dialect)
+        if predicate is not None:
+            try:
+                remote_sql = query.where(predicate).sql(dialect=dialect, unsupported_level=ErrorLevel.RAISE)
+            except SqlglotError:
+                # リモートのダイアレクトに変換できない条件はDuckDB側だけで評価する
+                predicate = None
+        plans[relation] = {
+            "sql": remote_sql,
+            "columns": columns,
+            "predicates": [cond.sql(dialect=dialect) for cond in _conjuncts(predicate)] if predicate is not None else [],
+        }
+    return plans
+
+
+def plan_remote_query(sql: str, relation: str, columns: List[str], table_ref: str, dialect: str,
+                      limit: Optional[int] = None) -> Optional[str]:
+    """1つのリモートリレーションだけを参照するDuckDB SQLを、クエリ全体をリモートで実行するSQLに変換
+
+    集計・結合・並べ替えをウェアハウスで行うため、取得するのは結果の行だけになる。
+
+    Args:
+        sql: 共有DuckDBセッションで実行するSQL
+        relation: 参照しているリモートリレーション名
+        columns: リレーションのカラム名（実際の大文字小文字）
+        table_ref: リモートの完全修飾テーブル名
+        dialect: リモートのSQLダイアレクト
+        limit: リモートから取得する行数の上限（クエリにより小さいLIMITがあればそちらを使う）
+
+    Returns:
+        リモートで実行するSQL（他のテーブルを参照する、またはダイアレクトに変換できない場合はNone）
+    """
+    try:
+        expression = sqlglot.parse_one(sql, read="duckdb")
+    except SqlglotError:
+        return None
+    if not isinstance(expression, (exp.Select, exp.Union)):
+        return None
+    cte_names = {cte.alias_or_name for cte in expression.find_all(exp.CTE)}
+    tables = [table for table in expression.find_all(exp.Table) if table.name not in cte_names]
+    if not tables or any(table.name != relation or table.db for table in tables):
+        return None
+
+    actual_names = {col.lower(): col for col in columns}
+    output_names = {alias.alias.lower(): alias.alias for alias in expression.find_all(exp.Alias)}
+
+    def transform(node: exp.Expression) -> exp.Expression:
+        if isinstance(node, exp.Table) and node.name == relation and not node.db:
+            remote_table = exp.to_table(table_ref, dialect=dialect)
+            # 列の修飾（relation.col）が引き続き解決できるよう、元の名前をエイリアスにする
+            remote_table.set("alias", exp.TableAlias(this=exp.to_identifier(node.alias or relation)))
+            return remote_table
+        if isinstance(node, exp.Column):
+            name = node.name.lower()
+            if not node.table and name in output_names and node.find_ancestor(exp.Ordered):
+                # ORDER BYの結果カラム名の参照（エイリアスと同じくクォートする）
+                return exp.column(output_names[name], quoted=True)
+            if name in actual_names:
+                # DuckDBの識別子は大文字小文字を区別しないため、実際のカラム名をクォートして指定する
+                return exp.Column(this=exp.to_identifier(actual_names[name], quoted=True), table=node.args.get("table"))
+        if isinstance(node, exp.Alias):
+            # 結果のカラム名の大文字小文字をDuckDBで実行した場合と揃える
+            node.set("alias", exp.to_identifier(node.alias, quoted=True))
+        return node
+
+    expression = expression.transform(transform)
+    if limit:
+        existing = expression.args.get("limit")
+        bound = existing.expression if isinstance(existing, exp.Limit) else None
+        if isinstance(expression, exp.Select) and not (isinstance(bound, exp.Literal) and bound.is_int
+                                                       and int(bound.this) <= limit):
+            expression = expression.limit(limit)
+        elif not isinstance(expression, exp.Select):
+            # UNIONはサブクエリにして全体に上限をかける
+            expression = exp.select("*").from_(expression.subquery("q")).limit(limit)
+    try:
+        return expression.sql(dialect=dialect, unsupported_level=ErrorLevel.RAISE)
+    except SqlglotError:
+        return None
@@ -0,0 +1,268 @@
+"""
+クエリジョブ管理
+ウェアハウスへの長時間クエリを有限スレッドプールで実行し、再実行（rerun）をまたいで状態を保持する
+"""
+from typing import Dict, List, Any, Optional, Callable
+from concurrent.futures import ThreadPoolExecutor, Future
+import contextvars
+import threading
+import time
+import uuid
+import pandas as pd
+from src.infrastructure.connectors.base import QueryHandle, QUERY_RUNNING
+from src.infrastructure.singleflight import query_flights
+
+
+class QueryJob:
+    """1件のクエリ実行ジョブ"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    CANCELLING = "cancelling"  # キャンセル要求済み（ワーカーが終了するまでは実行中として扱う）
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, owner: str, sql: str, label: str = ""):
+        self.id = uuid.uuid4().hex[:12]
+        self.owner = owner
+        self.sql = sql
+        self.label = label
+        self.status = self.QUEUED
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.rows_fetched = 0
+        self.query_id: Optional[str] = None  # ウェアハウス側のクエリID（非同期実行時）
+        self.result: Optional[pd.DataFrame] = None
+        self.error: Optional[str] = None
+        self._cancel: Optional[Callable[[], None]] = None
+        self._future: Optional[Future] = None
+        # 状態遷移（キャンセル要求とワーカーの開始・終了）の排他
+        self._lock = threading.Lock()
+
+    @property
+    def is_finished(self) -> bool:
+        """終了済み（成功・失敗・キャンセル）かどうか"""
+        return self.status in (self.SUCCEEDED, self.FAILED, self.CANCELLED)
+
+    @property
+    def elapsed(self) -> float:
+        """実行開始からの経過秒数（キュー待ち中は0）"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def add_rows(self, count: int) -> None:
+        """取得済み行数を加算（進捗表示用）"""
+        self.rows_fetched += count
+
+
+class QueryJobManager:
+    """有限スレッドプールでクエリジョブを実行・管理"""
+
+    def __init__(self, max_workers: int = 8, max_jobs_per_owner: int = 2, retention_seconds: float = 3600):
+        self.max_jobs_per_owner = max_jobs_per_owner
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-job")
+        self._jobs: Dict[str, QueryJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, owner: str, sql: str, run: Callable[["QueryJob"], pd.DataFrame],
+               cancel: Optional[Callable[[], None]] = None, label: str = "") -> QueryJob:
+        """ジョブを投入
+
+        Args:
+            owner: ジョブの所有者（ユーザー/セッションID）
+            sql: 実行するSQL（表示用）
+            run: ジョブを受け取り結果DataFrameを返す関数（進捗はjob.add_rowsで報告）
+            cancel: 実行中のクエリをドライバー経由で中断する関数
+            label: 表示用ラベル（質問文など）
+
+        Returns:
+            投入したジョブ
+
+        Raises:
+            RuntimeError: 所有者の同時実行数が上限に達している場合
+        """
+        job = QueryJob(owner, sql, label)
+        job._cancel = cancel
+        with self._lock:
+            self._prune()
+            active = [j for j in self._jobs.values() if j.owner == owner and not j.is_finished]
+            if len(active) >= self.max_jobs_per_owner:
+                raise RuntimeError(f"同時に実行できるクエリは{self.max_jobs_per_owner}件までです")
+            self._jobs[job.id] = job
+            # 投入元のコンテキスト（計測中のトレースなど）をワーカーに引き継ぐ
+            context = contextvars.copy_context()
+            job._future = self._executor.submit(context.run, self._run, job, run)
+        return job
+
+    def get(self, job_id: str) -> Optional[QueryJob]:
+        """ジョブを取得"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self, owner: str) -> List[QueryJob]:
+        """所有者のジョブ一覧（新しい順）"""
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.owner == owner]
+        return sorted(jobs, key=lambda j: j.submitted_at, reverse=True)
+
+    def cancel(self, job_id: str) -> bool:
+        """ジョブをキャンセル（キュー待ちなら取り消し、実行中ならドライバーのキャンセルAPIを呼ぶ）
+
+        実行中のジョブはCANCELLINGになり、ワーカーが実際に終了した時点でCANCELLEDになる。
+        それまでは所有者の同時実行数に数える（キャンセルに対応しないコネクタでもスレッドを占有し続けるため）。
+        """
+        job = self.get(job_id)
+        if job is None:
+            return False
+        with job._lock:
+            if job.is_finished or job.status == QueryJob.CANCELLING:
+                return False
+            if job._future is not None and job._future.cancel():
+                job.status = QueryJob.CANCELLED
+                job.finished_at = time.time()
+                return True
+            job.status = QueryJob.CANCELLING
+        if job._cancel is not None:
+            try:
+                job._cancel()
+            except Exception as e:
+                job.error = f"キャンセル要求に失敗しました: {e}"
+        return True
+
+    def pop(self, job_id: str) -> Optional[QueryJob]:
+        """終了したジョブを取り出して管理対象から外す"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.is_finished:
+                del self._jobs[job_id]
+            return job
+
+    def _run(self, job: QueryJob, run: Callable[[QueryJob], pd.DataFrame]) -> None:
+        """ワーカースレッドでジョブを実行（キャンセル要求済みなら終了時にCANCELLEDにする）"""
+        with job._lock:
+            if job.status in (QueryJob.CANCELLING, QueryJob.CANCELLED):
+                job.status = QueryJob.CANCELLED
+                job.finished_at = time.time()
+                return
+            job.status = QueryJob.RUNNING
+            job.started_at = time.time()
+        result, error = None, None
+        try:
+            result = run(job)
+        except Exception as e:
+            error = str(e)
+        with job._lock:
+            if job.status == QueryJob.CANCELLING:
+                job.status = QueryJob.CANCELLED
+            elif error is not None:
+                job.error = error
+                job.status = QueryJob.FAILED
+            else:
+                job.result = result
+                job.rows_fetched = len(result)
+                job.status = QueryJob.SUCCEEDED
+            job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        """保持期間を過ぎた終了済みジョブを破棄（ロック取得済みで呼ぶ）"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.is_finished and job.finished_at and now - job.finished_at > self.retention_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+def _shared_cancel(connector: Any, key: Any, cancel: Callable[[], None]) -> Callable[[], None]:
+    """共有実行中のクエリは、他に結果を待っている呼び出し元がいなければ中断する"""
+    def shared_cancel() -> None:
+        if query_flights.waiters(key) <= 1:
+            cancel()
+
+    return shared_cancel
+
+
+def make_sync_runner(connector: Any, sql: str):
+    """execute_queryで実行するコネクタ用の実行関数とキャンセル関数を作る
+
+    同じ接続先・認証主体で同じSQLが実行中なら、その結果を共有する。
+    キャンセルはこのジョブのクエリ（カーソル/ジョブ/クエリID）だけを中断し、同じ接続の他のクエリは中断しない。
+
+    Returns:
+        (run, cancel) QueryJobManager.submitに渡す関数
+    """
+    handle = QueryHandle()
+
+    def run(job: QueryJob) -> pd.DataFrame:
+        return connector.execute_query_shared(sql, progress=job.add_rows, handle=handle)
+
+    return run, _shared_cancel(connector, connector.coalesce_key(sql), handle.cancel)
+
+
+def make_federated_runner(federation: Any, sql: str):
+    """データソース横断のクエリ（FederationEngine）用の実行関数とキャンセル関数を作る
+
+    キャンセルは、このジョブが実行中のリモート取得（ウェアハウスのクエリ）またはDuckDBでの実行だけを中断する。
+
+    Returns:
+        (run, cancel) QueryJobManager.submitに渡す関数
+    """
+    handle = QueryHandle()
+
+    def run(job: QueryJob) -> pd.DataFrame:
+        return federation.execute(sql, handle=handle)
+
+    return run, handle.cancel
+
+
+def make_async_runner(connector: Any, sql: str, poll_interval: float = 0.5, max_poll_interval: float = 5.0):
+    """submit/poll/fetchに対応したコネクタ用の実行関数とキャンセル関数を作る
+
+    クエリはサーバー側で実行され、ワーカーは状態をポーリングするだけなので実行中は接続を占有しない。
+    同じ接続先・認証主体で同じSQLが実行中なら、新たに投入せずその結果を共有する。
+
+    Args:
+        connector: submit_query/get_query_status/fetch_query_resultを持つコネクタ
+        sql: 実行するSQL
+        poll_interval: 最初のポーリング間隔（秒）
+        max_poll_interval: ポーリング間隔の上限（秒）
+
+    Returns:
+        (run, cancel) QueryJobManager.submitに渡す関数
+    """
+    state = {"query_id": None}
+    key = connector.coalesce_key(sql)
+
+    def execute(job: QueryJob) -> pd.DataFrame:
+        query_id = connector.submit_query(sql)
+        state["query_id"] = job.query_id = query_id
+        interval = poll_interval
+        while connector.get_query_status(query_id) == QUERY_RUNNING:
+            time.sleep(interval)
+            interval = min(interval * 1.5, max_poll_interval)
+        return connector.fetch_query_result(query_id, progress=job.add_rows)
+
+    def run(job: QueryJob) -> pd.DataFrame:
+        return query_flights.do(key, lambda: execute(job))
+
+    def cancel() -> None:
+        if state["query_id"] is not None:
+            connector.cancel_query(state["query_id"])
+
+    return run, _shared_cancel(connector, key, cancel)
+
+
+_manager: Optional[QueryJobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_query_job_manager() -> QueryJobManager:
+    """プロセス全体で共有するジョブマネージャーを取得"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = QueryJobManager()
+        return _manager
@@ -0,0 +1,82 @@
+"""
+結果表示のページング
+結果のDataFrameをDuckDBに（コピーせずに）登録し、並べ替え・絞り込み・件数の計算をDuckDBで行って、
+表示するページの行だけをブラウザに送る。100万行の結果でも1ページ分の数KBしか転送しない。
+"""
+from typing import Dict, List, Any, Optional
+import os
+import duckdb
+import pandas as pd
+from src.infrastructure.tracing import span, set_attributes
+
+# 1ページの行数（既定値と選択肢）
+DEFAULT_PAGE_SIZE = int(os.getenv("FLASHVIZ_RESULT_PAGE_SIZE", "100"))
+PAGE_SIZE_OPTIONS = sorted({20, 50, 100, 500, 1000, DEFAULT_PAGE_SIZE})
+
+
+def _quote(name: Any) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _filter_condition(columns: List[Any], filter_column: Optional[Any]) -> str:
+    """絞り込み条件（指定カラム、省略時はいずれかのカラムに文字列を含む、大文字小文字を区別しない）"""
+    targets = [filter_column] if filter_column is not None else columns
+    return " OR ".join(f"CAST({_quote(col)} AS VARCHAR) ILIKE $pattern ESCAPE '\\'" for col in targets)
+
+
+def fetch_result_page(df: pd.DataFrame, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+                      sort_column: Optional[Any] = None, descending: bool = False,
+                      filter_text: str = "", filter_column: Optional[Any] = None) -> Dict[str, Any]:
+    """並べ替え・絞り込みをDuckDBで実行し、指定ページの行だけを取得
+
+    Args:
+        df: 結果のDataFrame（コピーせずにDuckDBへ登録する）
+        page: ページ番号（1始まり、範囲外は最初・最後のページに丸める）
+        page_size: 1ページの行数
+        sort_column: 並べ替えるカラム（Noneなら元の順序）
+        descending: 降順にするか
+        filter_text: 絞り込む文字列（部分一致、空なら絞り込まない）
+        filter_column: 絞り込むカラム（Noneなら全カラムのいずれか）
+
+    Returns:
+        {"rows": ページの行（DataFrame）, "total": 絞り込み後の行数, "page": ページ番号, "pages": ページ数,
+         "start": 先頭行の番号（0始まり）}
+    """
+    page_size = max(1, int(page_size))
+    where = ""
+    params: Dict[str, Any] = {}
+    if filter_text and len(df.columns) > 0:
+        escaped = filter_text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where = f" WHERE {_filter_condition(list(df.columns), filter_column)}"
+        params["pattern"] = f"%{escaped}%"
+    # 同じ値の行の順序がページ間で変わらないよう、元の行番号を第2キーにする
+    order = f" ORDER BY {_quote(sort_column)} {'DESC' if descending else 'ASC'} NULLS LAST, __row" \
+        if sort_column is not None else ""
+
+    with span("result_grid.fetch", rows=len(df)):
+        if not where and not order:
+            # 並べ替え・絞り込みがなければDataFrameから直接切り出す
+            total = len(df)
+            pages = max(1, -(-total // page_size))
+            page = min(max(1, int(page)), pages)
+            start = (page - 1) * page_size
+            rows = df.iloc[start:start + page_size]
+        else:
+            conn = duckdb.connect()
+            try:
+                conn.register("__result", df)
+                # 絞り込みのみの場合は挿入順が保たれるため行番号は付けない
+                row_number = ", row_number() OVER () AS __row" if order else ""
+                conn.execute(f"CREATE TEMP VIEW result AS SELECT *{row_number} FROM __result")
+                total = conn.execute(f"SELECT count(*) FROM result{where}", params).fetchone()[0] if where else len(df)
+                pages = max(1, -(-total // page_size))
+                page = min(max(1, int(page)), pages)
+                start = (page - 1) * page_size
+                columns = "* EXCLUDE (__row)" if order else "*"
+                rows = conn.execute(
+                    f"SELECT {columns} FROM result{where}{order} LIMIT {page_size} OFFSET {start}", params
+                ).fetchdf()
+            finally:
+                conn.close()
+        set_attributes(total=total, page=page)
+    return {"rows": rows, "total": total, "page": page, "pages": pages, "start": start}
@@ -0,0 +1,246 @@
+"""
+SQL生成パイプラインの共通部品
+ダイアレクト別のプロンプト、SQLの安全性チェック、事前検証エラーの修正プロンプト、要約プロンプト、MCPツール呼び出し用のメッセージ組み立て
+"""
+from typing import Dict, List, Any
+import re
+import pandas as pd
+
+
+SQL_SYSTEM_PROMPT = "あなたはSQL生成の専門家です。"
+SUMMARY_SYSTEM_PROMPT = "あなたはデータ分析の専門家です。"
+SQL_MODEL = "gpt-5-nano"
+MCP_MODEL = "gpt-4o"
+# MCPの会話で送る過去メッセージの最大件数
+MCP_HISTORY_LIMIT = 10
+
+
+def is_safe_query(sql: str) -> tuple[bool, str]:
+    """
+    SELECT文のみを許可するバリデーション
+
+    Returns:
+        (bool, str): (安全かどうか, エラーメッセージ)
+    """
+    sql_stripped = sql.strip()
+    if not sql_stripped:
+        return False, "SQLクエリが空です"
+
+    # 大文字に変換してチェック（コメントや文字列リテラルを考慮）
+    sql_upper = sql_stripped.upper()
+
+    # WITH句（CTE）をサポート
+    if sql_upper.startswith('WITH'):
+        # WITH句の場合、最終的なSELECTがあるかチェック
+        if 'SELECT' not in sql_upper:
+            return False, "WITH句の後にSELECT文が必要です"
+    elif not sql_upper.startswith('SELECT'):
+        return False, "SELECT文のみ実行可能です"
+
+    # 危険なキーワードをチェック
+    dangerous_keywords = [
+        'UPDATE', 'DELETE', 'DROP', 'INSERT', 'CREATE',
+        'ALTER', 'TRUNCATE', 'GRANT', 'REVOKE', 'EXEC',
+        'EXECUTE', 'MERGE', 'REPLACE'
+    ]
+
+    for keyword in dangerous_keywords:
+        # 単語境界を考慮（例: SELECT内の"UPDATE"は許可）
+        pattern = r'\b' + keyword + r'\b'
+        if re.search(pattern, sql_upper):
+            return False, f"危険なSQL操作が検出されました: {keyword}"
+
+    return True, ""
+
+
+def build_table_ref(active_data: Dict[str, Any], dialect: str, connector: Any) -> str:
+    """データソース情報からダイアレクトに応じた完全修飾テーブル名を組み立てる"""
+    if dialect == 'snowflake' and all(k in active_data for k in ('database', 'schema', 'table')):
+        return f"{active_data['database']}.{active_data['schema']}.{active_data['table']}"
+    if dialect == 'bigquery' and 'dataset' in active_data and 'table' in active_data:
+        # BigQueryのconnectorからproject_idを取得
+        project_id = getattr(getattr(connector, 'connection', None), 'project', None)
+        if project_id:
+            return f"`{project_id}.{active_data['dataset']}.{active_data['table']}`"
+        return f"{active_data['dataset']}.{active_data['table']}"
+    if dialect == 'databricks' and all(k in active_data for k in ('catalog', 'schema', 'table')):
+        return f"{active_data['catalog']}.{active_data['schema']}.{active_data['table']}"
+    if active_data.get('type') == 'local_file' and 'table' in active_data:
+        # ディレクトリ・globのローカルファイルはコネクタのビュー名
+        return active_data['table']
+    return "data"
+
+
+def build_sql_prompt(dialect: str, table_ref: str, schema_summary: str, question: str,
+                     previous_results: str = "") -> str:
+    """ダイアレクト別のSQL生成プロンプトを組み立てる
+
+    previous_resultsを渡すと、過去の回答の結果（prev_1, prev_2, ...）を対象にしたDuckDB SQLも生成できるようにする
+    """
+    prompt = _build_single_source_prompt(dialect, table_ref, schema_summary, question)
+    if not previous_results:
+        return prompt
+    if dialect in ('snowflake', 'bigquery', 'databricks'):
+        combine_rule = f"- 過去の結果のテーブルと{table_ref}を同じクエリで使わないこと"
+    else:
+        combine_rule = f"- 必要に応じて過去の結果のテーブルと{table_ref}を結合してよい"
+    return prompt + f"""
+過去の回答の結果（DuckDBのテーブルとして参照可能、prev_1が直前の結果）:
+{previous_results}
+
+- 質問が過去の結果の絞り込み・並べ替え・上位N件・再集計などで答えられる場合は、上記のテーブルのみを使うDuckDB SQLを生成すること
+{combine_rule}
+"""
+
+
+def _build_single_source_prompt(dialect: str, table_ref: str, schema_summary: str, question: str) -> str:
+    if dialect == 'snowflake':
+        return f"""
+以下のテーブル情報を基に、ユーザーの質問に答えるSnowflake SQLクエリを生成してください。
+
+テーブル名: {table_ref}
+カラム統計:
+{schema_summary}
+
+ユーザーの質問: {question}
+
+重要な指示:
+- Snowflakeの構文を使用すること
+- **カラム名が小文字の場合は必ずダブルクォートで囲むこと** (例: "name", "user_id")
+- 大文字のカラム名はダブルクォート不要 (例: NAME, USER_ID)
+- エイリアス（AS句）も小文字の場合はダブルクォートで囲むこと
+- 日付関数: DATE_TRUNC(), DATEADD(), DATEDIFF()など
+- 文字列関数: CONCAT(), SPLIT_PART(), REGEXP_SUBSTR()など
+- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
+- SQLクエリのみを返す（説明は不要）
+"""
+    if dialect == 'bigquery':
+        return f"""
+以下のテーブル情報を基に、ユーザーの質問に答えるBigQuery SQLクエリを生成してください。
+
+テーブル名: {table_ref}
+カラム統計:
+{schema_summary}
+
+ユーザーの質問: {question}
+
+重要な指示:
+- BigQueryの標準SQL構文を使用すること
+- 日付関数: DATE_TRUNC(), DATE_ADD(), DATE_DIFF()など
+- ARRAY、STRUCTなどの複雑な型も考慮
+- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
+- SQLクエリのみを返す（説明は不要）
+"""
+    if dialect == 'databricks':
+        return f"""
+以下のテーブル情報を基に、ユーザーの質問に答えるDatabricks SQLクエリを生成してください。
+
+テーブル名: {table_ref}
+カラム統計:
+{schema_summary}
+
+ユーザーの質問: {question}
+
+重要な指示:
+- Databricksの構文を使用すること（Spark SQLベース）
+- 日付関数: date_trunc(), date_add(), datediff()など
+- カタログ.スキーマ.テーブル形式の完全修飾名を使用
+- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
+- SQLクエリのみを返す（説明は不要）
+"""
+    # DuckDB (デフォルト)
+    return f"""
+以下のテーブル情報を基に、ユーザーの質問に答えるDuckDB SQLクエリを生成してください。
+
+テーブル名: {table_ref}
+カラム統計:
+{schema_summary}
+
+ユーザーの質問: {question}
+
+重要な指示:
+- DuckDBの構文を使用すること
+- 日付型のカラムはCAST(column_name AS DATE)を使用
+- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
+- SQLクエリのみを返す（説明は不要）
+"""
+
+
+def build_federated_sql_prompt(catalog: str, question: str) -> str:
+    """複数データソースを横断するDuckDB SQLの生成プロンプト"""
+    return f"""
+以下の複数のテーブル情報を基に、ユーザーの質問に答えるDuckDB SQLクエリを生成してください。
+
+{catalog}
+
+ユーザーの質問: {question}
+
+重要な指示:
+- DuckDBの構文を使用すること
+- 上記のテーブル名のみを使用し、必要に応じてJOINやUNIONで結合すること
+- 日付型のカラムはCAST(column_name AS DATE)を使用
+- グラフを要求された場合は、適切なGROUP BYとORDER BYを含める
+- SQLクエリのみを返す（説明は不要）
+"""
+
+
+def build_sql_repair_prompt(error: str) -> str:
+    """事前検証で見つかったエラーを伝えてSQLの修正を求めるプロンプト（生成時の会話に続けて送る）"""
+    return f"""
+上記のSQLを実行前に検証したところ、次のエラーが見つかりました。
+
+{error}
+
+テーブル情報にあるテーブル名・カラム名のみを使用し、エラーを修正したSQLクエリを生成してください（SQLクエリのみを返す）。
+"""
+
+
+def extract_sql(content: str) -> str:
+    """LLMの応答からSQLを取り出す（コードブロックの記号を除去）"""
+    return content.strip().replace("```sql", "").replace("```", "").strip()
+
+
+def build_summary_prompt(question: str, sql: str, result_df: pd.DataFrame) -> str:
+    """分析結果の要約プロンプト（結果は上位10行のみ渡す）"""
+    return f"""
+以下の分析結果を要約してください：
+
+ユーザーの質問: {question}
+実行したSQL: {sql}
+
+結果データ（上位10行）:
+{result_df.head(10).to_string()}
+
+以下の形式で要約してください：
+1. 主な発見（2-3個の重要なポイント）
+2. データの傾向や特徴
+3. ビジネス上の示唆（あれば）
+
+簡潔で分かりやすい日本語で記述してください。
+"""
+
+
+def mcp_tools_to_openai(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """MCPのツール定義をOpenAIのtools形式に変換"""
+    openai_tools = []
+    for tool in tools:
+        openai_tools.append({
+            "type": "function",
+            "function": {
+                "name": tool.get('name', 'unknown'),
+                "description": tool.get('description', ''),
+                "parameters": tool.get('inputSchema', {"type": "object", "properties": {}})
+            }
+        })
+    return openai_tools
+
+
+def build_mcp_messages(source_name: str, history: List[Dict[str, Any]], question: str) -> List[Dict[str, Any]]:
+    """MCPツール呼び出し用のメッセージ（システムプロンプト + 直近の履歴 + 新しい質問）"""
+    messages = [
+        {"role": "system", "content": f"あなたは{source_name}のMCPサーバーに接続されたアシスタントです。利用可能なツールを使ってユーザーの質問に答えてください。データベースのテーブル情報を取得したり、SQLクエリを実行したりできます。"}
+    ]
+    for msg in history[-MCP_HISTORY_LIMIT:]:
+        messages.append({"role": msg["role"], "content": msg["content"]})
+    messages.append({"role": "user", "content": question})
+    return messages
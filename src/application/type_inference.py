@@ -0,0 +1,99 @@
+"""
+取り込み時の型推論
+サンプル値から日付フォーマットを判定し、明示フォーマットで一括変換する
+"""
+from typing import Dict, List, Any, Optional, Tuple
+import pandas as pd
+
+
+# 判定を試す日付フォーマット（先に一致したものを採用）
+DATETIME_FORMATS = [
+    "%Y-%m-%d",
+    "%Y/%m/%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y/%m/%d %H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y年%m月%d日",
+    "%Y%m%d",
+    "%Y-%m",
+    "%Y/%m",
+    "%m/%d/%Y",
+    "%d/%m/%Y",
+    "ISO8601",
+]
+
+
+def column_kind(series: pd.Series) -> str:
+    """pandas dtypeをSQL寄りの型名に分類"""
+    if pd.api.types.is_bool_dtype(series):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(series):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(series):
+        return "FLOAT"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "TIMESTAMP"
+    return "STRING"
+
+
+def detect_datetime_format(values: pd.Series, min_success_rate: float = 1.0) -> Optional[str]:
+    """サンプル値が全て解釈できる日付フォーマットを返す
+
+    Args:
+        values: 非NULLのサンプル値（文字列）
+        min_success_rate: 変換に成功すべき割合
+
+    Returns:
+        一致したフォーマット（該当なしはNone）
+    """
+    if values.empty:
+        return None
+    for fmt in DATETIME_FORMATS:
+        # %Y%m%dは数字8桁以外（IDなど）の誤検出を避ける
+        if fmt == "%Y%m%d" and not values.str.fullmatch(r"\d{8}").all():
+            continue
+        parsed = pd.to_datetime(values, format=fmt, errors="coerce")
+        if parsed.notna().mean() >= min_success_rate:
+            return fmt
+    return None
+
+
+def infer_column_types(df: pd.DataFrame, sample_size: int = 200,
+                       max_new_null_rate: float = 0.01) -> Tuple[pd.DataFrame, Dict[str, Dict[str, Any]]]:
+    """文字列カラムの日付型を推論して変換し、推論結果のスキーマメタデータを返す
+
+    入力DataFrameは変更せず、変換したカラムだけを差し替えたコピーを返す。
+
+    Args:
+        df: 取り込んだDataFrame
+        sample_size: フォーマット判定に使う非NULL値の件数
+        max_new_null_rate: 一括変換で新たにNULLになってよい割合（超えた場合は変換しない）
+
+    Returns:
+        (変換後のDataFrame, {カラム名: {"type": 型名, "format": 日付フォーマット}})
+    """
+    converted = {}
+    metadata = {}
+    for col in df.columns:
+        series = df[col]
+        info = {"type": column_kind(series)}
+        if info["type"] == "STRING" and not isinstance(series.dtype, pd.CategoricalDtype):
+            non_null = series.dropna()
+            sample = non_null.head(sample_size)
+            if not sample.empty and all(isinstance(v, str) for v in sample):
+                fmt = detect_datetime_format(sample.str.strip())
+                if fmt is not None:
+                    parsed = pd.to_datetime(series.str.strip(), format=fmt, errors="coerce")
+                    new_nulls = parsed.isna().sum() - series.isna().sum()
+                    if new_nulls <= max_new_null_rate * max(len(non_null), 1):
+                        converted[col] = parsed
+                        info = {"type": "TIMESTAMP", "format": fmt}
+        metadata[col] = info
+
+    if converted:
+        df = df.copy(deep=False)
+        for col, values in converted.items():
+            df[col] = values
+    return df, metadata
@@ -1,6 +1,76 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable, Tuple, ContextManager
+from contextlib import contextmanager, nullcontext
+import re
+import threading
 import pandas as pd
 from src.domain.interfaces import DataSourceConnector
+from src.infrastructure.tracing import span, record_fetch
+from src.infrastructure.singleflight import query_flights
+
+# execute_query/fetch_query_resultで1回に取得する行数
+FETCH_BATCH_SIZE = 10000
+
+# 非同期クエリの状態（get_query_statusの戻り値）
+QUERY_RUNNING = "running"
+QUERY_SUCCEEDED = "succeeded"
+QUERY_FAILED = "failed"
+QUERY_CANCELLED = "cancelled"
+
+
+def is_sql_error(error: Exception) -> bool:
+    """ウェアハウスがSQLを受け付けなかったエラー（構文・未対応の関数・型の不一致など）か
+
+    SQLSTATEのクラス42（Snowflake・Databricks）、BigQueryのinvalidQueryを判定する。
+    認証・キャンセル・タイムアウト・接続のエラーはFalse。
+    """
+    sqlstate = getattr(error, "sqlstate", None)
+    if sqlstate:
+        return str(sqlstate).startswith("42")
+    reasons = [item.get("reason") for item in getattr(error, "errors", None) or [] if isinstance(item, dict)]
+    if reasons:
+        return "invalidQuery" in reasons
+    # Databricksはメッセージの末尾にSQLSTATEを含める
+    return re.search(r"SQLSTATE: 42", str(error)) is not None
+
+
+class QueryHandle:
+    """1件のクエリだけを中断するためのハンドル
+
+    execute_queryに渡すと、実行中のあいだそのクエリを中断する関数が登録される。
+    cancel()は登録中の関数だけを呼ぶため、同じ接続で実行中の他のクエリは中断しない。
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._cancel: Optional[Callable[[], None]] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def bind(self, cancel: Callable[[], None]):
+        """実行中のあいだcancelを登録する（既にキャンセル済みならcancelを呼んで例外を送出）"""
+        with self._lock:
+            if self.cancelled:
+                cancel()
+                raise RuntimeError("Query was cancelled")
+            self._cancel = cancel
+        try:
+            yield
+        finally:
+            # 登録を外した後に（次の処理に対して）中断が呼ばれないよう、ロック内で外す
+            with self._lock:
+                self._cancel = None
+
+    def cancel(self) -> None:
+        """登録中のクエリを中断（登録前なら、登録した時点で中断する）"""
+        with self._lock:
+            self.cancelled = True
+            if self._cancel is not None:
+                self._cancel()
+
+
+def bind_cancel(handle: Optional[QueryHandle], cancel: Callable[[], None]) -> ContextManager:
+    """handleがあればcancelを登録するコンテキスト（なければ何もしない）"""
+    return handle.bind(cancel) if handle is not None else nullcontext()
 
 
 class BaseConnector(DataSourceConnector):
@@ -9,6 +79,10 @@ class BaseConnector(DataSourceConnector):
     def __init__(self):
         self.connection = None
         self.is_connected = False
+        # 実行中のカーソル/ジョブ（cancel_queryで中断する対象）
+        self._active_cursors = []
+        # 接続先と認証主体（同じ値のコネクタ間では同じクエリの結果を共有できる。Noneならインスタンス内のみ共有）
+        self.identity: Optional[Tuple] = None
     
     def connect(self, credentials: Dict[str, Any]) -> None:
         """継承先で実装"""
@@ -30,17 +104,56 @@ class BaseConnector(DataSourceConnector):
         """継承先で実装"""
         raise NotImplementedError
     
-    def execute_query(self, query: str) -> pd.DataFrame:
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
         """SQLクエリを実行
         
         Args:
             query: 実行するSQLクエリ
+            progress: 取得した行数を受け取るコールバック（バッチごとに呼ばれる）
+            handle: このクエリだけを中断するためのハンドル
             
         Returns:
             クエリ結果のDataFrame
         """
         raise NotImplementedError
     
+    def coalesce_key(self, query: str) -> Tuple:
+        """同じ結果になるクエリを識別するキー（接続先・認証主体・SQL）"""
+        return (self.get_dialect(), self.identity or id(self), query)
+
+    def execute_query_shared(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                             handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """execute_queryと同じだが、同じ接続先・認証主体で同じSQLが実行中ならその結果を共有する
+
+        進捗（progress）とhandleは実際に実行する呼び出し元のものだけが使われる。結果のDataFrameは読み取り専用として扱うこと。
+        """
+        return query_flights.do(self.coalesce_key(query), lambda: self.execute_query(query, progress, handle))
+
+    def cancel_query(self, query_id: Optional[str] = None) -> None:
+        """実行中のクエリをキャンセル（対応していないコネクタでは何もしない）
+        
+        Args:
+            query_id: submit_queryで得たクエリID（省略時は実行中の全クエリ）
+        """
+        pass
+    
+    def submit_query(self, query: str) -> str:
+        """クエリをサーバー側で非同期実行し、クエリIDを返す（接続は実行完了まで保持しない）"""
+        raise NotImplementedError
+    
+    def get_query_status(self, query_id: str) -> str:
+        """非同期クエリの状態を返す（QUERY_RUNNING, QUERY_SUCCEEDED, QUERY_FAILED, QUERY_CANCELLED）"""
+        raise NotImplementedError
+    
+    def fetch_query_result(self, query_id: str, progress: Optional[Callable[[int], None]] = None) -> pd.DataFrame:
+        """非同期クエリの結果をクエリIDで取得（未完了の場合は完了まで待つ）"""
+        raise NotImplementedError
+    
+    def supports_async_query(self) -> bool:
+        """submit_query/get_query_status/fetch_query_resultに対応しているか"""
+        return type(self).submit_query is not BaseConnector.submit_query
+    
     def get_dialect(self) -> str:
         """SQLダイアレクトを返す
         
@@ -58,4 +171,23 @@ class BaseConnector(DataSourceConnector):
     def _ensure_connected(self) -> None:
         """接続確認ヘルパー"""
         if not self.is_connected:
-            raise ConnectionError("Not connected to data source")
\ No newline at end of file
+            raise ConnectionError("Not connected to data source")
+    
+    def _fetch_dataframe(self, cursor: Any, progress: Optional[Callable[[int], None]] = None) -> pd.DataFrame:
+        """DB-APIカーソルの結果をバッチで取得してDataFrameにするヘルパー"""
+        # カラム名を取得
+        columns = [desc[0] for desc in cursor.description]
+        data = []
+        with span("query.fetch"):
+            while True:
+                rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+                if not rows:
+                    break
+                data.extend(rows)
+                if progress:
+                    progress(len(rows))
+        
+        with span("query.to_dataframe"):
+            df = pd.DataFrame(data, columns=columns)
+            record_fetch(df, self.get_dialect())
+        return df
\ No newline at end of file
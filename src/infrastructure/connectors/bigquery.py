@@ -1,7 +1,8 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable
 import pandas as pd
 from google.cloud import bigquery
-from src.infrastructure.connectors.base import BaseConnector
+from src.infrastructure.connectors.base import BaseConnector, QueryHandle, bind_cancel
+from src.infrastructure.tracing import span, record_fetch
 
 
 class BigQueryConnector(BaseConnector):
@@ -28,6 +29,7 @@ class BigQueryConnector(BaseConnector):
             # デフォルト認証を使用
             self.connection = bigquery.Client(project=project_id)
         
+        self.identity = ("bigquery", credentials_path, self.connection.project)
         self.is_connected = True
     
     def list_datasets(self) -> List[str]:
@@ -61,10 +63,30 @@ class BigQueryConnector(BaseConnector):
 
         return schema
 
-    def execute_query(self, query: str) -> pd.DataFrame:
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
         """SQLクエリを実行"""
         self._ensure_connected()
-        return self.connection.query(query).to_dataframe()
+        job = self.connection.query(query)
+        self._active_cursors.append(job)
+        try:
+            with bind_cancel(handle, job.cancel):
+                with span("query.fetch"):
+                    rows = job.result()
+                with span("query.to_dataframe"):
+                    df = rows.to_dataframe()
+                    record_fetch(df, self.get_dialect())
+        finally:
+            self._active_cursors.remove(job)
+        if progress:
+            progress(len(df))
+        return df
+
+    def cancel_query(self, query_id: Optional[str] = None) -> None:
+        """実行中のクエリジョブをキャンセル"""
+        for job in list(self._active_cursors):
+            if query_id is None or job.job_id == query_id:
+                job.cancel()
 
     def get_dialect(self) -> str:
         """SQLダイアレクトを返す"""
@@ -1,12 +1,21 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable
+import hashlib
 import pandas as pd
 from databricks import sql
-from src.infrastructure.connectors.base import BaseConnector
+from databricks.sql.backend.types import CommandState
+from src.infrastructure.connectors.base import (
+    BaseConnector, QueryHandle, bind_cancel, QUERY_RUNNING, QUERY_SUCCEEDED, QUERY_FAILED, QUERY_CANCELLED
+)
 
 
 class DatabricksConnector(BaseConnector):
     """Databricksコネクタの実装"""
     
+    def __init__(self):
+        super().__init__()
+        # 非同期実行中のカーソル {クエリID: カーソル}
+        self._async_cursors = {}
+    
     def connect(self, credentials: Dict[str, Any]) -> None:
         """Databricksに接続
         
@@ -32,6 +41,10 @@ class DatabricksConnector(BaseConnector):
         if credentials.get('schema'):
             self.cursor.execute(f"USE SCHEMA {credentials['schema']}")
         
+        # アクセストークンはそのまま保持せず、ハッシュで認証主体を区別する
+        token_digest = hashlib.sha256(credentials['access_token'].encode()).hexdigest()
+        self.identity = ("databricks", credentials['server_hostname'], credentials['http_path'], token_digest,
+                         credentials.get('catalog'), credentials.get('schema'))
         self.is_connected = True
     
     def list_datasets(self) -> List[str]:
@@ -108,16 +121,65 @@ class DatabricksConnector(BaseConnector):
         
         return schema
     
-    def execute_query(self, query: str) -> pd.DataFrame:
-        """クエリを実行し結果をDataFrameで返す"""
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """クエリを実行し結果をDataFrameで返す（クエリごとに専用カーソルを使い、バッチで取得）"""
         self._ensure_connected()
-        self.cursor.execute(query)
-        
-        # カラム名を取得
-        columns = [desc[0] for desc in self.cursor.description]
-        data = self.cursor.fetchall()
-        
-        return pd.DataFrame(data, columns=columns)
+        cursor = self.connection.cursor()
+        self._active_cursors.append(cursor)
+        try:
+            with bind_cancel(handle, cursor.cancel):
+                cursor.execute(query)
+                return self._fetch_dataframe(cursor, progress)
+        finally:
+            self._active_cursors.remove(cursor)
+            cursor.close()
+    
+    def submit_query(self, query: str) -> str:
+        """execute_asyncでクエリを投入し、クエリIDを返す"""
+        self._ensure_connected()
+        cursor = self.connection.cursor()
+        cursor.execute_async(query)
+        query_id = cursor.query_id
+        self._async_cursors[query_id] = cursor
+        return query_id
+    
+    def get_query_status(self, query_id: str) -> str:
+        """クエリIDで実行状態を取得"""
+        state = self._get_async_cursor(query_id).get_query_state()
+        if state in (CommandState.PENDING, CommandState.RUNNING):
+            return QUERY_RUNNING
+        if state == CommandState.SUCCEEDED:
+            return QUERY_SUCCEEDED
+        if state == CommandState.CANCELLED:
+            return QUERY_CANCELLED
+        return QUERY_FAILED
+    
+    def fetch_query_result(self, query_id: str, progress: Optional[Callable[[int], None]] = None) -> pd.DataFrame:
+        """クエリIDで結果を取得（実行中なら完了を待つ）"""
+        cursor = self._get_async_cursor(query_id)
+        try:
+            cursor.get_async_execution_result()
+            return self._fetch_dataframe(cursor, progress)
+        finally:
+            self._async_cursors.pop(query_id, None)
+            cursor.close()
+    
+    def cancel_query(self, query_id: Optional[str] = None) -> None:
+        """クエリをキャンセル（ID省略時は実行中の全クエリ）"""
+        if query_id is not None:
+            cursors = [self._async_cursors[query_id]] if query_id in self._async_cursors else []
+        else:
+            cursors = list(self._active_cursors) + list(self._async_cursors.values())
+        for cursor in cursors:
+            cursor.cancel()
+    
+    def _get_async_cursor(self, query_id: str):
+        """クエリIDに対応する非同期実行カーソル"""
+        self._ensure_connected()
+        if query_id not in self._async_cursors:
+            raise ValueError(f"Unknown query id: {query_id}")
+        return self._async_cursors[query_id]
     
     def get_dialect(self) -> str:
         """ダイアレクトを返す"""
@@ -1,6 +1,8 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+import time
 import pandas as pd
 import gspread
+from gspread.utils import numericise_all
 from src.infrastructure.connectors.base import BaseConnector
 
 
@@ -12,6 +14,12 @@ class GoogleSheetsConnector(BaseConnector):
         self.gc = None
         self.sheet = None
         self.worksheet = None
+        # 取得済みデータのキャッシュ {シート名: (DataFrame, 取得した行数上限)}
+        self._cache: Dict[str, Tuple[pd.DataFrame, float]] = {}
+        self._cache_revision: Optional[str] = None
+        self._revision_checked_at = 0.0
+        # スプレッドシートの更新時刻を確認する最短間隔（秒）
+        self.revision_check_interval = 30.0
     
     def connect(self, credentials: Dict[str, Any]) -> None:
         """Google Sheetsに接続
@@ -52,15 +60,39 @@ class GoogleSheetsConnector(BaseConnector):
         return []
     
     def get_sample_data(self, dataset: str, table: str, limit: int = 1000) -> pd.DataFrame:
-        """指定したワークシートのデータを取得"""
+        """指定したワークシートの先頭limit行を取得（範囲指定で必要な行だけ読む）"""
         self._ensure_connected()
         if self.sheet:
-            worksheet = self.sheet.worksheet(table)
-            data = worksheet.get_all_records()
-            df = pd.DataFrame(data)
-            return df.head(limit)
+            return self.get_sample_data_batch([table], limit)[table]
         return pd.DataFrame()
     
+    def get_sample_data_batch(self, tables: List[str], limit: int = 1000) -> Dict[str, pd.DataFrame]:
+        """複数ワークシートの先頭limit行を1回のvalues.batchGetでまとめて取得
+        
+        スプレッドシートの更新時刻が変わっていなければキャッシュから返す。
+        
+        Args:
+            tables: ワークシート名のリスト
+            limit: 取得する最大行数（ヘッダー行を除く）
+            
+        Returns:
+            {ワークシート名: DataFrame}
+        """
+        self._ensure_connected()
+        self._refresh_cache_revision()
+        
+        missing = [t for t in tables if t not in self._cache or self._cache[t][1] < limit]
+        if missing:
+            ranges = [self._row_range(t, limit + 1) for t in missing]
+            response = self.sheet.values_batch_get(ranges)
+            for table, value_range in zip(missing, response.get("valueRanges", [])):
+                df = self._values_to_dataframe(value_range.get("values", []))
+                # シート全体がlimit行未満なら以後どの上限でも再取得不要
+                fetched_limit = limit if len(df) >= limit else float("inf")
+                self._cache[table] = (df, fetched_limit)
+        
+        return {t: self._cache[t][0].head(limit) for t in tables}
+    
     def get_table_schema(self, dataset: str, table: str) -> Dict[str, str]:
         """テーブルスキーマを取得（最初の行をカラム名として推定）"""
         self._ensure_connected()
@@ -86,4 +118,39 @@ class GoogleSheetsConnector(BaseConnector):
     
     def close(self) -> None:
         """接続を閉じる（Google Sheetsでは特に何もしない）"""
-        self.is_connected = False
\ No newline at end of file
+        self._cache = {}
+        self.is_connected = False
+    
+    def _refresh_cache_revision(self) -> None:
+        """スプレッドシートの更新時刻（Drive APIのmodifiedTime）が変わっていればキャッシュを破棄"""
+        now = time.time()
+        if self._cache and now - self._revision_checked_at < self.revision_check_interval:
+            return
+        try:
+            revision = self.sheet.get_lastUpdateTime()
+        except Exception:
+            # Drive APIの権限がない場合は常に再取得
+            revision = None
+        self._revision_checked_at = now
+        if revision is None or revision != self._cache_revision:
+            self._cache = {}
+        self._cache_revision = revision
+    
+    @staticmethod
+    def _row_range(table: str, rows: int) -> str:
+        """先頭rows行を指すA1表記の範囲（例: 'Sheet1'!1:1001）"""
+        title = table.replace("'", "''")
+        return f"'{title}'!1:{rows}"
+    
+    @staticmethod
+    def _values_to_dataframe(values: List[List[Any]]) -> pd.DataFrame:
+        """values APIの結果（先頭行がヘッダー）をget_all_recordsと同じ型変換でDataFrameにする"""
+        if not values:
+            return pd.DataFrame()
+        header = values[0]
+        rows = []
+        for row in values[1:]:
+            # 末尾の空セルは省略されて返るため、ヘッダー長に揃える
+            padded = list(row) + [""] * (len(header) - len(row))
+            rows.append(numericise_all(padded[:len(header)], default_blank=""))
+        return pd.DataFrame(rows, columns=header)
\ No newline at end of file
@@ -1,64 +1,470 @@
-from typing import Dict, List, Any, Optional
-import pandas as pd
+from typing import Dict, List, Any, Optional, Callable, Tuple
+import glob
 import os
-from src.infrastructure.connectors.base import BaseConnector
+import re
+import threading
+import duckdb
+import pandas as pd
+from src.infrastructure.connectors.base import BaseConnector, QueryHandle, bind_cancel
+from src.infrastructure.tracing import span, record_fetch, set_attributes
+from src.infrastructure.file_reader import read_csv, read_excel, sheet_table_name, csv_options
+
+try:
+    # ファイルシステムのイベントで変更を検知する（Linuxではinotify、任意）
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+# ディレクトリ・globで読み込める形式と拡張子
+DATASET_EXTENSIONS = {
+    "parquet": (".parquet", ".pq"),
+    "csv": (".csv", ".tsv", ".csv.gz", ".tsv.gz"),
+}
+# Hiveパーティションのディレクトリ名（例: dt=2026-10-01）
+_HIVE_PARTITION = re.compile(r"^[^=/\\]+=[^/\\]*$")
+# 変更を確認する間隔（秒、watchdogがない場合）
+RELOAD_INTERVAL = float(os.getenv("FLASHVIZ_RELOAD_INTERVAL", "2"))
+# CSVの追記の判定で、前回読み込んだ位置の直前の内容と比較するバイト数
+_CSV_TAIL_BYTES = 4096
+# イベントで検知した場合に、書き込みが落ち着くまで待つ秒数
+_WATCH_DEBOUNCE = 0.5
+
+
+def _is_glob(path: str) -> bool:
+    return any(ch in path for ch in "*?[")
+
+
+def _file_format(path: str) -> Optional[str]:
+    lower = path.lower()
+    for file_format, extensions in DATASET_EXTENSIONS.items():
+        if lower.endswith(extensions):
+            return file_format
+    return None
+
+
+def _file_state(path: str) -> Optional[Tuple[int, int]]:
+    """変更の検知に使うファイルの更新日時とサイズ（ファイルがなければNone）"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _table_name(name: str, existing: List[str]) -> str:
+    """ファイル・ディレクトリ名からSQLで使えるテーブル名を作る（重複時は連番を付与）"""
+    base = re.sub(r"\W+", "_", name.lower()).strip("_")
+    if not base or base[0].isdigit():
+        base = f"t_{base}" if base else "t"
+    table = base
+    suffix = 2
+    while table in existing:
+        table = f"{base}_{suffix}"
+        suffix += 1
+    return table
 
 
 class LocalFileConnector(BaseConnector):
-    """ローカルファイルコネクタの実装"""
-    
+    """ローカルファイルコネクタの実装
+
+    1ファイルの場合は従来どおり全体をDataFrameとして読み込み、"data"テーブルとして扱う
+    （Excelは全シートを読み込み、シートごとのテーブルとして扱う。"data"は最初のシート）。
+    ディレクトリ・globの場合はDuckDBのビューとしてファイルを直接参照し（Hiveパーティションはカラムとして公開）、
+    パーティションカラムの条件はDuckDBがファイルを開く前に評価するため、条件に合わないファイルは読まない。
+
+    refresh（またはwatchによる監視）でファイルの更新日時・サイズの変化を検知し、変更されたものだけを読み直す。
+    CSVへの追記は追記された行だけを読み、ディレクトリ・globはファイルごとの状態からテーブル単位で変更を判定する。
+    """
+
     def __init__(self):
         super().__init__()
         self.file_path = None
+        self.file_type = None
         self.df = None
-    
+        # 1ファイルで読み込んだテーブル（Excelはシートごと）
+        self.frames: Dict[str, pd.DataFrame] = {}
+        # {テーブル名: {"patterns": 読み込むファイル・glob, "format", "hive_partitioning", "files": ファイル数,
+        #              "file_states": {ファイル: (更新日時, サイズ)}}}
+        self.tables: Dict[str, Dict[str, Any]] = {}
+        self.union_by_name = False
+        self._dataset_options: Dict[str, Any] = {}
+        # 1ファイルの読み込み時の状態と、CSVの読み込み済みの位置・その直前の内容（追記の判定用）
+        self._file_state: Optional[Tuple[int, int]] = None
+        self._csv_offset: Optional[int] = None
+        self._csv_tail = b""
+        self._reload_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._observer = None
+        self._stop_watching = threading.Event()
+        self._file_events = threading.Event()
+
     def connect(self, credentials: Dict[str, Any]) -> None:
         """ファイルを読み込む
 
         Args:
             credentials: {
-                "file_path": "path/to/file.csv",
-                "file_type": "csv" or "parquet" or "excel"
+                "file_path": "path/to/file.csv"、ディレクトリ、またはglob（例: "exports/orders_*.csv"）,
+                "file_type": "csv" or "parquet" or "excel"（省略時は拡張子から判定）,
+                "progress": Excelのシートの読み込み進捗の通知先 (完了数, 全体数, シート名)（任意）,
+                "hive_partitioning": Hiveパーティションをカラムとして読むか（省略時はパスから自動判定）,
+                "union_by_name": ファイルごとにカラムが異なる場合にカラム名で揃えるか（既定False、全ファイルのスキーマを読む）
             }
         """
         self.file_path = credentials['file_path']
-        file_type = credentials.get('file_type', 'csv').lower()
+
+        if _is_glob(self.file_path) or os.path.isdir(self.file_path):
+            self._connect_dataset(credentials)
+            return
 
         if not os.path.exists(self.file_path):
             raise FileNotFoundError(f"File not found: {self.file_path}")
 
-        if file_type == 'csv':
-            self.df = pd.read_csv(self.file_path)
-        elif file_type == 'parquet':
-            self.df = pd.read_parquet(self.file_path)
-        elif file_type in ['excel', 'xlsx', 'xls']:
-            self.df = pd.read_excel(self.file_path)
+        self.file_type = credentials.get('file_type', 'csv').lower()
+        if self.file_type not in ['csv', 'parquet', 'excel', 'xlsx', 'xls']:
+            raise ValueError(f"Unsupported file type: {self.file_type}")
+        self._load_file(credentials.get('progress'))
+        self.is_connected = True
+
+    def _load_file(self, progress: Optional[Callable[[int, int, str], None]] = None) -> None:
+        """1ファイル全体を読み込む（読み込み中に変更された場合は次回の確認で読み直す）"""
+        state = _file_state(self.file_path)
+        if self.file_type == 'csv':
+            frames = {'data': read_csv(self.file_path, **csv_options(self.file_path))}
+        elif self.file_type == 'parquet':
+            frames = {'data': pd.read_parquet(self.file_path)}
         else:
-            raise ValueError(f"Unsupported file type: {file_type}")
+            frames = {}
+            for sheet, df in read_excel(self.file_path, progress).items():
+                frames[sheet_table_name(sheet, list(frames))] = df
+        unchanged = state is not None and state == _file_state(self.file_path)
+
+        # 追記を検知できるよう、読み込んだ位置と直前の内容を覚えておく（最終行が改行で終わる非圧縮のCSVのみ）
+        self._csv_offset, self._csv_tail = None, b""
+        if self.file_type == 'csv' and unchanged and not self.file_path.lower().endswith('.gz'):
+            with open(self.file_path, 'rb') as f:
+                f.seek(max(0, state[1] - _CSV_TAIL_BYTES))
+                tail = f.read(state[1] - f.tell())
+            if tail.endswith(b"\n"):
+                self._csv_offset, self._csv_tail = state[1], tail
+
+        self.frames = frames
+        self.df = next(iter(frames.values()))
+        self.tables = {table: {"patterns": [self.file_path], "format": self.file_type, "hive_partitioning": False,
+                               "files": 1, "file_states": {self.file_path: state}}
+                       for table in frames}
+        self._file_state = state if unchanged else None
 
+    def _connect_dataset(self, credentials: Dict[str, Any]) -> None:
+        """ディレクトリ・globのファイルをテーブルとしてDuckDBのビューに登録"""
+        self._dataset_options = {
+            "file_type": credentials.get('file_type'),
+            "hive_partitioning": credentials.get('hive_partitioning'),
+        }
+        self.union_by_name = bool(credentials.get('union_by_name', False))
+        self.tables = self._discover()
+
+        self.connection = duckdb.connect()
+        for table, info in self.tables.items():
+            self.connection.execute(f'CREATE VIEW "{table}" AS SELECT * FROM {self._scan_sql(info)}')
+        self.identity = ("local_file", os.path.abspath(self.file_path))
         self.is_connected = True
-    
+
+    def _discover(self) -> Dict[str, Dict[str, Any]]:
+        """ディレクトリ・globのファイルを探索してテーブルの定義を作る"""
+        file_type = self._dataset_options.get("file_type")
+        hive_partitioning = self._dataset_options.get("hive_partitioning")
+        tables: Dict[str, Dict[str, Any]] = {}
+        if _is_glob(self.file_path):
+            files = sorted(path for path in glob.glob(self.file_path, recursive=True) if os.path.isfile(path))
+            if not files:
+                raise FileNotFoundError(f"No files match: {self.file_path}")
+            # パターンの固定部分（最後のディレクトリ名またはファイル名の接頭辞）をテーブル名にする
+            fixed = re.split(r"[*?\[]", self.file_path)[0]
+            name = os.path.basename(fixed) or os.path.basename(os.path.dirname(fixed)) or "data"
+            self._add_table(tables, name, files, self.file_path, file_type, hive_partitioning)
+        else:
+            self._discover_tables(tables, self.file_path, file_type, hive_partitioning)
+        if not tables:
+            raise FileNotFoundError(f"No readable files in: {self.file_path}")
+        return tables
+
+    def _discover_tables(self, tables: Dict[str, Dict[str, Any]], directory: str, file_type: Optional[str],
+                         hive_partitioning: Optional[bool]) -> None:
+        """ディレクトリ内のファイルとパーティションセットをテーブルとして登録
+
+        - Hiveパーティションのディレクトリ（key=value）を含むディレクトリは、配下全体を1つのテーブルにする
+        - 直下のファイルはそれぞれ1つのテーブルにする
+        - それ以外のサブディレクトリは再帰的に探索する
+        """
+        entries = sorted(os.listdir(directory))
+        subdirs = [e for e in entries if os.path.isdir(os.path.join(directory, e))]
+        if any(_HIVE_PARTITION.match(d) for d in subdirs):
+            files = sorted(path for path in glob.glob(os.path.join(directory, "**", "*"), recursive=True)
+                           if os.path.isfile(path))
+            self._add_table(tables, os.path.basename(os.path.normpath(directory)), files, None, file_type,
+                            True if hive_partitioning is None else hive_partitioning, directory)
+            return
+
+        for entry in entries:
+            path = os.path.join(directory, entry)
+            if os.path.isfile(path) and (file_type or _file_format(path)):
+                self._add_table(tables, entry.split(".")[0], [path], path, file_type, False)
+        for entry in subdirs:
+            self._discover_tables(tables, os.path.join(directory, entry), file_type, hive_partitioning)
+
+    def _add_table(self, tables: Dict[str, Dict[str, Any]], name: str, files: List[str], pattern: Optional[str],
+                   file_type: Optional[str], hive_partitioning: Optional[bool], directory: Optional[str] = None) -> None:
+        """同じ形式のファイルの集合を1つのテーブルとして登録（形式が混在する場合はファイル数の多い形式のみ）
+
+        Args:
+            tables: 登録先のテーブルの定義
+            name: テーブル名の元にする名前
+            files: 対象のファイル
+            pattern: ファイルを読むときのパス・glob（Noneならdirectory配下を拡張子のglobで読む）
+            file_type: 形式（省略時は拡張子から判定）
+            hive_partitioning: Hiveパーティションをカラムとして読むか（Noneならパスから判定）
+            directory: patternがNoneの場合の読み込み元ディレクトリ
+        """
+        formats: Dict[str, List[str]] = {}
+        for path in files:
+            file_format = file_type.lower() if file_type else _file_format(path)
+            if file_format in DATASET_EXTENSIONS:
+                formats.setdefault(file_format, []).append(path)
+        if not formats:
+            return
+        file_format, paths = max(formats.items(), key=lambda item: len(item[1]))
+
+        if pattern is None:
+            # 新しいパーティションのファイルも読めるよう、ファイルの一覧ではなく拡張子ごとのglobで指定する
+            patterns = [os.path.join(directory, "**", f"*{ext}") for ext in DATASET_EXTENSIONS[file_format]
+                        if any(path.lower().endswith(ext) for path in paths)]
+        elif len(formats) > 1:
+            patterns = paths
+        else:
+            patterns = [pattern]
+        if hive_partitioning is None:
+            hive_partitioning = any(_HIVE_PARTITION.match(part) for path in paths for part in path.split(os.sep)[:-1])
+
+        tables[_table_name(name, list(tables))] = {
+            "patterns": patterns, "format": file_format, "hive_partitioning": hive_partitioning, "files": len(paths),
+            "file_states": {path: _file_state(path) for path in paths}
+        }
+
+    def _scan_sql(self, info: Dict[str, Any]) -> str:
+        """ファイルを読むDuckDBのテーブル関数
+
+        union_by_nameは全ファイルのスキーマを読むため、パーティションの絞り込みが効かなくなる。
+        既定では最初のファイルのスキーマを使い、ファイルごとにカラムが異なる場合のみ指定する。
+        """
+        patterns = "[" + ", ".join("'" + p.replace("'", "''") + "'" for p in info["patterns"]) + "]"
+        options = f"hive_partitioning = {str(info['hive_partitioning']).lower()}, union_by_name = {str(self.union_by_name).lower()}"
+        if info["format"] == "parquet":
+            return f"read_parquet({patterns}, {options})"
+        return f"read_csv_auto({patterns}, {options})"
+
+    def refresh(self) -> List[str]:
+        """ファイルの変更（更新日時・サイズ）を確認し、変更されたテーブルだけを読み直す
+
+        Returns:
+            内容が変わったテーブル名（追加・削除されたテーブルを含む。変更がなければ空）
+        """
+        self._ensure_connected()
+        with self._reload_lock:
+            if self.df is not None:
+                return self._refresh_file()
+            return self._refresh_dataset()
+
+    def _refresh_file(self) -> List[str]:
+        """1ファイルの変更を確認（CSVへの追記は追記された行だけを読む）"""
+        state = _file_state(self.file_path)
+        # ファイルの置き換え中（一時的に存在しない）の場合は次回に確認する
+        if state is None or state == self._file_state:
+            return []
+        with span("local_file.reload", file=os.path.basename(self.file_path)):
+            appended = None
+            if self._csv_offset is not None and state[1] >= self._csv_offset:
+                appended = self._read_csv_append(state[1])
+            if appended is not None:
+                set_attributes(mode="append", rows=len(appended))
+                self._file_state = state
+                if appended.empty:
+                    return []
+                self.df = pd.concat([self.df, appended], ignore_index=True)
+                self.frames = {'data': self.df}
+                return ['data']
+
+            set_attributes(mode="full")
+            previous = self.frames
+            self._load_file()
+            # 内容が同じテーブル（更新日時だけ変わったファイル、変更のないシート）は変更なしとして扱う
+            changed = [table for table, df in self.frames.items()
+                       if table not in previous or not df.equals(previous[table])]
+            return changed + [table for table in previous if table not in self.frames]
+
+    def _read_csv_append(self, size: int) -> Optional[pd.DataFrame]:
+        """前回読み込んだ位置以降に追記された行だけを読む（前回までの内容が書き換えられていればNone）"""
+        offset = self._csv_offset
+        with open(self.file_path, 'rb') as f:
+            f.seek(offset - len(self._csv_tail))
+            if f.read(len(self._csv_tail)) != self._csv_tail:
+                return None
+            chunk = f.read(size - offset)
+        # 書き込み途中の最終行は次回に読む
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        if not chunk.strip():
+            appended = self.df.iloc[0:0]
+        else:
+            appended = read_csv(chunk, header=None, names=list(self.df.columns), **csv_options(self.file_path))
+            for col, dtype in self.df.dtypes.items():
+                try:
+                    appended[col] = appended[col].astype(dtype)
+                except (TypeError, ValueError):
+                    # 変換できない値が追記された場合は結合時に型を広げる
+                    pass
+        self._csv_offset = offset + len(chunk)
+        self._csv_tail = (self._csv_tail + chunk)[-_CSV_TAIL_BYTES:]
+        return appended
+
+    def _refresh_dataset(self) -> List[str]:
+        """ディレクトリ・globのファイルごとの状態を確認し、ファイルが追加・変更・削除されたテーブルを返す
+
+        ビューはクエリのたびにファイルを読むため、テーブルの追加・削除とglobの変化がない限りビューは作り直さない。
+        """
+        try:
+            tables = self._discover()
+        except OSError:
+            # ファイルの置き換え中などで探索できない場合は次回に確認する
+            return []
+        with span("local_file.reload", file=os.path.basename(os.path.normpath(self.file_path))):
+            changed = []
+            for table, info in tables.items():
+                previous = self.tables.get(table)
+                if previous is None or any(previous[key] != info[key] for key in ("patterns", "format", "hive_partitioning")):
+                    self.connection.execute(f'CREATE OR REPLACE VIEW "{table}" AS SELECT * FROM {self._scan_sql(info)}')
+                    changed.append(table)
+                elif previous["file_states"] != info["file_states"]:
+                    changed.append(table)
+            for table in self.tables:
+                if table not in tables:
+                    self.connection.execute(f'DROP VIEW IF EXISTS "{table}"')
+                    changed.append(table)
+            self.tables = tables
+            set_attributes(mode="dataset", tables=len(changed))
+        return changed
+
+    def watch(self, on_change: Callable[[List[str]], None], interval: float = RELOAD_INTERVAL) -> None:
+        """ファイルの変更を監視し、変更があれば読み直してon_changeに変更されたテーブル名を渡す
+
+        watchdogがインストールされていればファイルシステムのイベント（Linuxではinotify）で、
+        なければinterval秒ごとの更新日時・サイズの確認で検知する。closeで監視を終了する。
+        """
+        self._ensure_connected()
+        if self._watcher is not None:
+            return
+        self._stop_watching.clear()
+        if Observer is not None:
+            self._observer = self._start_observer()
+        self._watcher = threading.Thread(target=self._watch_loop, args=(on_change, interval),
+                                         name="local-file-watch", daemon=True)
+        self._watcher.start()
+
+    def _start_observer(self) -> Any:
+        """ファイル（ディレクトリ・globの場合は配下）のイベントを受け取るwatchdogのObserverを起動"""
+        events = self._file_events
+
+        class ChangeHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                events.set()
+
+        if _is_glob(self.file_path):
+            path, recursive = os.path.dirname(re.split(r"[*?\[]", self.file_path)[0]) or ".", True
+        elif os.path.isdir(self.file_path):
+            path, recursive = self.file_path, True
+        else:
+            path, recursive = os.path.dirname(os.path.abspath(self.file_path)), False
+        observer = Observer()
+        observer.schedule(ChangeHandler(), path, recursive=recursive)
+        observer.daemon = True
+        observer.start()
+        return observer
+
+    def _watch_loop(self, on_change: Callable[[List[str]], None], interval: float) -> None:
+        while not self._stop_watching.is_set():
+            if self._observer is not None:
+                # イベントを取りこぼした場合に備えて、イベントがなくても一定時間ごとに確認する
+                self._file_events.wait(max(interval, 60.0))
+                # 書き込みが続いている間のイベントはまとめて1回の確認にする
+                self._stop_watching.wait(_WATCH_DEBOUNCE)
+                self._file_events.clear()
+            else:
+                self._stop_watching.wait(interval)
+            if self._stop_watching.is_set():
+                return
+            try:
+                changed = self.refresh()
+            except Exception:
+                # 書き込み途中などで読めない場合は、次の確認で読み直す
+                continue
+            if changed:
+                on_change(changed)
+
+    def close(self) -> None:
+        """監視を終了して接続を閉じる"""
+        self._stop_watching.set()
+        self._file_events.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+        self._watcher = None
+        super().close()
+
     def list_datasets(self) -> List[str]:
-        """ファイル名を返す（データセットの代わり）"""
+        """ファイル名（ディレクトリ名・glob）を返す（データセットの代わり）"""
         self._ensure_connected()
-        return [os.path.basename(self.file_path)]
-    
+        return [os.path.basename(os.path.normpath(self.file_path)) or self.file_path]
+
     def list_tables(self, dataset: str) -> List[str]:
-        """'data'という固定テーブル名を返す"""
+        """テーブル名を返す（1ファイルの場合は'data'かExcelのシートごと、ディレクトリ・globの場合はファイル・パーティションセットごと）"""
+        self._ensure_connected()
+        return list(self.tables)
+
+    def list_partitions(self, table: str) -> List[str]:
+        """テーブルのパーティションカラム（Hiveパーティションのキー）"""
         self._ensure_connected()
-        return ['data']
-    
-    def get_sample_data(self, dataset: str, table: str, limit: int = 1000) -> pd.DataFrame:
-        """サンプルデータを取得"""
+        info = self.tables[table]
+        if not info["hive_partitioning"]:
+            return []
+        keys = []
+        for pattern in info["patterns"]:
+            for path in glob.glob(pattern, recursive=True):
+                keys = [part.split("=", 1)[0] for part in path.split(os.sep)[:-1] if _HIVE_PARTITION.match(part)]
+                # 全ファイルが同じレイアウトの前提で、最初のファイルだけを見る
+                return keys
+        return keys
+
+    def get_sample_data(self, dataset: str, table: str = 'data', limit: int = 1000) -> pd.DataFrame:
+        """サンプルデータを取得（ディレクトリ・globの場合は先頭のファイルから読む）"""
         self._ensure_connected()
-        return self.df.head(limit)
-    
-    def get_table_schema(self, dataset: str, table: str) -> Dict[str, str]:
+        if self.df is not None:
+            return self.frames.get(table, self.df).head(limit)
+        return self.execute_query(f'SELECT * FROM "{table}" LIMIT {int(limit)}')
+
+    def get_table_schema(self, dataset: str, table: str = 'data') -> Dict[str, str]:
         """テーブルスキーマを取得"""
         self._ensure_connected()
+        df = self.frames.get(table, self.df)
+        if df is None:
+            cursor = self.connection.cursor()
+            try:
+                rows = cursor.execute(f'DESCRIBE "{table}"').fetchall()
+            finally:
+                cursor.close()
+            return {row[0]: row[1] for row in rows}
+
         schema = {}
-        for col in self.df.columns:
-            dtype = str(self.df[col].dtype)
+        for col in df.columns:
+            dtype = str(df[col].dtype)
             # pandas dtypeをSQL型にマッピング
             if 'int' in dtype:
                 schema[col] = 'INTEGER'
@@ -72,5 +478,35 @@ class LocalFileConnector(BaseConnector):
                 schema[col] = 'BOOLEAN'
             else:
                 schema[col] = 'STRING'
-        
-        return schema
\ No newline at end of file
+
+        return schema
+
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """DuckDBでクエリを実行（ディレクトリ・globの場合はファイルを直接読み、1ファイルの場合は読み込み済みのDataFrameを使う）"""
+        self._ensure_connected()
+        if self.df is not None:
+            cursor = duckdb.connect()
+            for table, df in self.frames.items():
+                cursor.register(table, df)
+            if 'data' not in self.frames:
+                cursor.register('data', self.df)
+        else:
+            # クエリごとに専用カーソルを使う（ビューは全カーソルから参照できる）
+            cursor = self.connection.cursor()
+        self._active_cursors.append(cursor)
+        try:
+            with bind_cancel(handle, cursor.interrupt), span("query.fetch"):
+                result = cursor.execute(query).fetchdf()
+            record_fetch(result, "local_file")
+            if progress:
+                progress(len(result))
+            return result
+        finally:
+            self._active_cursors.remove(cursor)
+            cursor.close()
+
+    def cancel_query(self, query_id: Optional[str] = None) -> None:
+        """実行中のクエリを中断"""
+        for cursor in list(self._active_cursors):
+            cursor.interrupt()
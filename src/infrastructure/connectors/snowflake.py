@@ -1,7 +1,11 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable
 import pandas as pd
+import re
 import snowflake.connector
-from src.infrastructure.connectors.base import BaseConnector
+from snowflake.connector.constants import QueryStatus
+from src.infrastructure.connectors.base import (
+    BaseConnector, QueryHandle, bind_cancel, QUERY_RUNNING, QUERY_SUCCEEDED, QUERY_FAILED, QUERY_CANCELLED
+)
 
 
 class SnowflakeConnector(BaseConnector):
@@ -59,6 +63,9 @@ class SnowflakeConnector(BaseConnector):
             role=credentials.get('role')
         )
         self.cursor = self.connection.cursor()
+        # 修飾なしのテーブル名の解決先（database/schema）も結果に影響するため含める
+        self.identity = ("snowflake", credentials['account'], credentials['user'], credentials.get('role'),
+                         credentials.get('warehouse'), credentials.get('database'), credentials.get('schema'))
         self.is_connected = True
     
     def list_datasets(self) -> List[str]:
@@ -127,16 +134,76 @@ class SnowflakeConnector(BaseConnector):
         
         return schema
     
-    def execute_query(self, query: str) -> pd.DataFrame:
-        """クエリを実行し結果をDataFrameで返す"""
+    def execute_query(self, query: str, progress: Optional[Callable[[int], None]] = None,
+                      handle: Optional[QueryHandle] = None) -> pd.DataFrame:
+        """クエリを実行し結果をDataFrameで返す（クエリごとに専用カーソルを使い、バッチで取得）
+
+        クエリIDを得てから結果を待つため、handleからはこのクエリだけをSYSTEM$CANCEL_QUERYで中断できる。
+        """
         self._ensure_connected()
-        self.cursor.execute(query)
-        
-        # カラム名を取得
-        columns = [desc[0] for desc in self.cursor.description]
-        data = self.cursor.fetchall()
-        
-        return pd.DataFrame(data, columns=columns)
+        cursor = self.connection.cursor()
+        self._active_cursors.append(cursor)
+        try:
+            cursor.execute_async(query)
+            query_id = cursor.sfqid
+            with bind_cancel(handle, lambda: self.cancel_query(query_id)):
+                cursor.get_results_from_sfqid(query_id)
+                return self._fetch_dataframe(cursor, progress)
+        finally:
+            self._active_cursors.remove(cursor)
+            cursor.close()
+    
+    def submit_query(self, query: str) -> str:
+        """execute_asyncでクエリを投入し、クエリIDを返す"""
+        self._ensure_connected()
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute_async(query)
+            return cursor.sfqid
+        finally:
+            cursor.close()
+    
+    def get_query_status(self, query_id: str) -> str:
+        """クエリIDで実行状態を取得"""
+        self._ensure_connected()
+        status = self.connection.get_query_status(query_id)
+        if self.connection.is_still_running(status):
+            return QUERY_RUNNING
+        if status in (QueryStatus.ABORTING, QueryStatus.ABORTED):
+            return QUERY_CANCELLED
+        if self.connection.is_an_error(status):
+            return QUERY_FAILED
+        return QUERY_SUCCEEDED
+    
+    def fetch_query_result(self, query_id: str, progress: Optional[Callable[[int], None]] = None) -> pd.DataFrame:
+        """クエリIDで結果を取得（実行中なら完了を待つ）"""
+        self._ensure_connected()
+        cursor = self.connection.cursor()
+        self._active_cursors.append(cursor)
+        try:
+            cursor.get_results_from_sfqid(query_id)
+            return self._fetch_dataframe(cursor, progress)
+        finally:
+            self._active_cursors.remove(cursor)
+            cursor.close()
+    
+    def cancel_query(self, query_id: Optional[str] = None) -> None:
+        """クエリをキャンセル（ID省略時はこのセッションで実行中の全クエリ）"""
+        if not self.is_connected:
+            return
+        if query_id is not None:
+            if not re.fullmatch(r"[0-9a-fA-F-]+", query_id):
+                raise ValueError(f"Invalid query id: {query_id}")
+            statement = f"SELECT SYSTEM$CANCEL_QUERY('{query_id}')"
+        elif self._active_cursors:
+            statement = f"SELECT SYSTEM$CANCEL_ALL_QUERIES({self.connection.session_id})"
+        else:
+            return
+        cancel_cursor = self.connection.cursor()
+        try:
+            cancel_cursor.execute(statement)
+        finally:
+            cancel_cursor.close()
     
     def get_dialect(self) -> str:
         """SQLダイアレクトを返す"""
@@ -0,0 +1,188 @@
+"""
+ローカルファイルの読み込み
+CSVはArrowのマルチスレッドリーダー、Excelはcalamine（Rust実装、インストールされている場合）で読み込み、
+ブックの全シートを別プロセスで並列に変換して、シートごとに1つのテーブルとして返す
+"""
+from typing import Dict, Any, Optional, Callable, List
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import datetime
+import io
+import multiprocessing
+import os
+import re
+import threading
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+EXCEL_EXTENSIONS = (".xlsx", ".xls", ".xlsm", ".xlsb", ".ods")
+# シートを並列に読むプロセス数
+MAX_SHEET_WORKERS = int(os.getenv("FLASHVIZ_SHEET_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# 進捗の通知先 (完了数, 全体数, 内容)
+ProgressCallback = Callable[[int, int, str], None]
+
+
+def _as_buffer(data: Any) -> Any:
+    """ファイルパス、bytes、またはアップロードファイル（BytesIO）を読み込み元にする"""
+    if isinstance(data, (str, os.PathLike)):
+        return data
+    if hasattr(data, "getbuffer"):
+        data.seek(0)
+        return data
+    return io.BytesIO(data)
+
+
+def csv_options(file_name: str) -> Dict[str, Any]:
+    """拡張子に応じたread_csvのオプション（TSVの区切り文字、.gzの圧縮形式）
+
+    bytes・アップロードファイルからの読み込みではpandasが拡張子から圧縮形式を推測しないため明示する。
+    """
+    lower = file_name.lower()
+    options: Dict[str, Any] = {}
+    if lower.endswith((".tsv", ".tsv.gz")):
+        options["sep"] = "\t"
+    if lower.endswith(".gz"):
+        options["compression"] = "gzip"
+    return options
+
+
+def _dates_to_datetime(df: pd.DataFrame) -> pd.DataFrame:
+    """Arrowが日付型（date32）として読んだカラム（datetime.dateのobject）をdatetime64にする
+
+    従来のパーサーと同じく、型推論で日時のカラムとして扱われるようにする。
+    """
+    for col in df.columns:
+        series = df[col]
+        if series.dtype != object:
+            continue
+        index = series.first_valid_index()
+        if index is None:
+            continue
+        value = series.loc[index]
+        if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            df[col] = pd.to_datetime(series)
+    return df
+
+
+def read_csv(data: Any, **kwargs: Any) -> pd.DataFrame:
+    """CSVをArrowのマルチスレッドリーダーで読み込む（Arrowで読めない形式は従来のパーサーで読み直す）
+
+    Args:
+        data: ファイルパス、bytes、またはアップロードファイル
+        kwargs: pd.read_csvに渡すオプション（header, names, sep, compressionなど。csv_options参照）
+    """
+    source = _as_buffer(data)
+    try:
+        return _dates_to_datetime(pd.read_csv(source, engine="pyarrow", **kwargs))
+    except (pa.ArrowException, ValueError):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return pd.read_csv(source, **kwargs)
+
+
+def _read_sheet(data: Any, sheet_name: str, engine: str) -> pd.DataFrame:
+    """1シートを読み込む（ワーカープロセスで実行）"""
+    return pd.read_excel(_as_buffer(data), sheet_name=sheet_name, engine=engine)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """シートの読み込みに使う共有プロセスプール（起動コストを1回にするため使い回す）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=MAX_SHEET_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def read_excel(data: Any, progress: Optional[ProgressCallback] = None,
+               engine: str = EXCEL_ENGINE) -> Dict[str, pd.DataFrame]:
+    """ブックの全シートを読み込む（2シート以上は別プロセスで並列に変換）
+
+    Returns:
+        {シート名: DataFrame}（ブック内の順序）
+    """
+    source = _as_buffer(data)
+    with pd.ExcelFile(source, engine=engine) as book:
+        sheet_names: List[str] = list(book.sheet_names)
+    total = len(sheet_names)
+
+    if total <= 1 or MAX_SHEET_WORKERS <= 1:
+        sheets = {}
+        for i, name in enumerate(sheet_names):
+            sheets[name] = _read_sheet(data, name, engine)
+            if progress:
+                progress(i + 1, total, name)
+        return sheets
+
+    # ワーカーには（アップロードファイルではなく）内容のbytesを渡す
+    payload = data if isinstance(data, (str, os.PathLike)) else bytes(source.getbuffer())
+    sheets = {}
+    try:
+        pool = _get_pool()
+        futures = {pool.submit(_read_sheet, payload, name, engine): name for name in sheet_names}
+        for done, future in enumerate(as_completed(futures), start=1):
+            sheets[futures[future]] = future.result()
+            if progress:
+                progress(done, total, futures[future])
+    except (BrokenProcessPool, OSError):
+        # プロセスを起動できない環境では順に読む
+        _reset_pool()
+        for i, name in enumerate(sheet_names):
+            if name not in sheets:
+                sheets[name] = _read_sheet(data, name, engine)
+            if progress:
+                progress(i + 1, total, name)
+    return {name: sheets[name] for name in sheet_names}
+
+
+def read_tables(data: Any, file_name: str, progress: Optional[ProgressCallback] = None) -> Dict[str, pd.DataFrame]:
+    """ファイルを拡張子に応じて読み込み、テーブル名ごとのDataFrameを返す
+
+    CSV・Parquetは"data"の1テーブル、Excelはシートごとのテーブル（シート名）。
+    """
+    lower = file_name.lower()
+    if lower.endswith(EXCEL_EXTENSIONS):
+        return read_excel(data, progress)
+    if progress:
+        progress(0, 1, file_name)
+    if lower.endswith((".csv", ".tsv", ".csv.gz", ".tsv.gz")):
+        df = read_csv(data, **csv_options(file_name))
+    elif lower.endswith((".parquet", ".pq")):
+        df = pd.read_parquet(_as_buffer(data))
+    else:
+        raise ValueError(f"Unsupported file type: {file_name}")
+    if progress:
+        progress(1, 1, file_name)
+    return {"data": df}
+
+
+def sheet_table_name(sheet_name: str, existing: List[str]) -> str:
+    """シート名からSQLで使えるテーブル名を作る（重複時は連番を付与）"""
+    base = re.sub(r"\W+", "_", str(sheet_name).lower()).strip("_")
+    if not base or base[0].isdigit():
+        base = f"sheet_{base}" if base else "sheet"
+    name = base
+    suffix = 2
+    while name in existing:
+        name = f"{base}_{suffix}"
+        suffix += 1
+    return name
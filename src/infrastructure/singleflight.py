@@ -0,0 +1,79 @@
+"""
+同一リクエストの実行中の共有（singleflight）
+同じキーの処理が実行中なら新たに実行せず、実行中の処理の結果（または例外）を待って受け取る。
+LLMの同じリクエストやウェアハウスの同じクエリが同時に投げられたときに、トークンとクエリの実行コストを1回分にする。
+結果は複数の呼び出し元で共有されるため、読み取り専用として扱うこと。
+"""
+from typing import Dict, Any, Callable, Hashable, Tuple
+from concurrent.futures import Future
+import threading
+from src.infrastructure.tracing import set_attributes, metrics
+
+
+class _Call:
+    """実行中の処理と、その結果を待っている呼び出し元の数"""
+
+    def __init__(self):
+        self.future: Future = Future()
+        self.waiters = 1
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つにまとめる"""
+
+    def __init__(self, kind: str):
+        """
+        Args:
+            kind: メトリクスのラベル（"llm", "query"など）
+        """
+        self.kind = kind
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """keyの処理が実行中ならその結果を待ち、なければfuncを実行する"""
+        return self.call(key, func)[0]
+
+    def call(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """doと同じだが、(結果, 他の呼び出し元の結果を共有したか) を返す"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            set_attributes(coalesced=True)
+            metrics.increment("flashviz_coalesced_total", kind=self.kind)
+            try:
+                return call.future.result(), True
+            finally:
+                with self._lock:
+                    call.waiters -= 1
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.future.set_exception(e)
+            raise
+        else:
+            call.future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                call.waiters -= 1
+                del self._calls[key]
+
+    def waiters(self, key: Hashable) -> int:
+        """keyの結果を待っている呼び出し元の数（実行中でなければ0）"""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+
+
+# LLMのリクエストとウェアハウスのクエリで共有するインスタンス
+llm_flights = SingleFlight("llm")
+query_flights = SingleFlight("query")
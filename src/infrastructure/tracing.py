@@ -0,0 +1,248 @@
+"""
+処理段階ごとの計測（軽量なスパン）とPrometheusメトリクス
+LLM呼び出し・クエリ実行・DataFrame変換・グラフ作成などの所要時間、トークン数、取得行数/バイト数を記録する
+"""
+from typing import Dict, List, Any, Optional, Iterator, Tuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import pandas as pd
+
+
+# 所要時間ヒストグラムのバケット境界（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Trace:
+    """1件の質問に対するスパンの記録（スレッドをまたいで記録できる）"""
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.started_at = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def has_span(self, name: str) -> bool:
+        """指定した名前のスパンが記録済みか"""
+        return any(span["name"] == name for span in self.spans)
+
+    def elapsed(self) -> float:
+        """トレース開始から最後のスパン終了までの秒数"""
+        if not self.spans:
+            return 0.0
+        return max(span["start"] + span["duration"] for span in self.spans) - self.started_at
+
+    def total(self, attribute: str) -> int:
+        """全スパンの属性値の合計（トークン数・行数など）"""
+        return sum(span["attributes"].get(attribute, 0) for span in self.spans)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """タイミングパネル表示用の表（開始順、入れ子はインデントで表現）"""
+        rows = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            details = ", ".join(f"{key}={_format_number(value)}" for key, value in span["attributes"].items())
+            rows.append({
+                "段階": "　" * span["depth"] + span["name"],
+                "開始(ms)": round((span["start"] - self.started_at) * 1000, 1),
+                "時間(ms)": round(span["duration"] * 1000, 1),
+                "詳細": details,
+            })
+        return pd.DataFrame(rows, columns=["段階", "開始(ms)", "時間(ms)", "詳細"])
+
+
+# 現在のトレースとスパン（ワーカースレッドへはcontextvars.copy_contextで引き継ぐ）
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("flashviz_trace", default=None)
+_current_span: ContextVar[Optional[Dict[str, Any]]] = ContextVar("flashviz_span", default=None)
+
+
+@contextmanager
+def activate(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """このブロック内のスパンを指定したトレースに記録する（Noneならメトリクスのみ）"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """処理段階を計測するスパン
+
+    所要時間はPrometheusのヒストグラムに常に記録し、トレースが有効なら入れ子の深さとともにトレースにも追加する。
+    """
+    parent = _current_span.get()
+    record = {
+        "name": name,
+        "start": time.time(),
+        "duration": 0.0,
+        "depth": parent["depth"] + 1 if parent is not None else 0,
+        "attributes": dict(attributes),
+        "error": None,
+    }
+    token = _current_span.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - start
+        _current_span.reset(token)
+        metrics.observe("flashviz_stage_duration_seconds", record["duration"], stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(record)
+
+
+def set_attributes(**attributes: Any) -> None:
+    """現在のスパンに属性を追加（スパン外では何もしない）"""
+    current = _current_span.get()
+    if current is not None:
+        current["attributes"].update(attributes)
+
+
+def record_llm_usage(model: str, usage: Any) -> None:
+    """OpenAIの応答のusageをトークン数として記録"""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    set_attributes(model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    metrics.increment("flashviz_llm_tokens_total", prompt_tokens, model=model, type="prompt")
+    metrics.increment("flashviz_llm_tokens_total", completion_tokens, model=model, type="completion")
+
+
+def record_fetch(df: pd.DataFrame, source: str) -> None:
+    """取得した行数・バイト数を記録（バイト数は全要素を走査しない目安で、文字列カラムはポインタ分のみ）"""
+    rows = len(df)
+    num_bytes = int(df.memory_usage(deep=False, index=False).sum())
+    set_attributes(rows=rows, bytes=num_bytes)
+    metrics.increment("flashviz_rows_fetched_total", rows, source=source)
+    metrics.increment("flashviz_bytes_fetched_total", num_bytes, source=source)
+
+
+def _format_number(value: Any) -> str:
+    """数値を桁落ちなく文字列化（整数はそのまま、指数表記にしない）"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label_value(value: Any) -> str:
+    """Prometheusのラベル値をエスケープ"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """カウンターとヒストグラムを保持し、Prometheusのテキスト形式で出力する"""
+
+    HELP = {
+        "flashviz_stage_duration_seconds": "Duration of each pipeline stage",
+        "flashviz_llm_tokens_total": "LLM tokens used",
+        "flashviz_rows_fetched_total": "Rows fetched from data sources",
+        "flashviz_bytes_fetched_total": "Bytes of fetched result data (in-memory size)",
+        "flashviz_questions_total": "Questions processed by status",
+        "flashviz_llm_queue_wait_seconds": "Time LLM requests waited for a slot and rate limit",
+        "flashviz_llm_request_seconds": "LLM request latency excluding queue wait",
+        "flashviz_llm_retries_total": "LLM request retries by reason",
+        "flashviz_coalesced_total": "Requests that shared an identical in-flight call",
+        "flashviz_preflight_total": "SQL pre-flight checks by result (ok or failed stage)",
+        "flashviz_ingest_cache_total": "File ingestions by cache result (memory, disk or miss)",
+        "flashviz_source_reloads_total": "Local file sources reloaded after the file changed",
+    }
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        # {(名前, ラベル): [バケットごとの件数, 合計, 件数]}
+        self._histograms: Dict[Tuple[str, Tuple], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(DURATION_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式（exposition format）"""
+        def format_labels(labels: Tuple, extra: Tuple = ()) -> str:
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in items) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{format_labels(labels)} {_format_number(value)}")
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in declared:
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{format_labels(labels, (('le', f'{bound:g}'),))} {bucket_count}")
+            lines.append(f"{name}_bucket{format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {_format_number(total)}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+# プロセス全体で共有するメトリクス
+metrics = MetricsRegistry()
+
+_metrics_server: Optional[ThreadingHTTPServer] = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> None:
+    """/metrics をPrometheus形式で返すHTTPサーバーをバックグラウンドで起動（起動済みなら何もしない）"""
+    global _metrics_server
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with _metrics_server_lock:
+        if _metrics_server is not None:
+            return
+        _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        _metrics_server.daemon_threads = True
+        threading.Thread(target=_metrics_server.serve_forever, name="metrics-server", daemon=True).start()